@@ -1,14 +1,15 @@
 from __future__ import with_statement
-from syncdav import davfs, filesystems, syncer, ntplib
+from syncdav import davfs, filesystems, syncer, ntplib, blobcache
+from syncdav.common import WorkQueue
 import binascii
 import ConfigParser
 import datetime
 import codecs
 import httplib
-import ssl
-import socket
 import hashlib
+import threading
 import time
+import os
 
 try:
     import keyring
@@ -16,34 +17,8 @@ except ImportError as e:
     print "*** For passwords security its recommended to install keyring: 'pip install keyring' ***"
 
 
-def _disableCertificateCheck(server):
-    try:
-        _create_unverified_https_context = ssl._create_unverified_context
-    except AttributeError:
-        # Legacy Python that doesn't verify HTTPS certificates by default
-        pass
-    else:
-        # Handle target environment that doesn't support HTTPS verification
-        ssl._create_default_https_context = _create_unverified_https_context
-        with open(FileSyncer.LOG_FILE_NAME, "a") as logFile:
-            logFile.write(server + ": server SSL Certificate check DISABLED. Server SHA256 fingerprint check ENABLED.\n")
-
-
-def _enableCertificateCheck(server):
-    try:
-        _create_verified_https_context = ssl.create_default_context
-    except AttributeError:
-        # Legacy Python that doesn't verify HTTPS certificates by default
-        pass
-    else:
-        # Handle target environment that doesn't support HTTPS verification
-        ssl._create_default_https_context = _create_verified_https_context
-        with open(FileSyncer.LOG_FILE_NAME, "a") as logFile:
-            logFile.write(server + ": server SSL Certificate check ENABLED. Server SHA256 fingerprint check DISABLED.\n")
-
-
 class SyncElement:
-    def __init__(self, syncPaths, server, port, proto, username, password, maxFileSizeKb, isReadOnly, sha256, syncOnlyExistingPath, useLocks, threadsCount):
+    def __init__(self, syncPaths, server, port, proto, username, password, maxFileSizeKb, isReadOnly, sha256, syncOnlyExistingPath, useLocks, threadsCount, webDavOptions = None):
         self.syncPaths = syncPaths
         self.server = server
         self.port = port
@@ -56,6 +31,7 @@ class SyncElement:
         self.syncOnlyExistingPath = syncOnlyExistingPath
         self.useLocks = useLocks
         self.threadsCount = threadsCount
+        self.webDavOptions = webDavOptions
 
     def isSet(self):
         return self.syncPaths != None and len(self.syncPaths) > 0
@@ -73,8 +49,44 @@ class SyncElement:
         return self.sha256 != None and len(self.sha256) > 0
 
 
-    def getFileSystem(self):
-        filesystem = filesystems.WebDavFileSystem(self.server, self.port, self.proto, self.username, self.password, self.useLocks) if self.isRemote() else filesystems.LocalFileSystem()
+    def detectMoves(self):
+        return self.webDavOptions != None and self.webDavOptions.detectMoves
+
+
+    def getTransferThreadsCount(self):
+        return self.webDavOptions.transferThreads if self.webDavOptions != None else 0
+
+
+    def smallFilesFirst(self):
+        return self.webDavOptions == None or self.webDavOptions.smallFilesFirst
+
+
+    # metadataCaches, blobCaches - dicts of remote metadata and file content caches shared by all tasks with the same
+    # server in sync run. serverStates - dict of network state (response time, bandwidth, requests limit, TLS session) of servers.
+    def getFileSystem(self, metadataCaches = None, blobCaches = None, serverStates = None):
+        options = self.webDavOptions if self.webDavOptions != None else davfs.WebDavOptions()
+        if self.isRemote():
+            serverKey = (self.server, self.port, self.proto, self.username)
+            metadataCache = None
+            if metadataCaches != None:
+                metadataCache = metadataCaches.setdefault(serverKey, davfs.WebDavMetadataCache())
+            blobCache = None
+            if blobCaches != None and options.blobCacheSize > 0:
+                if serverKey not in blobCaches:
+                    blobCacheDirPath = os.path.join(FileSyncer.SETTINGS_DATA_DIR, FileSyncer.BLOB_CACHE_DIR, hashlib.sha224(repr(serverKey)).hexdigest())
+                    blobCaches[serverKey] = blobcache.BlobCache(blobCacheDirPath, options.blobCacheSize)
+                blobCache = blobCaches[serverKey]
+            serverState = None
+            if serverStates != None:
+                # tasks with other certificate fingerprint or limits of the same server get their own state
+                stateKey = (self.server, self.port, self.proto, self.sha256 if self.isServerSha256FingerprintSet() else None) + options.getServerStateOptions()
+                if stateKey not in serverStates:
+                    serverStates[stateKey] = davfs.WebDavServerState(options, self.sha256 if self.isServerSha256FingerprintSet() else None)
+                serverState = serverStates[stateKey]
+            filesystem = filesystems.WebDavFileSystem(self.server, self.port, self.proto, self.username, self.password, self.useLocks, options, metadataCache = metadataCache, blobCache = blobCache,
+                                                      serverState = serverState)
+        else:
+            filesystem = filesystems.LocalFileSystem(options.chunkSize, options.resumeMinSize)
         return filesystems.ReadOnlyFileSystem(filesystem) if self.isReadOnly else filesystem
 
 
@@ -84,8 +96,8 @@ class SyncPair:
         self.local  = SyncElement("", "", 0, "", "", "", 0, False, "", True, True, 1)
 
 
-    def addSyncElement(self, syncPaths, server, port, proto, username, password, maxFileSizeKb, isReadOnly, sha256, syncOnlyExistingPath, useLocks, threadsCount):
-        syncElement = SyncElement(syncPaths, server, port, proto, username, password, maxFileSizeKb, isReadOnly, sha256, syncOnlyExistingPath, useLocks, threadsCount)
+    def addSyncElement(self, syncPaths, server, port, proto, username, password, maxFileSizeKb, isReadOnly, sha256, syncOnlyExistingPath, useLocks, threadsCount, webDavOptions):
+        syncElement = SyncElement(syncPaths, server, port, proto, username, password, maxFileSizeKb, isReadOnly, sha256, syncOnlyExistingPath, useLocks, threadsCount, webDavOptions)
         if syncElement.isRemote() and not self.remote.isSet():
             self.remote = syncElement
         elif syncElement.isLocal() and not self.local.isSet():
@@ -102,6 +114,8 @@ class FileSyncer:
     LOG_START_MARKER           = "--------------"
     SETTINGS_DATA_DIR          = "FileSyncerData"
     BACKUP_DATA_DIR            = "FileSyncerBackup"
+    BLOB_CACHE_DIR             = "cache"
+    RESUME_DIR                 = "resume"
     INI_SYNC_PATHS             = "SyncPaths"
     INI_SYNC_PATH_DELIMITER    = "|"
     INI_SECTION_NAME_DELIMITER = " "
@@ -116,6 +130,29 @@ class FileSyncer:
     INI_ONLY_EXISTING_PATH     = "OnlyIfSyncPathExist"
     INI_USE_LOCKS              = "UseLocks"
     INI_MAX_THREADS            = "MaxThreads"
+    INI_MAX_CONNECTIONS        = "MaxConnections"
+    INI_CHUNK_SIZE_KB          = "ChunkSizeKB"
+    INI_MAX_RETRIES            = "MaxRetries"
+    INI_RETRY_BACKOFF_SEC      = "RetryBackoffSec"
+    INI_RETRY_BUDGET           = "RetryBudget"
+    INI_REMOTE_SNAPSHOT        = "RemoteSnapshot"
+    INI_SYNC_COLLECTION        = "SyncCollection"
+    INI_BLOB_CACHE_SIZE_MB     = "BlobCacheSizeMB"
+    INI_SEGMENTED_DOWNLOAD_MB  = "SegmentedDownloadMB"
+    INI_DOWNLOAD_SEGMENTS      = "DownloadSegments"
+    INI_RESUME_TRANSFER_MB     = "ResumeTransferMB"
+    INI_UPLOAD_SEGMENT_MB      = "UploadSegmentMB"
+    INI_COMPRESSION            = "Compression"
+    INI_DETECT_MOVES           = "DetectMoves"
+    INI_LOCK_MODE              = "LockMode"
+    INI_PIPELINE_DEPTH         = "PipelineDepth"
+    INI_MAX_REQUESTS           = "MaxRequests"
+    INI_CIRCUIT_BREAKER        = "CircuitBreakerFailures"
+    INI_CIRCUIT_BREAKER_SEC    = "CircuitBreakerResetSec"
+    INI_TRANSFER_THREADS       = "TransferThreads"
+    INI_SMALL_FILES_FIRST      = "SmallFilesFirst"
+    INI_RUN_SECTION            = "FileSyncer" # settings of entire sync run, not a task
+    INI_MAX_TASKS              = "MaxTasks"
     INI_KEYRING_PASS           = "[****]"
     KEYRING_APP_NAME           = "FyleSyncerAccount:user="
     KEYRING_KEY                = "&-^7aTHR!.?20g83h34n03vM:d@ATs]s#2nAy?tn\')8!9)BPGrq8479N%I2J9(0"
@@ -126,37 +163,68 @@ class FileSyncer:
                                   '0.us.pool.ntp.org',
                                   '3.us.pool.ntp.org']
 
-    def sync(self, syncTaskList):
+    # dryRun - only write planned operations of tasks to log, nothing is synced.
+    # Every sync path of every task is synced by its own syncer. Up to MaxTasks of them are run at the same time, their
+    # worker threads share budget of MaxThreads (settings of [FileSyncer] section). Tasks with the same server share its
+    # connections and limit of requests in flight.
+    def sync(self, syncTaskList, dryRun = False):
         start = time.time()
 
         self._beginLogSession()
         syncElements = self._getSyncElements()
-        for key, element in sorted(syncElements.iteritems()):
-            if not syncTaskList or key in syncTaskList:
-                print "Start sync for task '" + key + "'"
-                taskStart = time.time()
-
-                if len(element.remote.syncPaths) == len(element.local.syncPaths):
-                    if self._verifySslFingerprint(element.remote):
-                        filesyncer = syncer.Syncer(element.remote.getFileSystem(), element.local.getFileSystem(),
-                                                   FileSyncer.LOG_FILE_NAME, FileSyncer.SETTINGS_DATA_DIR,
-                                                   max(element.remote.maxFileSizeKb, element.local.maxFileSizeKb),
-                                                   max(element.remote.threadsCount, element.local.threadsCount))
-
-                        for index, remotePath in enumerate(element.remote.syncPaths):
-                            filesyncer.addSyncElement(remotePath.decode('utf8'), element.local.syncPaths[index].decode('utf8'))
-
-                        filesyncer.sync(element.remote.syncOnlyExistingPath, element.local.syncOnlyExistingPath)
-                else:
-                    print "Error: not equal amount of paths to sync."
-
-                taskEnd = time.time()
-                print "End sync for task '" + key + "'. Sync time: ", round(taskEnd - taskStart, 2), " seconds"
+        maxTasks, maxThreads = self._getRunSettings()
+        workerBudget = threading.BoundedSemaphore(maxThreads) if maxThreads > 0 else None
+        taskQueue = WorkQueue(maxTasks) if maxTasks > 1 else None
+        metadataCaches = {}
+        blobCaches = {}
+        serverStates = {}
+        try:
+            for key, element in sorted(syncElements.iteritems()):
+                if syncTaskList and key not in syncTaskList:
+                    continue
+                if len(element.remote.syncPaths) != len(element.local.syncPaths):
+                    print "Error: not equal amount of paths to sync in task '" + key + "'."
+                    continue
+
+                for index, remotePath in enumerate(element.remote.syncPaths):
+                    # file systems are created in this thread, caches and server states are shared with running syncers
+                    # server certificate (or its SHA256 fingerprint, if set) is checked on each new connection
+                    filesyncer = syncer.Syncer(element.remote.getFileSystem(metadataCaches, blobCaches, serverStates),
+                                               element.local.getFileSystem(metadataCaches, blobCaches, serverStates),
+                                               FileSyncer.LOG_FILE_NAME, FileSyncer.SETTINGS_DATA_DIR,
+                                               max(element.remote.maxFileSizeKb, element.local.maxFileSizeKb),
+                                               max(element.remote.threadsCount, element.local.threadsCount),
+                                               element.remote.detectMoves(), dryRun,
+                                               max(element.remote.getTransferThreadsCount(), element.local.getTransferThreadsCount()),
+                                               element.remote.smallFilesFirst(), workerBudget)
+                    filesyncer.addSyncElement(remotePath.decode('utf8'), element.local.syncPaths[index].decode('utf8'))
+
+                    if taskQueue != None:
+                        taskQueue.add(self._syncTaskPath, key, remotePath, filesyncer, element)
+                    else:
+                        self._syncTaskPath(key, remotePath, filesyncer, element)
+
+            if taskQueue != None:
+                taskQueue.join()
+        finally:
+            if taskQueue != None:
+                taskQueue.close()
 
         end = time.time()
         print "Total sync time: ", round(end - start, 2), " seconds"
 
 
+    def _syncTaskPath(self, key, remotePath, filesyncer, element):
+        print "Start sync for task '" + key + "': '" + remotePath + "'"
+        taskStart = time.time()
+        try:
+            filesyncer.sync(element.remote.syncOnlyExistingPath, element.local.syncOnlyExistingPath)
+        except Exception, error:
+            print "Error: sync for task '" + key + "': '" + remotePath + "': " + str(error)
+        taskEnd = time.time()
+        print "End sync for task '" + key + "': '" + remotePath + "'. Sync time: ", round(taskEnd - taskStart, 2), " seconds"
+
+
     def getLastSyncLogLines(self):
         lastLog = []
         with codecs.open(FileSyncer.LOG_FILE_NAME, "r", "utf8") as f:
@@ -177,6 +245,8 @@ class FileSyncer:
         self._configCryptPasswords(config)
 
         for section in config.sections():
+            if section == FileSyncer.INI_RUN_SECTION:
+                continue
             config = self._configDecryptPassword(config, section)
 
             syncElementName = self._getSyncElementName(section)
@@ -196,13 +266,52 @@ class FileSyncer:
                                     sectionItems.get(FileSyncer.INI_SERVER_SHA256, ""),
                                     sectionItems.get(FileSyncer.INI_ONLY_EXISTING_PATH, "1") == "1",
                                     sectionItems.get(FileSyncer.INI_USE_LOCKS, "0") == "1",
-                                    int(sectionItems.get(FileSyncer.INI_MAX_THREADS, "1")))
+                                    int(sectionItems.get(FileSyncer.INI_MAX_THREADS, "1")),
+                                    self._getWebDavOptions(sectionItems))
 
             syncElements[syncElementName] = syncPair
 
         return syncElements
 
 
+    # Return (max number of sync paths synced at the same time, max number of busy worker threads of all of them - 0, if
+    # not limited) from [FileSyncer] section.
+    def _getRunSettings(self):
+        config = ConfigParser.ConfigParser()
+        config.optionxform = str
+        config.read(FileSyncer.CONFIG_FILE_NAME)
+        if not config.has_section(FileSyncer.INI_RUN_SECTION):
+            return 1, 0
+        sectionItems = dict(config.items(FileSyncer.INI_RUN_SECTION))
+        return max(1, int(sectionItems.get(FileSyncer.INI_MAX_TASKS, "1"))), int(sectionItems.get(FileSyncer.INI_MAX_THREADS, "0"))
+
+
+    def _getWebDavOptions(self, sectionItems):
+        options = davfs.WebDavOptions(int(sectionItems.get(FileSyncer.INI_MAX_CONNECTIONS, "0")),
+                                      int(sectionItems.get(FileSyncer.INI_CHUNK_SIZE_KB, str(davfs.WebDavOptions.DEFAULT_CHUNK_SIZE / 1024))) * 1024,
+                                      int(sectionItems.get(FileSyncer.INI_MAX_RETRIES, "4")),
+                                      float(sectionItems.get(FileSyncer.INI_RETRY_BACKOFF_SEC, "0.5")),
+                                      int(sectionItems.get(FileSyncer.INI_RETRY_BUDGET, "200")),
+                                      sectionItems.get(FileSyncer.INI_REMOTE_SNAPSHOT, "0") == "1",
+                                      sectionItems.get(FileSyncer.INI_SYNC_COLLECTION, "0") == "1",
+                                      int(sectionItems.get(FileSyncer.INI_BLOB_CACHE_SIZE_MB, "0")) * 1024 * 1024,
+                                      int(sectionItems.get(FileSyncer.INI_SEGMENTED_DOWNLOAD_MB, "0")) * 1024 * 1024,
+                                      int(sectionItems.get(FileSyncer.INI_DOWNLOAD_SEGMENTS, "4")),
+                                      int(sectionItems.get(FileSyncer.INI_RESUME_TRANSFER_MB, "0")) * 1024 * 1024,
+                                      int(sectionItems.get(FileSyncer.INI_UPLOAD_SEGMENT_MB, "4")) * 1024 * 1024,
+                                      sectionItems.get(FileSyncer.INI_COMPRESSION, "0") == "1",
+                                      sectionItems.get(FileSyncer.INI_DETECT_MOVES, "0") == "1",
+                                      sectionItems.get(FileSyncer.INI_LOCK_MODE, davfs.WebDavOptions.LOCK_MODE_FILE),
+                                      int(sectionItems.get(FileSyncer.INI_PIPELINE_DEPTH, "0")),
+                                      int(sectionItems.get(FileSyncer.INI_MAX_REQUESTS, "0")),
+                                      int(sectionItems.get(FileSyncer.INI_CIRCUIT_BREAKER, "5")),
+                                      float(sectionItems.get(FileSyncer.INI_CIRCUIT_BREAKER_SEC, "30")),
+                                      int(sectionItems.get(FileSyncer.INI_TRANSFER_THREADS, "0")),
+                                      sectionItems.get(FileSyncer.INI_SMALL_FILES_FIRST, "1") == "1")
+        options.resumeDirPath = os.path.join(FileSyncer.SETTINGS_DATA_DIR, FileSyncer.RESUME_DIR)
+        return options
+
+
     def _getSyncElementName(self, section):
         return section.split(FileSyncer.INI_SECTION_NAME_DELIMITER)[0]
 
@@ -246,39 +355,6 @@ class FileSyncer:
                 logFile.write("Warning: system time out of sync. May occur synchronization errors and data loss.\n")
 
 
-    def _verifySslFingerprint(self, syncElement):
-        response = True
-
-        if syncElement.isServerSha256FingerprintSet():
-            _disableCertificateCheck(syncElement.server)
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(1)
-            wrappedSocket = ssl.wrap_socket(sock)
-            realFingerprint = ""
-
-            try:
-                wrappedSocket.connect((syncElement.server, syncElement.port))
-            except Exception, error:
-                #print error
-                response = False
-            else:
-                der_cert_bin = wrappedSocket.getpeercert(True)
-                thumb_sha256 = hashlib.sha256(der_cert_bin).hexdigest()
-
-                if thumb_sha256 == None or thumb_sha256 != syncElement.sha256:
-                    response = False
-                    realFingerprint = thumb_sha256
-
-            wrappedSocket.close()
-
-            if not response:
-                with open(FileSyncer.LOG_FILE_NAME, "a") as logFile:
-                    logFile.write("Error: Can't verify server fingerprint: " + syncElement.server +  "[" + realFingerprint + "]\n")
-        else:
-            _enableCertificateCheck(syncElement.server)
-
-        return response
-
     def _configCryptPasswords(self, config):
         hasNewPasswords = False
 
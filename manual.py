@@ -9,9 +9,10 @@ import sys
 system("title FileSyncer (p. " + platform.python_version() + ")")
 print "Start sync"
 
+dryRun = "--dry-run" in sys.argv[1:]
 fsyncer = filesyncer.FileSyncer()
 start = time.time()
-fsyncer.sync(sys.argv[1:])
+fsyncer.sync([arg for arg in sys.argv[1:] if arg != "--dry-run"], dryRun)
 end = time.time()
 
 print "End sync. Time elapsed: " + str(end - start) + " seconds"
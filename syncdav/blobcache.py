@@ -0,0 +1,161 @@
+from __future__ import with_statement
+import os, pickle, hashlib, threading, time
+
+
+class BlobCacheEntry:
+    def __init__(self, key, etag, lastModified, size):
+        self.key = key
+        self.etag = etag                 # ETag header of cached content or None
+        self.lastModified = lastModified # Last-Modified header of cached content or None
+        self.size = size
+        self.lastUsedTime = time.time()
+#end class BlobCacheEntry
+
+
+class BlobCacheWriter:
+    def __init__(self, cache, key, etag, lastModified, filePath):
+        self._cache = cache
+        self._key = key
+        self._etag = etag
+        self._lastModified = lastModified
+        self._filePath = filePath
+        self._file = open(filePath, "wb")
+        self._size = 0
+
+
+    def write(self, data):
+        self._file.write(data)
+        self._size += len(data)
+
+
+    def commit(self):
+        self._file.close()
+        self._cache._commit(self._key, BlobCacheEntry(self._key, self._etag, self._lastModified, self._size), self._filePath)
+
+
+    def discard(self):
+        self._file.close()
+        if os.path.exists(self._filePath):
+            os.remove(self._filePath)
+#end class BlobCacheWriter
+
+
+# Local LRU cache of downloaded file contents. Stores one content (with its validators) per key,
+# total size of stored contents is limited by 'maxSizeBytes'.
+class BlobCache:
+    INDEX_FILE_NAME = "index"
+    BLOB_FILE_SUFFIX = ".blob"
+    TEMP_FILE_SUFFIX = ".tmp"
+
+    def __init__(self, dirPath, maxSizeBytes):
+        self.dirPath = dirPath
+        self.maxSizeBytes = maxSizeBytes
+        self.hitsCount = 0
+        self.missesCount = 0
+        self._lock = threading.Lock()
+        self._entries = {} # blob name -> BlobCacheEntry
+        if not os.path.isdir(dirPath):
+            os.makedirs(dirPath)
+        self._loadIndex()
+
+
+    # Return BlobCacheEntry with validators of cached content or None.
+    def getEntry(self, key):
+        with self._lock:
+            return self._entries.get(self._getBlobName(key))
+
+
+    # Return opened file with cached content or None if content with given validators isn't cached.
+    def open(self, key, entry):
+        blobName = self._getBlobName(key)
+        with self._lock:
+            storedEntry = self._entries.get(blobName)
+            if storedEntry is None or storedEntry.etag != entry.etag or storedEntry.lastModified != entry.lastModified:
+                return None
+            try:
+                file = open(self._getBlobPath(blobName), "rb")
+            except IOError:
+                del self._entries[blobName]
+                return None
+            storedEntry.lastUsedTime = time.time() # stored in index with next committed content
+            self.hitsCount += 1
+            return file
+
+
+    # Return BlobCacheWriter for new content of 'key' or None if content is too big for cache.
+    def createWriter(self, key, etag, lastModified, size = None):
+        with self._lock:
+            self.missesCount += 1
+        if size != None and size > self.maxSizeBytes:
+            return None
+        blobName = self._getBlobName(key)
+        return BlobCacheWriter(self, key, etag, lastModified, self._getBlobPath(blobName) + "." + str(threading.current_thread().ident) + BlobCache.TEMP_FILE_SUFFIX)
+
+
+    def remove(self, key):
+        blobName = self._getBlobName(key)
+        with self._lock:
+            if blobName in self._entries:
+                self._removeBlob(blobName)
+                self._storeIndex()
+
+
+    def _commit(self, key, entry, tempFilePath):
+        blobName = self._getBlobName(key)
+        with self._lock:
+            if blobName in self._entries:
+                self._removeBlob(blobName)
+            if entry.size > self.maxSizeBytes:
+                os.remove(tempFilePath)
+                return
+            os.rename(tempFilePath, self._getBlobPath(blobName))
+            self._entries[blobName] = entry
+            self._evict()
+            self._storeIndex()
+
+
+    # Remove least recently used contents until cache fits in 'maxSizeBytes'.
+    def _evict(self):
+        totalSize = sum(entry.size for entry in self._entries.itervalues())
+        if totalSize <= self.maxSizeBytes:
+            return
+        for blobName, entry in sorted(self._entries.items(), key = lambda item: item[1].lastUsedTime):
+            self._removeBlob(blobName)
+            totalSize -= entry.size
+            if totalSize <= self.maxSizeBytes:
+                break
+
+
+    def _removeBlob(self, blobName):
+        del self._entries[blobName]
+        try:
+            os.remove(self._getBlobPath(blobName))
+        except OSError:
+            pass # already removed or opened (on Windows)
+
+
+    def _getBlobName(self, key):
+        return hashlib.sha224(key).hexdigest()
+
+
+    def _getBlobPath(self, blobName):
+        return os.path.join(self.dirPath, blobName + BlobCache.BLOB_FILE_SUFFIX)
+
+
+    def _loadIndex(self):
+        indexPath = os.path.join(self.dirPath, BlobCache.INDEX_FILE_NAME)
+        if os.path.isfile(indexPath):
+            try:
+                with open(indexPath, "rb") as file:
+                    self._entries = pickle.load(file)
+            except Exception:
+                self._entries = {}
+        for blobName in self._entries.keys():
+            if not os.path.isfile(self._getBlobPath(blobName)):
+                del self._entries[blobName]
+
+
+    def _storeIndex(self):
+        with open(os.path.join(self.dirPath, BlobCache.INDEX_FILE_NAME), "wb") as file:
+            pickle.dump(self._entries, file)
+#end class BlobCache
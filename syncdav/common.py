@@ -1,4 +1,17 @@
 import threading
+import pickle
+import heapq
+import os
+import errno
+
+
+# Create folder and its parents, if folder doesn't exist. Folder may be created at the same time by other sync.
+def makeDirs(dirPath):
+    try:
+        os.makedirs(dirPath)
+    except OSError, error:
+        if error.errno != errno.EEXIST or not os.path.isdir(dirPath):
+            raise
 
 
 class DummyLock:
@@ -34,6 +47,121 @@ class AtomicInteger(object):
             return self.value
 
 
+# Queue of tasks run by fixed number of worker threads. Tasks with lower priority value are run first, tasks with equal
+# priority - in order they were added. Tasks may add more tasks, join() returns as soon as all added tasks (and tasks
+# added by them) are done. Tasks must handle their errors.
+# budget - semaphore shared by queues of concurrent syncs, limits number of tasks run by all of them at once.
+class WorkQueue(object):
+    def __init__(self, workersCount, budget = None):
+        self._budget = budget if budget != None else DummyLock()
+        self._lock = threading.Lock()
+        self._taskAdded = threading.Condition(self._lock)
+        self._allDone = threading.Condition(self._lock)
+        self._tasks = [] # heap of (priority, sequence number, function, args)
+        self._addedCount = 0
+        self._pendingCount = 0 # added and not finished tasks
+        self._closed = False
+        for index in range(workersCount):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+
+    def add(self, function, *args):
+        self.addWithPriority(0, function, *args)
+
+    def addWithPriority(self, priority, function, *args):
+        with self._lock:
+            heapq.heappush(self._tasks, (priority, self._addedCount, function, args))
+            self._addedCount += 1
+            self._pendingCount += 1
+            self._taskAdded.notify()
+
+    def join(self):
+        with self._lock:
+            while self._pendingCount > 0:
+                self._allDone.wait()
+
+    # Stop workers when remaining tasks are done.
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._taskAdded.notify_all()
+
+    def _work(self):
+        while True:
+            with self._lock:
+                while not self._tasks and not self._closed:
+                    self._taskAdded.wait()
+                if not self._tasks:
+                    return
+                priority, sequenceNumber, function, args = heapq.heappop(self._tasks)
+            try:
+                with self._budget:
+                    function(*args)
+            except Exception:
+                pass # worker must survive, tasks log their errors themselves
+            finally:
+                with self._lock:
+                    self._pendingCount -= 1
+                    if self._pendingCount == 0:
+                        self._allDone.notify_all()
+
+
+
+class CountingReader(object):
+    def __init__(self, stream):
+        self._stream = stream
+        self.bytesCount = 0
+        try:
+            self._startPosition = stream.tell()
+        except Exception:
+            self._startPosition = 0
+
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        self.bytesCount += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        self._stream.seek(offset, whence)
+        self.bytesCount = self._stream.tell() - self._startPosition
+
+    def close(self):
+        self._stream.close()
+
+    def __getattr__(self, name): # tell, fileno, writeTo, etc. if stream supports it
+        attribute = getattr(self._stream, name)
+        if name == "writeTo":
+            return self._writeTo
+        return attribute
+
+    def _writeTo(self, file):
+        count = self._stream.writeTo(file)
+        self.bytesCount += count
+        return count
+
+
+
+# State of interrupted transfer, stored in small sidecar file.
+class ResumeInfo:
+    def __init__(self, href, validator, offset):
+        self.href = href           # transferred resource
+        self.validator = validator # ETag (Last-Modified) of downloaded content or identity of uploaded file
+        self.offset = offset       # bytes transferred
+
+    @staticmethod
+    def load(filePath):
+        try:
+            with open(filePath, "rb") as file:
+                return pickle.load(file)
+        except Exception:
+            return None
+
+    def store(self, filePath):
+        with open(filePath, "wb") as file:
+            pickle.dump(self, file)
+
+
 
 class PathOperations:
     @staticmethod
@@ -1,40 +1,46 @@
 from __future__ import with_statement
-import socket
 import os
+import threading
+import hashlib
+import socket
 import urllib
 from tinydav import *
+from tinydav import util
 from tinydav.exception import *
 from datetime import datetime
-from httplib import MULTI_STATUS, OK, CONFLICT, NO_CONTENT, UNAUTHORIZED, CREATED, NOT_FOUND, METHOD_NOT_ALLOWED
-from common import PathOperations, DummyLock
+from httplib import HTTPException, MULTI_STATUS, OK, CONFLICT, NO_CONTENT, UNAUTHORIZED, CREATED, NOT_FOUND, METHOD_NOT_ALLOWED, NOT_MODIFIED, PARTIAL_CONTENT, LOCKED
+from common import PathOperations, DummyLock, ResumeInfo, makeDirs
 
 
 class WebDavElement:
-    def __init__(self, rawcontent, response):
-        self.isDir = response.get('resourcetype').find('{DAV:}collection') != None
-        self.fullPath = urllib.url2pathname(response.href).decode('utf8')
+    # entry - tinydav.util.MultiStatusEntry
+    def __init__(self, entry):
+        self.status = entry.status
+        self.isDir = entry.is_collection
+        self.fullPath = urllib.url2pathname(entry.href).decode('utf8')
 
         try:
             # TODO: available variants for last modified:
             # Sun, 06 Nov 1994 08:49:37 GMT  ; RFC 822, updated by RFC 1123
             # Sunday, 06-Nov-94 08:49:37 GMT ; RFC 850, obsoleted by RFC 1036
             # Sun Nov  6 08:49:37 1994       ; ANSI C's asctime() format
-            self.lastModifiedTimeGMT = datetime.strptime(self._getElementText(response, 'getlastmodified'), '%a, %d %b %Y %H:%M:%S GMT') # Sat, 06 Jun 2015 16:52:05 GMT
+            self.lastModifiedTimeGMT = datetime.strptime(self._getElementText(entry, 'getlastmodified'), '%a, %d %b %Y %H:%M:%S GMT') # Sat, 06 Jun 2015 16:52:05 GMT
         except Exception:
             self.lastModifiedTimeGMT = None
             pass
-        self.etag = self._getElementText(response, 'getetag')
-        self.displayName = self._getElementText(response, 'displayname')
-        self.contentType = self._getElementText(response, 'getcontenttype')
+        self.etag = self._getElementText(entry, 'getetag')
+        self.displayName = self._getElementText(entry, 'displayname')
+        self.contentType = self._getElementText(entry, 'getcontenttype')
         try:
-            self.size = int(self._getElementText(response, 'getcontentlength', '0'))
+            self.size = int(self._getElementText(entry, 'getcontentlength', '0'))
         except Exception:
             self.size = 0
             pass
 
 
-    def _getElementText(self, response, tag, default = ''):
-        return response.get(tag).text if tag in response else default
+    def _getElementText(self, entry, tag, default = ''):
+        text = entry.properties.get(tag)
+        return text if text != None else default
 
 
     def __str__(self):
@@ -49,15 +55,455 @@ class WebDavElement:
         return strRep
 
 
+# Collection created by this client with MKCOL, its properties aren't requested from server.
+class WebDavCreatedDir(WebDavElement):
+    def __init__(self, fullPath):
+        self.status = None
+        self.isDir = True
+        self.fullPath = fullPath
+        self.lastModifiedTimeGMT = datetime.utcnow()
+        self.etag = ''
+        self.displayName = PathOperations.getPathLastElement(fullPath)
+        self.contentType = ''
+        self.size = 0
+
+
+class WebDavOptions:
+    DEFAULT_CHUNK_SIZE = 64 * 1024
+    LOCK_MODE_FILE       = "file"       # LOCK/UNLOCK around every operation
+    LOCK_MODE_COLLECTION = "collection" # one LOCK of sync root for entire sync
+
+    def __init__(self, maxConnections=0, chunkSize=DEFAULT_CHUNK_SIZE, maxRetries=4, retryBackoffSec=0.5, retryBudget=200, useSnapshot=False, useSyncCollection=False, blobCacheSize=0,
+                 segmentedDownloadSize=0, downloadSegments=4, resumeMinSize=0, uploadSegmentSize=4 * 1024 * 1024, useCompression=False,
+                 detectMoves=False, lockMode=LOCK_MODE_FILE, pipelineDepth=0, maxRequests=0,
+                 circuitBreakerFailures=5, circuitBreakerResetSec=30, transferThreads=0, smallFilesFirst=True):
+        self.maxConnections = maxConnections   # 0 - no limit, connections count is bounded by sync threads count
+        self.chunkSize = chunkSize             # max size of data block kept in memory while transferring file
+        self.maxRetries = maxRetries           # retries of one failed request (connection errors, 429, 5xx)
+        self.retryBackoffSec = retryBackoffSec # delay before first retry, doubled on each next retry
+        self.retryBudget = retryBudget         # max retries of all requests in sync run, 0 - no limit
+        self.useSnapshot = useSnapshot         # list entire remote tree with one 'Depth: infinity' PROPFIND
+        self.useSyncCollection = useSyncCollection # request only remote changes since last sync (RFC 6578 sync-collection REPORT)
+        self.blobCacheSize = blobCacheSize     # max size in bytes of local cache of downloaded files, 0 - no cache
+        self.segmentedDownloadSize = segmentedDownloadSize # min size in bytes of file downloaded in parallel byte ranges, 0 - disabled
+        self.downloadSegments = downloadSegments # number of byte ranges (connections) of segmented download
+        self.resumeMinSize = resumeMinSize     # min size in bytes of interrupted transfer to be resumed, 0 - disabled
+        self.uploadSegmentSize = uploadSegmentSize # size in bytes of segment of resumable upload
+        self.useCompression = useCompression   # request gzip/deflate compressed listings and downloads
+        self.detectMoves = detectMoves         # do local renames and moves with server-side MOVE (COPY) instead of upload
+        self.lockMode = lockMode               # LOCK_MODE_FILE or LOCK_MODE_COLLECTION, used if locks are enabled
+        self.pipelineDepth = pipelineDepth     # max PROPFIND requests sent on one connection without waiting for responses, 0 - disabled
+        self.maxRequests = maxRequests         # upper bound of adaptive (AIMD) limit of requests in flight to server, 0 - no limit
+        self.circuitBreakerFailures = circuitBreakerFailures # connection failures in a row after which server is treated as unreachable, 0 - disabled
+        self.circuitBreakerResetSec = circuitBreakerResetSec # delay before first probe request to unreachable server
+        self.transferThreads = transferThreads # threads of file transfers, 0 - same as sync threads count
+        self.smallFilesFirst = smallFilesFirst # transfer planned files in order of size, smallest first
+        self.resumeDirPath = None              # dir of upload resume files
+
+
+    # Options WebDavServerState is built from: tasks may share state of server only if these options are equal.
+    def getServerStateOptions(self):
+        return (self.maxConnections, self.maxRetries, self.retryBackoffSec, self.retryBudget, self.maxRequests,
+                self.circuitBreakerFailures, self.circuitBreakerResetSec)
+
+
+# Metadata of remote elements received with PROPFIND requests. Thread-safe, shared by all WebDavFS objects of one
+# server in sync run. Paths are compared by their elements, like PathOperations.comparePath does.
+class WebDavMetadataCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._elements = {}   # path key -> WebDavElement or None if element doesn't exist
+        self._listedDirs = {} # dir path key -> list of child path keys
+        self._knownDirs = set() # keys of collections known to exist in this run (listed or created)
+        self.serverFeatures = None # set of DAV header values
+        self.hitsCount = 0
+        self.missesCount = 0
+        self.knownDirHitsCount = 0
+
+
+    # Return tuple (isCached, WebDavElement or None if element doesn't exist).
+    def get(self, path):
+        key = self._getKey(path)
+        with self._lock:
+            if key in self._elements:
+                self.hitsCount += 1
+                return (True, self._elements[key])
+            if key[:-1] in self._listedDirs: # parent listed, but element not found in it
+                self.hitsCount += 1
+                return (True, None)
+            self.missesCount += 1
+            return (False, None)
+
+
+    # Return list of WebDavElement in dir or None if dir wasn't listed.
+    def getListing(self, dirPath):
+        key = self._getKey(dirPath)
+        with self._lock:
+            if key in self._listedDirs:
+                self.hitsCount += 1
+                return [self._elements[childKey] for childKey in self._listedDirs[key]]
+            self.missesCount += 1
+            return None
+
+
+    def put(self, path, element):
+        key = self._getKey(path)
+        with self._lock:
+            self._elements[key] = element
+            if element != None and element.isDir:
+                self._knownDirs.add(key)
+
+
+    def putListing(self, dirPath, elements):
+        key = self._getKey(dirPath)
+        with self._lock:
+            childKeys = []
+            for element in elements:
+                childKey = self._getKey(element.fullPath)
+                self._elements[childKey] = element
+                childKeys.append(childKey)
+                if element.isDir:
+                    self._knownDirs.add(childKey)
+            self._listedDirs[key] = childKeys
+            self._knownDirs.add(key)
+
+
+    # Return True if collection was listed or created in this run and wasn't deleted since.
+    def isKnownDir(self, path):
+        with self._lock:
+            if self._getKey(path) in self._knownDirs:
+                self.knownDirHitsCount += 1
+                return True
+            return False
+
+
+    # Forget element (and all elements below it if 'recursive') and listing of its parent dir.
+    def invalidate(self, path, recursive = False):
+        key = self._getKey(path)
+        with self._lock:
+            if recursive:
+                for elementKey in self._elements.keys() + self._listedDirs.keys() + list(self._knownDirs):
+                    if elementKey[:len(key)] == key:
+                        self._elements.pop(elementKey, None)
+                        self._listedDirs.pop(elementKey, None)
+                        self._knownDirs.discard(elementKey)
+            else:
+                self._elements.pop(key, None)
+                self._listedDirs.pop(key, None)
+                self._knownDirs.discard(key)
+            self._listedDirs.pop(key[:-1], None)
+
+
+    def clear(self):
+        with self._lock:
+            self._elements = {}
+            self._listedDirs = {}
+            self._knownDirs = set()
+
+
+    def _getKey(self, path):
+        return tuple(PathOperations.splitPath(path))
+
+
+# Network state of one server shared by all tasks of sync run: kept-alive connections (at most options.maxConnections,
+# if set), retry policy with one budget of retries (options.retryBudget) for entire run, response time and bandwidth
+# estimates, adaptive limit of requests in flight (if options.maxRequests is set), circuit breaker (if
+# options.circuitBreakerFailures is set) and SSL context with last TLS session. sha256Fingerprint - certificate of HTTPS
+# server is checked against it on every new connection instead of certificate chain verification.
+class WebDavServerState:
+    INITIAL_REQUESTS = 4
+
+    def __init__(self, options=None, sha256Fingerprint=None):
+        options = options if options != None else WebDavOptions()
+        self.pool = ConnectionPool(options.maxConnections)
+        self.retryPolicy = RetryPolicy(options.maxRetries + 1, options.retryBackoffSec, budget=options.retryBudget or None)
+        self.timeoutPolicy = TimeoutPolicy()
+        self.tlsPolicy = TLSPolicy(fingerprint=sha256Fingerprint)
+        self.limiter = None
+        if options.maxRequests > 0:
+            self.limiter = ConcurrencyLimiter(min(self.INITIAL_REQUESTS, options.maxRequests), maxlimit=options.maxRequests)
+        self.breaker = None
+        if options.circuitBreakerFailures > 0:
+            self.breaker = CircuitBreaker(options.circuitBreakerFailures, options.circuitBreakerResetSec)
+
+
+# Depth: infinity LOCK of sync root, held while root is synced and refreshed in background. Writes below the root send
+# lock token in If header instead of LOCK/UNLOCK around every operation. Shared by all WebDavFS objects of one sync.
+class WebDavCollectionLock:
+    TIMEOUT_SEC = 600
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rootKey = None
+        self._ifHeader = None
+        self._davClient = None
+        self._davLock = None
+        self._stopEvent = None
+        self.locksCount = 0
+        self.refreshesCount = 0
+        self.fallbacksCount = 0
+
+
+    # Return True if root is locked, False if server can't lock it (operations are locked one by one then).
+    # Raise HTTPUserError if root is locked by other client.
+    def acquire(self, dav, rootPath):
+        self.release()
+        davClient = dav._createDavClient()
+        try:
+            davLock = davClient.lock(dav._encodePath(rootPath), timeout=self.TIMEOUT_SEC, depth="infinity")
+        except HTTPUserError, error:
+            if error.response == LOCKED:
+                raise error
+            davLock = None
+        except HTTPServerError:
+            davLock = None
+        if davLock == None or (davLock != OK and davLock != CREATED) or not davLock.locktokens:
+            self.fallbacksCount += 1
+            return False
+
+        stopEvent = threading.Event()
+        with self._lock:
+            self._rootKey = tuple(PathOperations.splitPath(rootPath))
+            # RFC 4918, 10.4: tagged list - lock token of locked root applies to all resources below it
+            self._ifHeader = "<%s> (<%s>)" % (davLock._tag, davLock.locktokens[0])
+            self._davClient = davClient
+            self._davLock = davLock
+            self._stopEvent = stopEvent
+            self.locksCount += 1
+        refreshThread = threading.Thread(target=self._refresh, args=(davClient, davLock, stopEvent))
+        refreshThread.daemon = True
+        refreshThread.start()
+        return True
+
+
+    def release(self):
+        with self._lock:
+            davClient, davLock, stopEvent = self._davClient, self._davLock, self._stopEvent
+            self._rootKey = None
+            self._ifHeader = None
+            self._davClient = None
+            self._davLock = None
+            self._stopEvent = None
+        if davLock == None:
+            return
+        stopEvent.set()
+        try:
+            davClient.unlock(davLock)
+        except Exception:
+            pass # lock expires by timeout
+
+
+    def isLocked(self, path):
+        return self.getHeaders(path) != None
+
+
+    # Return headers with lock token for write request to 'path' or None if 'path' isn't locked.
+    def getHeaders(self, path):
+        key = tuple(PathOperations.splitPath(path))
+        with self._lock:
+            if self._rootKey != None and key[:len(self._rootKey)] == self._rootKey:
+                return {"If": self._ifHeader}
+        return None
+
+
+    def _refresh(self, davClient, davLock, stopEvent):
+        while not stopEvent.wait(self.TIMEOUT_SEC / 2):
+            try:
+                davClient.refresh_lock(davLock, self.TIMEOUT_SEC)
+                self.refreshesCount += 1
+            except Exception:
+                pass # writes fail with 412 (423) if lock is lost
+
+
+class WebDavDownloadStream:
+    # cacheWriter - blobcache.BlobCacheWriter, receives read content. Content is committed to cache if entire file was read.
+    # offset - position of first read byte in file (resumed download).
+    def __init__(self, dav, encodedPath, response, cacheWriter=None, offset=0):
+        self._dav = dav
+        self._encodedPath = encodedPath
+        self._response = response
+        self._cacheWriter = cacheWriter
+        self._closed = False
+        self.href = encodedPath
+        self.validator = response.headers.get("etag") or response.headers.get("last-modified")
+        self.offset = offset
+
+
+    def read(self, size=-1):
+        if size == None or size < 0:
+            data = self._response.read()
+        else:
+            data = self._response.read(size)
+        self._writeToCache(data)
+        return data
+
+
+    def __iter__(self):
+        for data in self._response.iter_content(self._dav.options.chunkSize):
+            self._writeToCache(data)
+            yield data
+
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            isComplete = self._response.response.isclosed()
+            self._response.close()
+            if self._cacheWriter != None:
+                try:
+                    if isComplete:
+                        self._cacheWriter.commit()
+                    else:
+                        self._cacheWriter.discard()
+                except Exception:
+                    pass
+            self._dav._safeUnlock(self._encodedPath)
+
+
+    def _writeToCache(self, data):
+        if self._cacheWriter != None and data:
+            try:
+                self._cacheWriter.write(data)
+            except Exception: # cache is optional, download continues without it
+                self._cacheWriter.discard()
+                self._cacheWriter = None
+
+
+# Result of sync-collection REPORT. Iterate to get changed WebDavElement objects (removed elements have
+# NOT_FOUND status), 'syncToken' is set when iteration is finished.
+class WebDavChangeList:
+    def __init__(self, response):
+        self._response = response
+        self._extra = {}
+        self.syncToken = None
+
+
+    def __iter__(self):
+        for entry in self._response.iter_entries(self._extra):
+            yield WebDavElement(entry)
+        self.syncToken = self._extra.get("{DAV:}sync-token")
+
+
+    def close(self):
+        self._response.close()
+
+
+# Download of file split in byte ranges. Ranges are read one by one with 'read' or fetched in parallel over
+# separate connections with 'writeTo'. Every range must have the same validator (ETag) as the first one.
+class WebDavSegmentedDownloadStream:
+    def __init__(self, dav, encodedPath, response, size, validator, segmentSize):
+        self._dav = dav
+        self._encodedPath = encodedPath
+        self._response = response # response of current range, first range is already requested
+        self._size = size
+        self._validator = validator
+        self._segmentSize = segmentSize
+        self._position = 0
+        self._closed = False
+
+
+    def read(self, size=-1):
+        chunks = []
+        remaining = size if size != None and size >= 0 else self._size
+        while remaining > 0 and self._position < self._size:
+            if self._response == None:
+                self._response = self._dav._getRange(self._dav.davClient, self._encodedPath, self._position, self._getRangeEnd(self._position), self._validator)
+            data = self._response.read(min(remaining, self._dav.options.chunkSize))
+            if not data:
+                self._response.close()
+                self._response = None
+                continue
+            chunks.append(data)
+            remaining -= len(data)
+            self._position += len(data)
+        return "".join(chunks)
+
+
+    # Preallocate file and write all ranges to it in parallel. Return written bytes count. Must be called before 'read'.
+    def writeTo(self, file):
+        file.truncate(self._size)
+        ranges = [(start, self._getRangeEnd(start)) for start in xrange(self._position + self._segmentSize, self._size, self._segmentSize)]
+        rangesLock = threading.Lock()
+        fileLock = threading.Lock()
+        errors = []
+
+        def writeRanges(davClient, response, start, end):
+            try:
+                while True:
+                    if response == None:
+                        with rangesLock:
+                            if not ranges or errors:
+                                return
+                            start, end = ranges.pop(0)
+                        response = self._dav._getRange(davClient, self._encodedPath, start, end, self._validator)
+                    try:
+                        position = start
+                        for data in response.iter_content(self._dav.options.chunkSize):
+                            with fileLock:
+                                file.seek(position)
+                                file.write(data)
+                            position += len(data)
+                    finally:
+                        response.close()
+                    if position != end + 1:
+                        raise Exception("Download fail " + self._encodedPath + " : byte range " + str(start) + "-" + str(end) + " is incomplete")
+                    response = None
+            except Exception, error:
+                with rangesLock:
+                    errors.append(error)
+
+        workers = []
+        for i in xrange(min(self._dav.options.downloadSegments, len(ranges) + 1) - 1):
+            worker = threading.Thread(target = writeRanges, args = (self._dav._createDavClient(), None, 0, 0))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        response = self._response
+        self._response = None
+        writeRanges(self._dav.davClient, response, self._position, self._getRangeEnd(0))
+        for worker in workers:
+            worker.join()
+        if errors:
+            raise errors[0]
+
+        file.seek(self._size)
+        self._position = self._size
+        return self._size
+
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            if self._response != None:
+                self._response.close()
+                self._response = None
+            self._dav._safeUnlock(self._encodedPath)
+
+
+    def _getRangeEnd(self, start):
+        return min(start + self._segmentSize, self._size) - 1
+
+
 class WebDavFS:
-    def __init__(self, server, port, proto, login, password, useLocks):
-        socket.setdefaulttimeout(3)    #Set 3 seconds network timeout, because Python 2.5 doesn't have timeout options for network commands.
-        self.davClient = WebDAVClient(server, port, proto)
-        self.davClient.setbasicauth(login, password)
+    LIST_PROPERTIES = ["resourcetype", "getlastmodified", "getcontentlength", "getetag"]
+    TEMP_FILE_SUFFIX = u".filesyncer-tmp"
+    PARTIAL_UPDATE_FEATURE = "sabredav-partialupdate"
+    PARTIAL_UPDATE_CONTENT_TYPE = "application/x-sabredav-partialupdate"
+
+    def __init__(self, server, port, proto, login, password, useLocks, pool=None, options=None, retryPolicy=None, cache=None, blobCache=None, transferStats=None,
+                 collectionLock=None, serverState=None):
+        self.options = options if options != None else WebDavOptions()
+        self.cache = cache if cache != None else WebDavMetadataCache()
+        self.blobCache = blobCache
+        self.collectionLock = collectionLock
+        self.serverState = serverState if serverState != None else WebDavServerState(self.options)
+        self._clientArgs = (server, port, proto, login, password, pool, retryPolicy, transferStats)
+        self.davClient = self._createDavClient()
         self.useLocks = useLocks
 
     def exists(self, path):
-        return len(self._getWebDavElements(path)) > 0
+        return self.getElement(path) != None
 
 
     def isfile(self, path):
@@ -65,95 +511,425 @@ class WebDavFS:
 
 
     def isdir(self, path):
-        elements = self._getWebDavElements(path)
-        if len(elements) > 0:
-            return elements[0].isDir
+        element = self.getElement(path)
+        if element != None:
+            return element.isDir
         return False
 
 
+    # Return WebDavElement or None if element doesn't exist.
+    def getElement(self, path):
+        isCached, element = self.cache.get(path)
+        if not isCached:
+            elements = self._getWebDavElements(path)
+            element = elements[0] if len(elements) > 0 else None
+        return element
+
+
+    # Generator. Elements are parsed while listing is received from server.
     def list(self, path):
-        return self._getWebDavElements(path, 1)
+        elements = self.cache.getListing(path)
+        if elements != None:
+            return iter(elements)
+        return self._iterWebDavElements(path, 1)
+
+
+    # Request listings of several folders with pipelined PROPFIND requests and store them in metadata cache,
+    # so following 'list' calls don't wait for server. Does nothing if pipelining is disabled.
+    # Failed requests are ignored, these folders are listed again by 'list'.
+    def prefetchListings(self, paths):
+        if self.options.pipelineDepth < 2:
+            return
+        paths = [path for path in paths if self.cache.getListing(path) == None]
+        for start in range(0, len(paths), self.options.pipelineDepth):
+            batchPaths = paths[start:start + self.options.pipelineDepth]
+            if len(batchPaths) < 2:
+                break
+            pipeline = self.davClient.pipeline()
+            for path in batchPaths:
+                pipeline.propfind(self._encodePath(path), 1, properties = self.LIST_PROPERTIES)
+            try:
+                for path, response in zip(batchPaths, pipeline.send()):
+                    if isinstance(response, HTTPError):
+                        if response.response == NOT_FOUND:
+                            self.cache.put(path, None)
+                    elif response == MULTI_STATUS:
+                        list(self._iterResponseElements(path, 1, response))
+            except (HTTPException, socket.error, HTTPError):
+                return
+
+
+    # Generator. 'path' element and all elements below it, listed with one 'Depth: infinity' request.
+    # Raise HTTPUserError with FORBIDDEN response if server doesn't allow infinite depth.
+    def listTree(self, path):
+        return self._iterWebDavElements(path, "infinity")
+
+
+    # Return WebDavChangeList with elements changed below 'path' since 'syncToken' (all elements if token is None).
+    # Raise HTTPUserError if token is rejected or server doesn't support sync-collection REPORT.
+    def listChanges(self, path, syncToken):
+        response = self.davClient.sync_collection_report(self._encodePath(path), syncToken, properties = self.LIST_PROPERTIES, stream = True)
+        if response != MULTI_STATUS:
+            response.close()
+            raise Exception("Sync collection fail " + path.encode('utf-8') + " :" + response.statusline)
+        return WebDavChangeList(response)
 
 
     #Raise exception if download failed.
     #Return file content.
     def download(self, path):
-        fileContent = ''
+        stream = self.openDownload(path)
+        try:
+            return stream.read()
+        finally:
+            stream.close()
+
+
+    #Raise exception if download failed.
+    #Return WebDavDownloadStream, file content is read from server while reading stream. Stream must be closed.
+    #With blob cache content is requested only if it differs from cached content, otherwise cached file is returned.
+    #Big files are returned as WebDavSegmentedDownloadStream if server supports byte ranges.
+    #resumeInfo - ResumeInfo of interrupted download, returned stream starts from its offset if file wasn't changed.
+    def openDownload(self, path, allowSegments=True, resumeInfo=None):
         encodedPath = self._encodePath(path, False)
+        cacheKey = self._getBlobCacheKey(encodedPath)
+        cachedEntry = None
+        segmentSize = 0
+        if resumeInfo != None and resumeInfo.href == encodedPath and resumeInfo.validator and resumeInfo.offset > 0:
+            # RFC 7233, 3.2: If-Range - send remaining bytes if validator matches, entire file otherwise
+            headers = {"Range": "bytes=" + str(resumeInfo.offset) + "-", "If-Range": resumeInfo.validator}
+        else:
+            resumeInfo = None
+            cachedEntry = self.blobCache.getEntry(cacheKey) if self.blobCache != None else None
+            headers = self._getConditionalHeaders(cachedEntry) or {}
+            segmentSize = self._getSegmentSize(path) if allowSegments else 0
+            if segmentSize > 0:
+                headers["Range"] = "bytes=0-" + str(segmentSize - 1)
         lock = self._safeLock(encodedPath)
         if lock != None:
             with lock:
                 try:
-                    response = self.davClient.get(encodedPath)
+                    response = self.davClient.get(encodedPath, headers, stream=True)
                 except Exception, error:
                     self._safeUnlock(encodedPath)
                     raise error
 
-            self._safeUnlock(encodedPath)
+            if response == NOT_MODIFIED and cachedEntry != None:
+                self._safeUnlock(encodedPath)
+                cachedFile = self.blobCache.open(cacheKey, cachedEntry)
+                if cachedFile != None:
+                    return cachedFile
+                self.blobCache.remove(cacheKey)
+                return self.openDownload(path, allowSegments)
+
+            if response == PARTIAL_CONTENT and segmentSize > 0:
+                size = self._getRangeSize(response, 0, segmentSize - 1)
+                validator = response.headers.get("etag") or response.headers.get("last-modified")
+                if size != None and validator and response.headers.get("accept-ranges", "bytes") != "none":
+                    return WebDavSegmentedDownloadStream(self, encodedPath, response, size, validator, segmentSize)
+                response.close()
+                self._safeUnlock(encodedPath)
+                return self.openDownload(path, False)
+
+            if response == PARTIAL_CONTENT and resumeInfo != None:
+                if self._getRangeSize(response, resumeInfo.offset, None) != None:
+                    return WebDavDownloadStream(self, encodedPath, response, None, resumeInfo.offset)
+                response.close()
+                self._safeUnlock(encodedPath)
+                return self.openDownload(path, allowSegments)
+
             if response != OK:
+                response.close()
+                self._safeUnlock(encodedPath)
                 raise Exception("Download fail " + path.encode('utf-8') + " :" + response.statusline)
-            else:
-                fileContent = response.content
         else:
             raise Exception("Lock fail on download")
-        return fileContent
+        return WebDavDownloadStream(self, encodedPath, response, self._createBlobCacheWriter(cacheKey, response))
+
+
+    # Validators of cached content: RFC 7232, If-None-Match has precedence over If-Modified-Since.
+    def _getConditionalHeaders(self, cachedEntry):
+        if cachedEntry == None:
+            return None
+        if cachedEntry.etag:
+            return {"If-None-Match": cachedEntry.etag}
+        return {"If-Modified-Since": cachedEntry.lastModified}
+
+
+    def _createBlobCacheWriter(self, cacheKey, response):
+        etag = response.headers.get("etag")
+        lastModified = response.headers.get("last-modified")
+        if self.blobCache == None or (not etag and not lastModified):
+            return None
+        try:
+            size = int(response.headers.get("content-length")) if response.content_encoding == None else None
+        except Exception:
+            size = None
+        try:
+            return self.blobCache.createWriter(cacheKey, etag, lastModified, size)
+        except Exception:
+            return None
+
+
+    # Return size of byte range used in segmented download of file or 0 if file must be downloaded in one request.
+    def _getSegmentSize(self, path):
+        if self.options.segmentedDownloadSize <= 0 or self.options.downloadSegments < 2:
+            return 0
+        isCached, element = self.cache.get(path)
+        if element == None or element.size < self.options.segmentedDownloadSize:
+            return 0
+        return (element.size + self.options.downloadSegments - 1) / self.options.downloadSegments
+
+
+    # Return file size from Content-Range header of PARTIAL_CONTENT response or None if range differs from requested.
+    # end - None if range up to end of file was requested.
+    def _getRangeSize(self, response, start, end):
+        # RFC 7233, 4.2: Content-Range: bytes 0-499/1234
+        try:
+            unit, value = response.headers.get("content-range", "").split(" ", 1)
+            rangeValue, size = value.split("/")
+            rangeStart, rangeEnd = rangeValue.split("-")
+            size = int(size)
+            if end == None:
+                end = size - 1
+            if unit == "bytes" and int(rangeStart) == start and int(rangeEnd) == min(end, size - 1):
+                return size
+        except Exception:
+            pass
+        return None
+
+
+    def _getRange(self, davClient, encodedPath, start, end, validator):
+        response = davClient.get(encodedPath, {"Range": "bytes=" + str(start) + "-" + str(end)}, stream=True)
+        if response != PARTIAL_CONTENT or self._getRangeSize(response, start, end) == None or \
+            validator not in (response.headers.get("etag"), response.headers.get("last-modified")):
+            response.close()
+            raise Exception("Download fail " + encodedPath + " : file changed or byte range not supported (" + response.statusline + ")")
+        return response
+
+
+    def _createDavClient(self):
+        server, port, proto, login, password, pool, retryPolicy, transferStats = self._clientArgs
+        davClient = WebDAVClient(server, port, proto, pool=pool, retrypolicy=retryPolicy)
+        davClient.setbasicauth(login, password)
+        davClient.blocksize = self.options.chunkSize
+        davClient.transferstats = transferStats
+        davClient.timeoutpolicy = self.serverState.timeoutPolicy
+        davClient.limiter = self.serverState.limiter
+        davClient.breaker = self.serverState.breaker
+        davClient.tls = self.serverState.tlsPolicy
+        if self.options.useCompression:
+            davClient.accept_encoding = "gzip, deflate"
+        return davClient
+
+
+    def _getBlobCacheKey(self, encodedPath):
+        return "%s://%s:%s%s" % (self.davClient.protocol, self.davClient.host, self.davClient.port, encodedPath)
 
 
     #Raise exception if upload failed.
+    #Content - string or file-like object (streamed to server).
     def upload(self, path, content):
-        if content == "":
+        if content == "" or (hasattr(content, "read") and util.get_length(content) == 0):
             content = " " #on some servers we can't create empty files
+        if self._isResumableUpload(path, content):
+            self._uploadResumable(path, content)
+            return
         encodedPath = self._encodePath(path, False)
         lock = self._safeLock(encodedPath)
         if lock != None:
             with lock:
                 try:
-                    response = self.davClient.put(encodedPath, content)
+                    response = self.davClient.put(encodedPath, content, headers=self._getWriteHeaders(path))
                 except Exception, error:
                     self._safeUnlock(encodedPath)
                     raise error
+                finally:
+                    self.cache.invalidate(path)
 
             self._safeUnlock(encodedPath)
         else:
             raise Exception("Lock fail on upload")
 
 
+    # Return ResumeInfo of interrupted upload or None.
+    def getUploadResumeInfo(self, path):
+        if self.options.resumeDirPath == None:
+            return None
+        return ResumeInfo.load(self._getUploadResumeFilePath(self._encodePath(path, False)))
+
+
+    def _isResumableUpload(self, path, content):
+        if (self.useLocks and not self._isCollectionLocked(self._encodePath(path, False))) or self.options.resumeMinSize <= 0 or self.options.resumeDirPath == None or not hasattr(content, "fileno"):
+            return False
+        length = util.get_length(content)
+        return length != None and length >= self.options.resumeMinSize and self.PARTIAL_UPDATE_FEATURE in self._getServerFeatures(path)
+
+
+    # File is uploaded to temporary file in segments: first segment with PUT, next ones with PATCH (SabreDAV partial update).
+    # Uploaded bytes count is stored in ResumeInfo sidecar, interrupted upload continues from it. Complete file is
+    # moved to 'path'.
+    def _uploadResumable(self, path, content):
+        encodedPath = self._encodePath(path, False)
+        tempPath = encodedPath + self.TEMP_FILE_SUFFIX.encode('utf8')
+        resumeFilePath = self._getUploadResumeFilePath(encodedPath)
+        fileStat = os.fstat(content.fileno())
+        identity = str(fileStat.st_size) + ":" + str(fileStat.st_mtime)
+        start = content.tell()
+        length = util.get_length(content)
+
+        offset = 0
+        resumeInfo = ResumeInfo.load(resumeFilePath)
+        if resumeInfo != None and resumeInfo.href == tempPath and resumeInfo.validator == identity and \
+                self._getUploadedSize(tempPath) == resumeInfo.offset:
+            offset = resumeInfo.offset
+
+        try:
+            while offset == 0 or offset < length:
+                segmentLength = min(self.options.uploadSegmentSize, length - offset)
+                content.seek(start + offset)
+                if offset == 0:
+                    self.davClient.put(tempPath, content, headers=self._getWriteHeaders(path), length=segmentLength)
+                else:
+                    headers = self._getWriteHeaders(path) or {}
+                    headers["X-Update-Range"] = "bytes=" + str(offset) + "-" + str(offset + segmentLength - 1)
+                    self.davClient.patch(tempPath, content, self.PARTIAL_UPDATE_CONTENT_TYPE, headers=headers, length=segmentLength)
+                offset += segmentLength
+                ResumeInfo(tempPath, identity, offset).store(resumeFilePath)
+            self.davClient.move(tempPath, urllib.quote(encodedPath), overwrite=True, headers=self._getWriteHeaders(path))
+        finally:
+            self.cache.invalidate(path)
+            self.cache.invalidate(tempPath.decode('utf8'))
+        os.remove(resumeFilePath)
+
+
+    # Return size of uploaded part of file or None.
+    def _getUploadedSize(self, encodedPath):
+        try:
+            response = self.davClient.propfind(encodedPath, 0, properties = self.LIST_PROPERTIES, stream = True)
+        except HTTPUserError: #on 4xx HTTP status codes
+            return None
+        if response != MULTI_STATUS:
+            response.close()
+            return None
+        sizes = [WebDavElement(entry).size for entry in response.iter_entries()]
+        return sizes[0] if len(sizes) > 0 else None
+
+
+    def _getUploadResumeFilePath(self, encodedPath):
+        if not os.path.isdir(self.options.resumeDirPath):
+            makeDirs(self.options.resumeDirPath)
+        return os.path.join(self.options.resumeDirPath, hashlib.sha224(self._getBlobCacheKey(encodedPath)).hexdigest())
+
+
+    # Return set of DAV compliance classes and extensions from OPTIONS response. Shared by all clones.
+    def _getServerFeatures(self, path):
+        if self.cache.serverFeatures == None:
+            try:
+                response = self.davClient.options(self._encodePath(os.path.dirname(path)))
+                self.cache.serverFeatures = set(feature.strip() for feature in response.headers.get("dav", "").split(","))
+            except Exception:
+                self.cache.serverFeatures = set()
+        return self.cache.serverFeatures
+
+
     def delete(self, path):
         try:
-            self.davClient.delete(self._encodePath(path, False))
+            self.davClient.delete(self._encodePath(path, False), headers=self._getWriteHeaders(path))
         except HTTPUserError, error:
             if (error.response != NOT_FOUND):
                 raise error
             else:
                 pass
+        finally:
+            self.cache.invalidate(path, True)
+
+
+    # Server-side MOVE of file or folder, fails with HTTPUserError if destination exists. Destination header isn't quoted by tinydav.
+    def move(self, path, destinationPath):
+        try:
+            self.davClient.move(self._encodePath(path, False), urllib.quote(self._encodePath(destinationPath, False)), overwrite=False,
+                                headers=self._getWriteHeaders(path))
+        finally:
+            self.cache.invalidate(path, True)
+            self.cache.invalidate(destinationPath, True)
 
 
+    # Server-side COPY of file or folder, fails with HTTPUserError if destination exists.
+    def copy(self, path, destinationPath):
+        try:
+            self.davClient.copy(self._encodePath(path, False), urllib.quote(self._encodePath(destinationPath, False)), overwrite=False,
+                                headers=self._getWriteHeaders(destinationPath))
+        finally:
+            self.cache.invalidate(destinationPath, True)
+
+
+    # Collections known to exist in this run aren't created again.
     def mkdir(self, path):
-        parentDir = os.path.dirname(path)
-        encodedParentDirPath = self._encodePath(parentDir)
-        lock = self._safeLock(encodedParentDirPath, 10)
-        if lock != None:
-            with lock:
-                try:
-                    response = self.davClient.mkcol(self._encodePath(path))
-                except HTTPUserError, error:
-                    if (error.response != METHOD_NOT_ALLOWED or not self.isdir(path)):
-                        self._safeUnlock(encodedParentDirPath)
-                        raise error
-                    else:
-                        pass
-                except Exception, error:
-                    self._safeUnlock(encodedParentDirPath)
-                    raise error
+        self.mkdirs([path])
 
-            self._safeUnlock(encodedParentDirPath)
-        else:
+
+    # Create new collections of one subtree. Paths are created parents first under one lock of the topmost parent,
+    # so MKCOL never fails with 409 Conflict for a missing parent. Created collections are cached as empty listings:
+    # they aren't requested with PROPFIND when synced right after creation.
+    # Return list of created paths (without already existing ones).
+    def mkdirs(self, paths):
+        paths = sorted([path for path in paths if not self.cache.isKnownDir(path)], key = lambda path: len(PathOperations.splitPath(path)))
+        if len(paths) == 0:
+            return []
+
+        encodedParentDirPath = self._encodePath(os.path.dirname(paths[0].rstrip('/')))
+        lock = self._safeLock(encodedParentDirPath, 10 + len(paths))
+        if lock == None:
             raise Exception("Lock fail on mkdir")
 
+        createdPaths = []
+        try:
+            with lock:
+                for path in paths:
+                    if self._mkcol(path):
+                        createdPaths.append(path)
+        finally:
+            self._safeUnlock(encodedParentDirPath)
+            self._putCreatedDirs(createdPaths)
+        return createdPaths
+
+
+    # Return False if collection already exists.
+    def _mkcol(self, path):
+        self.cache.invalidate(path)
+        try:
+            self.davClient.mkcol(self._encodePath(path), headers=self._getWriteHeaders(path))
+        except HTTPUserError, error:
+            if (error.response != METHOD_NOT_ALLOWED or not self.isdir(path)):
+                raise error
+            return False
+        return True
+
+
+    def _putCreatedDirs(self, paths):
+        childDirs = dict((tuple(PathOperations.splitPath(path)), []) for path in paths)
+        for path in paths:
+            parentKey = tuple(PathOperations.splitPath(path))[:-1]
+            if parentKey in childDirs:
+                childDirs[parentKey].append(WebDavCreatedDir(path))
+        for path in paths:
+            self.cache.putListing(path, childDirs[tuple(PathOperations.splitPath(path))])
+
 
     # Return WebDavLockResponse object. Can be used with other requests.
+    # Return headers with lock token of collection lock or None.
+    def _getWriteHeaders(self, path):
+        return self.collectionLock.getHeaders(path) if self.collectionLock != None else None
+
+
+    # Operations below root locked with collection lock aren't locked one by one.
+    def _isCollectionLocked(self, encodedPath):
+        return self.collectionLock != None and self.collectionLock.isLocked(encodedPath.decode('utf8'))
+
+
     def _safeLock(self, path, timeoutSec=600):
-        if self.useLocks:
+        if self.useLocks and not self._isCollectionLocked(path):
             try:
                 lock = self.davClient.lock(path, timeout=timeoutSec)
                 if lock == OK or lock == CREATED:
@@ -166,7 +942,7 @@ class WebDavFS:
 
 
     def _safeUnlock(self, path):
-        if self.useLocks:
+        if self.useLocks and not self._isCollectionLocked(path):
             try:
                 self.davClient.unlock(path)
             except:
@@ -174,17 +950,41 @@ class WebDavFS:
 
 
     def _getWebDavElements(self, path, depth = 0):
-        elements = []
+        return list(self._iterWebDavElements(path, depth))
+
+
+    # Received elements are stored in metadata cache.
+    def _iterWebDavElements(self, path, depth = 0):
         try:
-            responses = self.davClient.propfind(self._encodePath(path), depth, properties = ["resourcetype", "getlastmodified", "getcontentlength"])
-            for i in responses:
-                webdavElement = WebDavElement(responses.content, i)
-                if depth == 0 or not PathOperations.comparePath(webdavElement.fullPath, path): #exclude current path if we list entire folder.
-                    elements.append(WebDavElement(responses.content, i))
+            response = self.davClient.propfind(self._encodePath(path), depth, properties = self.LIST_PROPERTIES, stream = True)
         except HTTPUserError, error: #on 4xx HTTP status codes
             if error.response != NOT_FOUND:
                 raise error
-        return elements
+            self.cache.put(path, None)
+            return
+
+        if response != MULTI_STATUS:
+            response.close()
+            return
+
+        for webdavElement in self._iterResponseElements(path, depth, response):
+            yield webdavElement
+
+
+    # Generator. Elements of multi-status PROPFIND response are stored in metadata cache.
+    def _iterResponseElements(self, path, depth, response):
+        listedElements = []
+        for entry in response.iter_entries():
+            webdavElement = WebDavElement(entry)
+            if depth != 1 or not PathOperations.comparePath(webdavElement.fullPath, path): #exclude current path if we list entire folder.
+                yield webdavElement
+                if depth == 1:
+                    listedElements.append(webdavElement)
+                    continue
+            self.cache.put(webdavElement.fullPath, webdavElement)
+
+        if depth == 1:
+            self.cache.putListing(path, listedElements)
 
 
     def _encodePath(self, path, addEndSlash=True):
@@ -1,19 +1,23 @@
 from __future__ import with_statement
-import os, sys, shutil, datetime, pickle, hashlib
+import os, sys, shutil, datetime, pickle, hashlib, errno
 from stat import *
 import davfs
 import threading
-from common import PathOperations, DummyLock
+from httplib import FORBIDDEN, NOT_FOUND, INSUFFICIENT_STORAGE
+from tinydav import util
+from tinydav.exception import HTTPUserError
+from common import PathOperations, DummyLock, ResumeInfo, makeDirs
 
 
 class FileSystemElement:
-    def __init__(self, parentPath, name, isDir, lastModifiedTimeGMT, size, isLocked = False):
+    def __init__(self, parentPath, name, isDir, lastModifiedTimeGMT, size, isLocked = False, fingerprint = None):
         self.parentPath = parentPath
         self.name = name
         self.isDir = isDir
         self.lastModifiedTimeGMT = lastModifiedTimeGMT
         self.size = size
         self.isLocked = isLocked
+        self.fingerprint = fingerprint # hash of file content, set for stored files only
 
     def __hash__(self):
         return hash((self.name, self.parentPath))
@@ -24,17 +28,45 @@ class FileSystemElement:
 
 
 class LocalFileSystem:
+    TEMP_FILE_SUFFIX   = u".filesyncer-tmp"
+    RESUME_FILE_SUFFIX = u".resume" + TEMP_FILE_SUFFIX
+    DEFAULT_CHUNK_SIZE = 64 * 1024
+
+    # resumeMinSize - interrupted download is kept to be resumed if at least this number of bytes was received, 0 - disabled
+    def __init__(self, chunkSize = DEFAULT_CHUNK_SIZE, resumeMinSize = 0):
+        self.chunkSize = chunkSize
+        self.resumeMinSize = resumeMinSize
+
+
     def isReadOnly(self):
         return False
 
 
+    def isAvailable(self):
+        return True
+
+
     def clone(self):
-        return LocalFileSystem()
+        return LocalFileSystem(self.chunkSize, self.resumeMinSize)
+
+
+    def getStats(self):
+        return {}
+
+
+    def beginSync(self, rootPath, statePath = None, isDryRun = False):
+        pass
+
+
+    def endSync(self, rootPath):
+        pass
 
 
     def list(self, dirPath):
         elementList = [];
         for element in os.listdir(dirPath):
+            if element.endswith(LocalFileSystem.TEMP_FILE_SUFFIX): # unfinished download
+                continue
             pathname = os.path.join(dirPath, element)
             try:
                 elementList.append(self.getFileSystemElement(pathname))
@@ -49,23 +81,105 @@ class LocalFileSystem:
         return FileSystemElement(os.path.dirname(path), os.path.basename(path), S_ISDIR(statResult.st_mode), datetime.datetime.utcfromtimestamp(timestamp), statResult.st_size)
 
 
+    # Content - string or file-like object. File-like object content is written to temporary file
+    # in chunks and replaces target file only when all data was read. Object with 'writeTo' method
+    # (segmented download) writes content to temporary file itself.
+    # Content with 'offset' attribute continues interrupted download (see getResumeInfo), if download is
+    # interrupted again temporary file is kept with ResumeInfo sidecar file.
     def writeFile(self, filePath, content):
         if content != None:
-            try:
-                with open(filePath, "wb") as file:
-                    file.write(content)
-            except IOError, error:
-                strError = str(error)
-
-                # If permission denied on Windows might be trying to update a
-                # hidden file, in which case try opening without CREATE
-                # See: https://stackoverflow.com/questions/13215716/ioerror-errno-13-permission-denied-when-trying-to-open-hidden-file-in-w-mod
-                if "Errno 13" in strError or "Permission" in strError:
-                    with open(filePath, "r+b") as file:
-                        file.truncate(0)
-                        file.write(content)
-                else:
-                    raise error
+            if hasattr(content, "read"):
+                tempFilePath = filePath + LocalFileSystem.TEMP_FILE_SUFFIX
+                resumeFilePath = filePath + LocalFileSystem.RESUME_FILE_SUFFIX
+                offset = getattr(content, "offset", 0)
+                isWritten = False
+                try:
+                    if offset > 0:
+                        if not os.path.isfile(tempFilePath) or os.path.getsize(tempFilePath) < offset:
+                            raise IOError("Can't resume download of '" + filePath.encode('utf8') + "': partial file is missing")
+                        file = open(tempFilePath, "r+b")
+                        file.seek(offset)
+                        file.truncate()
+                    else:
+                        file = open(tempFilePath, "wb")
+                    with file:
+                        if hasattr(content, "writeTo"):
+                            content.writeTo(file)
+                        else:
+                            shutil.copyfileobj(content, file, self.chunkSize)
+                    self._replaceFile(tempFilePath, filePath)
+                    isWritten = True
+                finally:
+                    if isWritten or not self._keepPartialFile(tempFilePath, resumeFilePath, content):
+                        if os.path.exists(tempFilePath):
+                            os.remove(tempFilePath)
+                        if os.path.exists(resumeFilePath):
+                            os.remove(resumeFilePath)
+            else:
+                self._writeFile(filePath, lambda file: file.write(content))
+
+
+    # Return ResumeInfo of interrupted download of 'filePath' or None.
+    def getResumeInfo(self, filePath):
+        resumeInfo = ResumeInfo.load(filePath + LocalFileSystem.RESUME_FILE_SUFFIX)
+        tempFilePath = filePath + LocalFileSystem.TEMP_FILE_SUFFIX
+        if resumeInfo != None and os.path.isfile(tempFilePath) and os.path.getsize(tempFilePath) >= resumeInfo.offset:
+            return resumeInfo
+        return None
+
+
+    # Return hex digest of file content.
+    def getFingerprint(self, filePath):
+        digest = hashlib.sha1()
+        with open(filePath, "rb") as file:
+            while True:
+                data = file.read(self.chunkSize)
+                if not data:
+                    break
+                digest.update(data)
+        return digest.hexdigest()
+
+
+    def _keepPartialFile(self, tempFilePath, resumeFilePath, content):
+        href = getattr(content, "href", None)
+        validator = getattr(content, "validator", None)
+        if self.resumeMinSize <= 0 or not href or not validator or not os.path.isfile(tempFilePath):
+            return False
+        offset = os.path.getsize(tempFilePath)
+        if offset < self.resumeMinSize:
+            return False
+        try:
+            ResumeInfo(href, validator, offset).store(resumeFilePath)
+            return True
+        except Exception:
+            return False
+
+
+    def _writeFile(self, filePath, writer):
+        try:
+            with open(filePath, "wb") as file:
+                writer(file)
+        except IOError, error:
+            strError = str(error)
+
+            # If permission denied on Windows might be trying to update a
+            # hidden file, in which case try opening without CREATE
+            # See: https://stackoverflow.com/questions/13215716/ioerror-errno-13-permission-denied-when-trying-to-open-hidden-file-in-w-mod
+            if "Errno 13" in strError or "Permission" in strError:
+                with open(filePath, "r+b") as file:
+                    file.truncate(0)
+                    writer(file)
+            else:
+                raise error
+
+
+    def _replaceFile(self, sourceFilePath, filePath):
+        try:
+            os.rename(sourceFilePath, filePath)
+        except OSError:
+            # On Windows rename can't replace existing (or hidden) file - copy content
+            with open(sourceFilePath, "rb") as sourceFile:
+                self._writeFile(filePath, lambda file: shutil.copyfileobj(sourceFile, file, self.chunkSize))
 
 
     def readFile(self, filePath):
@@ -73,6 +187,10 @@ class LocalFileSystem:
             return file.read()
 
 
+    def openFile(self, filePath, resumeInfo = None):
+        return open(filePath, "rb")
+
+
     def deleteFile(self, filePath):
         os.remove(filePath)
 
@@ -81,11 +199,43 @@ class LocalFileSystem:
         os.makedirs(dirPath)
 
 
+    # Create new subtree of folders parents first. Return list of created folders.
+    def createDirs(self, dirPaths):
+        for dirPath in dirPaths:
+            self.createDir(dirPath)
+        return list(dirPaths)
+
+
+    # Local listings are not prefetched.
+    def prefetchLists(self, dirPaths):
+        pass
+
+
     def deleteDir(self, dirPath):
         if os.path.isdir(dirPath):
             shutil.rmtree(dirPath)
 
 
+    # Rename (move) file or folder, fails if destination exists.
+    def moveElement(self, sourcePath, destinationPath):
+        self._checkNotExist(destinationPath)
+        os.rename(sourcePath, destinationPath)
+
+
+    # Copy file or folder with modification times, fails if destination exists.
+    def copyElement(self, sourcePath, destinationPath):
+        self._checkNotExist(destinationPath)
+        if os.path.isdir(sourcePath):
+            shutil.copytree(sourcePath, destinationPath)
+        else:
+            shutil.copy2(sourcePath, destinationPath)
+
+
+    def _checkNotExist(self, path):
+        if os.path.exists(path):
+            raise OSError(errno.EEXIST, os.strerror(errno.EEXIST), path)
+
+
     def isFile(self, path):
         return os.path.isfile(path)
 
@@ -99,65 +249,406 @@ class LocalFileSystem:
 #end class LocalFileSystem
 
 
+# In-memory index of remote tree, loaded with one request at sync start or restored from file and updated with
+# remote changes. Paths are compared by their elements, like PathOperations.comparePath does.
+class RemoteSnapshot:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.loadsCount = 0
+        self.fallbacksCount = 0
+        self.changesCount = 0
+        self.syncTokenResetsCount = 0
+        self.syncCollectionError = None # reason of last fallback from sync-collection to listing
+        self.clear()
+
+
+    def clear(self):
+        with self._lock:
+            self._rootKey = None
+            self._elements = {} # path key -> FileSystemElement
+            self._children = {} # dir path key -> {name: FileSystemElement}
+
+
+    # elements - iterable of (path, FileSystemElement) for rootPath and all paths below it.
+    # isCounted - False if snapshot is only a base for remote changes, it's counted when changes are applied.
+    def load(self, rootPath, elements, isCounted = True):
+        rootKey = self._getKey(rootPath)
+        loadedElements = {}
+        loadedChildren = {}
+        for path, element in elements:
+            key = self._getKey(path)
+            if key[:len(rootKey)] != rootKey:
+                continue
+            loadedElements[key] = element
+            if key != rootKey:
+                loadedChildren.setdefault(key[:-1], {})[key[-1]] = element
+
+        with self._lock:
+            self._rootKey = rootKey
+            self._elements = loadedElements
+            self._children = loadedChildren
+            if isCounted:
+                self.loadsCount += 1
+
+
+    def covers(self, path):
+        key = self._getKey(path)
+        with self._lock:
+            return self._rootKey != None and key[:len(self._rootKey)] == self._rootKey
+
+
+    def getElement(self, path):
+        with self._lock:
+            return self._elements.get(self._getKey(path))
+
+
+    def list(self, dirPath):
+        with self._lock:
+            return self._children.get(self._getKey(dirPath), {}).values()
+
+
+    def add(self, path, element):
+        key = self._getKey(path)
+        with self._lock:
+            self._elements[key] = element
+            if len(key) > 0:
+                self._children.setdefault(key[:-1], {})[key[-1]] = element
+
+
+    # Move element and all elements below it to 'destinationPath', keep them if 'keepSource' (copy).
+    def move(self, sourcePath, destinationPath, keepSource = False):
+        sourceKey = self._getKey(sourcePath)
+        destinationKey = self._getKey(destinationPath)
+        with self._lock:
+            movedElements = [(key, element) for key, element in self._elements.iteritems() if key[:len(sourceKey)] == sourceKey]
+        if not keepSource:
+            self.remove(sourcePath)
+        for key, element in movedElements:
+            newKey = destinationKey + key[len(sourceKey):]
+            self.add(u"/" + u"/".join(newKey), FileSystemElement(u"/" + u"/".join(newKey[:-1]), newKey[-1], element.isDir, element.lastModifiedTimeGMT, element.size))
+
+
+    def remove(self, path):
+        key = self._getKey(path)
+        with self._lock:
+            for elementKey in self._elements.keys():
+                if elementKey[:len(key)] == key:
+                    del self._elements[elementKey]
+                    self._children.pop(elementKey, None)
+            if len(key) > 0:
+                self._children.get(key[:-1], {}).pop(key[-1], None)
+
+
+    # Return sync token stored with snapshot of 'rootPath' or None if there is no stored snapshot.
+    def loadFromFile(self, filePath, rootPath):
+        try:
+            with open(filePath, "rb") as file:
+                storedRootKey, syncToken, elements = pickle.load(file)
+        except Exception:
+            return None
+
+        if storedRootKey != self._getKey(rootPath):
+            return None
+        self.load(rootPath, ((u"/" + u"/".join(key), element) for key, element in elements), False)
+        return syncToken
+
+
+    def storeInFile(self, filePath, syncToken):
+        with self._lock:
+            data = (self._rootKey, syncToken, self._elements.items())
+        with open(filePath, "wb") as file:
+            pickle.dump(data, file)
+
+
+    def _getKey(self, path):
+        return tuple(PathOperations.splitPath(path))
+#end class RemoteSnapshot
+
+
 class WebDavFileSystem:
-    def __init__(self, server, port, proto, login, password, useLocks):
+    def __init__(self, server, port, proto, login, password, useLocks, options = None, pool = None, retryPolicy = None, snapshot = None, metadataCache = None, blobCache = None,
+                 transferStats = None, collectionLock = None, serverState = None):
         self._server = server
         self._port = port
         self._proto = proto
         self._login = login
         self._password = password
         self._useLocks = useLocks
-        self.dav = davfs.WebDavFS(server, port, proto, login, password, useLocks)
+        self._options = options if options != None else davfs.WebDavOptions()
+        # shared by all clones
+        self._serverState = serverState if serverState != None else davfs.WebDavServerState(self._options)
+        self._pool = pool if pool != None else self._serverState.pool
+        self._retryPolicy = retryPolicy if retryPolicy != None else self._serverState.retryPolicy
+        self._snapshot = snapshot if snapshot != None else RemoteSnapshot()
+        self._metadataCache = metadataCache if metadataCache != None else davfs.WebDavMetadataCache()
+        self._blobCache = blobCache
+        self._transferStats = transferStats if transferStats != None else util.TransferStats()
+        self._collectionLock = collectionLock if collectionLock != None else davfs.WebDavCollectionLock()
+        self._syncState = None # (state file path, sync token) of current sync path
+        self.dav = davfs.WebDavFS(server, port, proto, login, password, useLocks, self._pool, self._options, self._retryPolicy, self._metadataCache, self._blobCache,
+                                  self._transferStats, self._collectionLock, self._serverState)
 
 
     def clone(self):
-        return WebDavFileSystem(self._server, self._port, self._proto, self._login, self._password, self._useLocks)
+        return WebDavFileSystem(self._server, self._port, self._proto, self._login, self._password, self._useLocks, self._options, self._pool, self._retryPolicy, self._snapshot, self._metadataCache, self._blobCache,
+                                self._transferStats, self._collectionLock, self._serverState)
+
+
+    def getStats(self):
+        retryStats = self._retryPolicy.getstats()
+        stats = {"retries": retryStats["retries"],
+                 "retry wait sec": round(retryStats["waited"], 2),
+                 "retries over budget": retryStats["rejected"],
+                 "metadata cache hits": self._metadataCache.hitsCount,
+                 "metadata cache misses": self._metadataCache.missesCount,
+                 "known dir hits": self._metadataCache.knownDirHitsCount}
+        timeoutStats = self._serverState.timeoutPolicy.getstats()
+        stats["response time ms"] = int(timeoutStats["srtt"] * 1000) if timeoutStats["srtt"] != None else None
+        stats["request timeout sec"] = round(timeoutStats["rto"], 2)
+        stats["bandwidth KB/s"] = int(timeoutStats["bandwidth"] / 1024) if timeoutStats["bandwidth"] != None else None
+        if self._serverState.limiter != None:
+            limiterStats = self._serverState.limiter.getstats()
+            stats["requests limit"] = limiterStats["limit"]
+            stats["requests limit decreases"] = limiterStats["decreases"]
+            stats["requests limit history"] = ">".join([str(limit) for limit in limiterStats["history"]])
+            stats["max requests in flight"] = limiterStats["peak"]
+        if self._serverState.breaker != None:
+            breakerStats = self._serverState.breaker.getstats()
+            stats["server state"] = breakerStats["state"]
+            stats["server unreachable"] = breakerStats["opened"]
+            stats["requests failed fast"] = breakerStats["rejected"]
+        if self._proto == "https":
+            tlsStats = self._serverState.tlsPolicy.getstats()
+            stats["TLS handshakes"] = tlsStats["handshakes"]
+            stats["TLS sessions resumed"] = tlsStats["resumed"]
+        if self._options.useCompression:
+            transferStats = self._transferStats.getstats()
+            stats["compressed responses"] = transferStats["encoded"]
+            stats["received KB"] = transferStats["wirebytes"] / 1024
+            stats["decoded KB"] = transferStats["decodedbytes"] / 1024
+        if self._useLocks and self._options.lockMode == davfs.WebDavOptions.LOCK_MODE_COLLECTION:
+            stats["collection locks"] = self._collectionLock.locksCount
+            stats["collection lock refreshes"] = self._collectionLock.refreshesCount
+            stats["collection lock fallbacks"] = self._collectionLock.fallbacksCount
+        if self._blobCache != None:
+            stats["blob cache hits"] = self._blobCache.hitsCount
+            stats["blob cache misses"] = self._blobCache.missesCount
+        if self._options.useSnapshot or self._options.useSyncCollection:
+            stats["snapshots"] = self._snapshot.loadsCount
+            stats["snapshot fallbacks"] = self._snapshot.fallbacksCount
+        if self._options.useSyncCollection:
+            stats["remote changes"] = self._snapshot.changesCount
+            stats["sync token resets"] = self._snapshot.syncTokenResetsCount
+            if self._snapshot.syncCollectionError != None:
+                stats["sync-collection error"] = self._snapshot.syncCollectionError
+        return stats
+
+
+    # Load snapshot of remote tree. With sync-collection snapshot stored in 'statePath' file is updated with remote
+    # changes only. Otherwise if server rejects 'Depth: infinity' remote tree is listed folder by folder.
+    # With collection lock mode sync root is locked until endSync, unless it's dry run (nothing is written to server).
+    def beginSync(self, rootPath, statePath = None, isDryRun = False):
+        self._snapshot.clear()
+        self._syncState = None
+        if self._useLocks and self._options.lockMode == davfs.WebDavOptions.LOCK_MODE_COLLECTION and not isDryRun and self.dav.isdir(rootPath):
+            self._collectionLock.acquire(self.dav, rootPath)
+        if self._options.useSyncCollection and statePath != None:
+            syncToken = self._loadChanges(rootPath, statePath)
+            if syncToken != None:
+                self._syncState = (statePath, syncToken)
+                return
+            self._snapshot.clear()
+            self._snapshot.fallbacksCount += 1
+            if os.path.exists(statePath):
+                os.remove(statePath)
+
+        if self._options.useSnapshot:
+            try:
+                self._snapshot.load(rootPath, self._iterTree(rootPath))
+            except HTTPUserError, error:
+                if error.response != FORBIDDEN:
+                    raise error
+                self._snapshot.clear()
+                self._snapshot.fallbacksCount += 1
+
+
+    # Stored snapshot is saved with token received at sync start: changes made while syncing are reported by server next time.
+    def endSync(self, rootPath):
+        self._collectionLock.release()
+        if self._syncState != None:
+            statePath, syncToken = self._syncState
+            self._syncState = None
+            self._snapshot.storeInFile(statePath, syncToken)
+        self._snapshot.clear()
+
+
+    # Restore snapshot and apply remote changes. Return new sync token or None if server doesn't support sync-collection.
+    def _loadChanges(self, rootPath, statePath):
+        rootElement = self.getFileSystemElement(rootPath)
+        if rootElement is None or not rootElement.isDir:
+            return None
+
+        syncToken = self._snapshot.loadFromFile(statePath, rootPath)
+        try:
+            if syncToken != None:
+                try:
+                    syncToken = self._applyChanges(rootPath, syncToken)
+                except HTTPUserError: # token is expired or invalid
+                    syncToken = None
+                    self._snapshot.syncTokenResetsCount += 1
+
+            if syncToken == None:
+                self._snapshot.load(rootPath, [], False)
+                syncToken = self._applyChanges(rootPath, None)
+        except Exception, error: # not supported by server, network error or bad response: remote tree is listed then
+            self._snapshot.syncCollectionError = str(error)
+            return None
+
+        self._snapshot.add(rootPath, rootElement)
+        self._snapshot.loadsCount += 1
+        return syncToken
+
+
+    def _applyChanges(self, rootPath, syncToken):
+        while True:
+            changes = self.dav.listChanges(rootPath, syncToken)
+            truncated = False
+            try:
+                for element in changes:
+                    if PathOperations.comparePath(element.fullPath, rootPath):
+                        truncated = element.status == INSUFFICIENT_STORAGE # RFC 6578, 3.6: results are truncated, request again with new token
+                    elif element.status == NOT_FOUND:
+                        self._snapshot.remove(element.fullPath)
+                        self._snapshot.changesCount += 1
+                    else:
+                        self._snapshot.add(element.fullPath, self._getElement(element))
+                        self._snapshot.changesCount += 1
+            finally:
+                changes.close()
+
+            if changes.syncToken == None:
+                raise Exception("Sync collection fail " + rootPath.encode('utf-8') + " : no sync token")
+            syncToken = changes.syncToken
+            if not truncated:
+                return syncToken
 
 
     def isReadOnly(self):
         return False
 
 
+    # Return False while circuit breaker is open: server didn't respond to several requests in a row, so requests
+    # fail without connecting until next probe.
+    def isAvailable(self):
+        return self._serverState.breaker == None or self._serverState.breaker.isavailable()
+
+
     def list(self, dirPath):
-        elementList = [];
-        for element in self.dav.list(dirPath):
-            elementList.append(FileSystemElement(dirPath, PathOperations.getPathLastElement(element.fullPath), element.isDir, element.lastModifiedTimeGMT, element.size))
-        return elementList
+        if self._snapshot.covers(dirPath):
+            elementList = self._snapshot.list(dirPath)
+        else:
+            elementList = [];
+            for element in self.dav.list(dirPath):
+                elementList.append(FileSystemElement(dirPath, PathOperations.getPathLastElement(element.fullPath), element.isDir, element.lastModifiedTimeGMT, element.size))
+        return [element for element in elementList if not element.name.endswith(LocalFileSystem.TEMP_FILE_SUFFIX)] # skip unfinished uploads
+
+
+    # Request listings of folders, that will be listed soon, at once (with pipelining enabled).
+    def prefetchLists(self, dirPaths):
+        self.dav.prefetchListings([dirPath for dirPath in dirPaths if not self._snapshot.covers(dirPath)])
+
+
+    def _iterTree(self, rootPath):
+        for element in self.dav.listTree(rootPath):
+            yield (element.fullPath, self._getElement(element))
+
+
+    def _getElement(self, webdavElement):
+        return FileSystemElement(os.path.dirname(webdavElement.fullPath.rstrip('/')), PathOperations.getPathLastElement(webdavElement.fullPath), webdavElement.isDir, webdavElement.lastModifiedTimeGMT, webdavElement.size)
 
 
     def getFileSystemElement(self, path):
-        elements = self.dav._getWebDavElements(path)
-        if len(elements) > 0:
-            element = elements[0]
+        if self._snapshot.covers(path):
+            return self._snapshot.getElement(path)
+
+        element = self.dav.getElement(path)
+        if element != None:
             return FileSystemElement(path, PathOperations.getPathLastElement(path), element.isDir, element.lastModifiedTimeGMT, element.size)
         return None
 
 
     def writeFile(self, filePath, content):
+        size = util.get_length(content) if hasattr(content, "read") else len(content)
         self.dav.upload(filePath, content)
+        if self._snapshot.covers(filePath):
+            self._snapshot.add(filePath, FileSystemElement(os.path.dirname(filePath), PathOperations.getPathLastElement(filePath), False, datetime.datetime.utcnow(), size or 0))
 
 
     def readFile(self, filePath):
         return self.dav.download(filePath)
 
 
+    # resumeInfo - ResumeInfo of interrupted download, content is requested from its offset if file wasn't changed.
+    def openFile(self, filePath, resumeInfo = None):
+        return self.dav.openDownload(filePath, resumeInfo = resumeInfo)
+
+
+    # Return ResumeInfo of interrupted upload of 'filePath' or None.
+    def getResumeInfo(self, filePath):
+        return self.dav.getUploadResumeInfo(filePath)
+
+
     def deleteFile(self, filePath):
         self.dav.delete(filePath)
+        self._snapshot.remove(filePath)
 
 
     def createDir(self, dirPath):
-        self.dav.mkdir(dirPath)
+        self.createDirs([dirPath])
+
+
+    # Create new subtree of folders parents first. Return list of created folders.
+    def createDirs(self, dirPaths):
+        createdPaths = self.dav.mkdirs(dirPaths)
+        for dirPath in dirPaths:
+            if self._snapshot.covers(dirPath):
+                self._snapshot.add(dirPath, FileSystemElement(os.path.dirname(dirPath), PathOperations.getPathLastElement(dirPath), True, datetime.datetime.utcnow(), 0))
+        return createdPaths
 
 
     def deleteDir(self, dirPath):
         self.deleteFile(dirPath)
 
 
+    # Server-side move of file or folder, fails if destination exists.
+    def moveElement(self, sourcePath, destinationPath):
+        self.dav.move(sourcePath, destinationPath)
+        self._updateSnapshot(sourcePath, destinationPath, False)
+
+
+    # Server-side copy of file or folder, fails if destination exists.
+    def copyElement(self, sourcePath, destinationPath):
+        self.dav.copy(sourcePath, destinationPath)
+        self._updateSnapshot(sourcePath, destinationPath, True)
+
+
+    def _updateSnapshot(self, sourcePath, destinationPath, keepSource):
+        if self._snapshot.covers(sourcePath) and self._snapshot.covers(destinationPath):
+            self._snapshot.move(sourcePath, destinationPath, keepSource)
+        elif not keepSource:
+            self._snapshot.remove(sourcePath)
+
+
     def isFile(self, path):
+        if self._snapshot.covers(path):
+            element = self._snapshot.getElement(path)
+            return element is None or not element.isDir
         return self.dav.isfile(path)
 
 
     def isExist(self, path):
+        if self._snapshot.covers(path):
+            return self._snapshot.getElement(path) != None
         return self.dav.exists(path)
 
 
@@ -168,14 +659,17 @@ class WebDavFileSystem:
 
 class StoredFileSystem:
     def __init__(self, remoteSyncPath, localSyncPath, settingsDirPath, threadSafe = False):
+        self.remoteSyncPath = remoteSyncPath
+        self.localSyncPath = localSyncPath
         self.localFilesystem = LocalFileSystem();
-        if not self.localFilesystem.isExist(settingsDirPath):
-            self.localFilesystem.createDir(settingsDirPath)
+        makeDirs(settingsDirPath)
         self.storedFilePath = \
             os.path.join(settingsDirPath, \
             hashlib.sha224(localSyncPath.encode('utf8') + remoteSyncPath.encode('utf8')).hexdigest()).decode('utf8')
 
         self.storedPaths = {}
+        self._isStoreDeferred = False
+        self._isChanged = False # changed after last store, if store is deferred
         self._loadFromFile()
 
         if threadSafe:
@@ -184,6 +678,23 @@ class StoredFileSystem:
             self._lock = DummyLock()
 
 
+    # Deferred store: changes are kept in memory until store() is called, e.g. once per synced folder instead of once per file.
+    def setDeferredStore(self, isDeferred):
+        with self._lock:
+            self._isStoreDeferred = isDeferred
+
+
+    def store(self):
+        with self._lock:
+            if self._isChanged:
+                self._writeToFile()
+
+
+    # Path of additional state file kept next to stored file system state.
+    def getStateFilePath(self, suffix):
+        return self.storedFilePath + suffix
+
+
     def getAllElements(self):
         allElements = []
         with self._lock:
@@ -206,9 +717,33 @@ class StoredFileSystem:
 
 
     def writeFile(self, filePath, content):
+        self.writeFileInfo(filePath, len(content))
+
+
+    # fingerprint - hash of file content (LocalFileSystem.getFingerprint), used to detect moved files.
+    def writeFileInfo(self, filePath, size, fingerprint = None):
         with self._lock:
             self.storedPaths[filePath.encode('utf8')] =\
-                FileSystemElement(filePath, os.path.dirname(filePath), False, self._getCurrentStoreUTC(), len(content))
+                FileSystemElement(filePath, os.path.dirname(filePath), False, self._getCurrentStoreUTC(), size, fingerprint = fingerprint)
+            self._storeInFile()
+
+
+    # Return content hash of stored file or None if it's unknown.
+    def getFingerprint(self, filePath):
+        element = self.getFileSystemElement(filePath)
+        return getattr(element, "fingerprint", None) if element is not None else None
+
+
+    # Move info about element and elements below it to 'destinationPath', elements are marked as synced now.
+    def moveElement(self, sourcePath, destinationPath, keepSource = False):
+        encodedSourcePath = sourcePath.encode('utf8')
+        with self._lock:
+            for key in self.storedPaths.keys():
+                if key == encodedSourcePath or PathOperations.isSubPath(encodedSourcePath, key):
+                    element = self.storedPaths[key] if keepSource else self.storedPaths.pop(key)
+                    newPath = destinationPath + key[len(encodedSourcePath):].decode('utf8')
+                    self.storedPaths[newPath.encode('utf8')] = FileSystemElement(newPath, os.path.dirname(newPath), element.isDir, self._getCurrentStoreUTC(), element.size,
+                                                                                 fingerprint = getattr(element, "fingerprint", None))
             self._storeInFile()
 
 
@@ -254,8 +789,16 @@ class StoredFileSystem:
 
 
     def _storeInFile(self):
+        if self._isStoreDeferred:
+            self._isChanged = True
+        else:
+            self._writeToFile()
+
+
+    def _writeToFile(self):
         with open(self.storedFilePath, "wb") as file:
             pickle.dump(self.storedPaths, file)
+        self._isChanged = False
 
 
     def _getCurrentStoreUTC(self):
@@ -272,14 +815,34 @@ class ReadOnlyFileSystem:
         return ReadOnlyFileSystem(self.filesystem.clone())
 
 
+    def getStats(self):
+        return self.filesystem.getStats()
+
+
+    def beginSync(self, rootPath, statePath = None, isDryRun = False):
+        self.filesystem.beginSync(rootPath, statePath, isDryRun)
+
+
+    def endSync(self, rootPath):
+        self.filesystem.endSync(rootPath)
+
+
     def isReadOnly(self):
         return True
 
 
+    def isAvailable(self):
+        return self.filesystem.isAvailable()
+
+
     def list(self, dirPath):
         return self.filesystem.list(dirPath)
 
 
+    def prefetchLists(self, dirPaths):
+        self.filesystem.prefetchLists(dirPaths)
+
+
     def getFileSystemElement(self, path):
         return self.filesystem.getFileSystemElement(path)
 
@@ -292,14 +855,34 @@ class ReadOnlyFileSystem:
         return self.filesystem.readFile(filePath)
 
 
+    def openFile(self, filePath, resumeInfo = None):
+        return self.filesystem.openFile(filePath, resumeInfo)
+
+
+    def getResumeInfo(self, filePath):
+        return None
+
+
     def deleteFile(self, filePath):
         pass
 
 
+    def moveElement(self, sourcePath, destinationPath):
+        pass
+
+
+    def copyElement(self, sourcePath, destinationPath):
+        pass
+
+
     def createDir(self, dirPath):
         pass
 
 
+    def createDirs(self, dirPaths):
+        return []
+
+
     def deleteDir(self, dirPath):
         pass
 
@@ -1,21 +1,29 @@
 from __future__ import with_statement
 from filesystems import LocalFileSystem, WebDavFileSystem, StoredFileSystem
-from common import PathOperations, AtomicInteger, DummyLock
-import datetime, shutil, sys, random, string, threading
+from common import PathOperations, AtomicInteger, DummyLock, CountingReader, WorkQueue, makeDirs
+from syncplan import SyncOperation, SyncPlan, FolderProgress
+import datetime, shutil, sys, os, random, string, threading
 import time
-try:
-    from concurrent.futures import ThreadPoolExecutor
-except ImportError as e:
-    print "*** For multithread sync its recommended to install futures: 'pip install futures' ***"
 
 
 class Syncer:
+    LOG_LOCK = threading.Lock() # log file is shared by syncers run at the same time
     STORED_FS_DATA_DIR_NAME = "state"
+    REMOTE_STATE_FILE_SUFFIX = u".remote"
+    MAX_TRANSFER_RESUMES = 3
     BACKUP_DATA_DIR_NAME    = "backup"
     WAIT_ANIMATION_CHARS    = "|/-\\"
 
-    def __init__(self, remoteFs, localFs, logFilePath, settingsDirPath, maxFileSizeKb = 0, maxWorkers=4):
+    # detectMoves - do local renames and moves of synced elements with server-side MOVE (COPY) instead of upload.
+    # dryRun - only write planned operations (and bytes to transfer) to log, neither side nor stored state is changed.
+    # maxTransferWorkers - threads of file transfers, separate from 'maxWorkers' threads of listings and deletions (0 - same count).
+    # smallFilesFirst - transfer files in order of size, smallest first.
+    # workerBudget - semaphore shared by syncers run at the same time, limits number of their busy worker threads.
+    def __init__(self, remoteFs, localFs, logFilePath, settingsDirPath, maxFileSizeKb = 0, maxWorkers=4, detectMoves = False, dryRun = False,
+                 maxTransferWorkers = 0, smallFilesFirst = True, workerBudget = None):
         self.lastFileStatPrintTime = time.time()
+        self.detectMoves = detectMoves
+        self.dryRun = dryRun
         self.fileStatPrintAnimCounter = 0
         self._remoteFs = remoteFs
         self._localFs = localFs
@@ -23,61 +31,100 @@ class Syncer:
         self.logFilePath = logFilePath
         self.settingsDirPath = settingsDirPath
         self.backupDirPath = self._internalFs.buildPath(self.settingsDirPath, Syncer.BACKUP_DATA_DIR_NAME)
-        if not self._internalFs.isExist(self.backupDirPath):
-            self._internalFs.createDir(self.backupDirPath)
+        self.stateDirPath = self._internalFs.buildPath(self.settingsDirPath, Syncer.STORED_FS_DATA_DIR_NAME)
+        # created here, before syncers run at the same time use them
+        for dirPath in (self.backupDirPath, self.stateDirPath):
+            makeDirs(dirPath)
         self.syncElements = {}
         self.maxFileSizeBytes = maxFileSizeKb * 1024
         if self.maxFileSizeBytes == 0:
             self.maxFileSizeBytes = sys.maxint
 
-        try:
-            self.executor = ThreadPoolExecutor(max_workers=maxWorkers)
-            self.maxWorkers = maxWorkers
-        except Exception, error:
-            self.maxWorkers = 1
+        self.maxWorkers = max(1, maxWorkers)
+        self.maxTransferWorkers = maxTransferWorkers if maxTransferWorkers > 0 else self.maxWorkers
+        self.smallFilesFirst = smallFilesFirst
+        self.workerBudget = workerBudget
+        self.isMultiThreaded = self.maxWorkers > 1 or self.maxTransferWorkers > 1
 
-        if self.maxWorkers > 1:
+        if self.isMultiThreaded:
             self._lock = threading.Lock()
-            print "Use " + str(self.maxWorkers) + " threads for sync" 
+            print "Use " + str(self.maxWorkers) + " threads for sync, " + str(self.maxTransferWorkers) + " threads for transfers"
         else:
             self._lock = DummyLock()
 
-        self.processedDirsCount = AtomicInteger(0, self.maxWorkers > 1)
-        self.processedFilesCount = AtomicInteger(0, self.maxWorkers > 1)
-        self.updatedDirsCount = AtomicInteger(0, self.maxWorkers > 1)
-        self.updatedFilesCount = AtomicInteger(0, self.maxWorkers > 1)
-        self.lastSyncPathErrorCount = AtomicInteger(0, self.maxWorkers > 1)
+        self.processedDirsCount = AtomicInteger(0, self.isMultiThreaded)
+        self.processedFilesCount = AtomicInteger(0, self.isMultiThreaded)
+        self.updatedDirsCount = AtomicInteger(0, self.isMultiThreaded)
+        self.updatedFilesCount = AtomicInteger(0, self.isMultiThreaded)
+        self.lastSyncPathErrorCount = AtomicInteger(0, self.isMultiThreaded)
+        self.isRemoteUnavailableLogged = False
 
-        self.activeWorkers = set()
+        self._workQueue = None     # WorkQueue of listings and deletions of sync run, if maxWorkers > 1
+        self._transferQueue = None # WorkQueue of file transfers of sync run, if maxTransferWorkers > 1
+        self._workerFileSystems = threading.local()
 
 
     def addSyncElement(self, remotePath, localPath):
         self.syncElements[remotePath] = localPath
 
 
+    # Sync path is synced in two phases: both sides are listed and compared with stored state to plan operations,
+    # then the plan is executed.
     def sync(self, onlyIfRemoteExist=False, onlyIfLocalExist=False):
+        if self.maxWorkers > 1:
+            self._workQueue = WorkQueue(self.maxWorkers, self.workerBudget)
+        if self.maxTransferWorkers > 1:
+            self._transferQueue = WorkQueue(self.maxTransferWorkers, self.workerBudget)
+        try:
+            self._syncElements(onlyIfRemoteExist, onlyIfLocalExist)
+        finally:
+            for workQueue in (self._workQueue, self._transferQueue):
+                if workQueue != None:
+                    workQueue.close()
+            self._workQueue = None
+            self._transferQueue = None
+
+        self._printSyncStat(True)
+        self._writeFileSystemStats()
+        print ""
+
+
+    def _syncElements(self, onlyIfRemoteExist, onlyIfLocalExist):
         for remotePath, localPath in self.syncElements.iteritems():
-            storedLocalFsState = StoredFileSystem(remotePath, localPath, self._internalFs.buildPath(self.settingsDirPath, Syncer.STORED_FS_DATA_DIR_NAME), self.maxWorkers > 1)
+            storedLocalFsState = StoredFileSystem(remotePath, localPath, self.stateDirPath, self.isMultiThreaded)
+            plan = SyncPlan(self.isMultiThreaded)
             try:
-                self._syncPath(remotePath, localPath, storedLocalFsState, onlyIfRemoteExist, onlyIfLocalExist)
-
-                if self.maxWorkers > 1:
-                    while self._getBusyWorkersCount() != 0:
-                        time.sleep(0.5)
+                self._remoteFs.beginSync(remotePath, storedLocalFsState.getStateFilePath(Syncer.REMOTE_STATE_FILE_SUFFIX), self.dryRun)
+                self._localFs.beginSync(localPath, None, self.dryRun)
+                self._syncPath(remotePath, localPath, storedLocalFsState, plan, onlyIfRemoteExist, onlyIfLocalExist)
+                self._waitForWorkers()
 
-                if self.lastSyncPathErrorCount.get() == 0:
-                    self._removeNonExistingDataFromStoredFs(storedLocalFsState, self._localFs)
+                if self.dryRun:
+                    self._writePlan(plan)
+                else:
+                    self._executePlan(plan, storedLocalFsState)
+                    if self.lastSyncPathErrorCount.get() == 0:
+                        self._removeNonExistingDataFromStoredFs(storedLocalFsState, self._localFs)
             except Exception, error:
                 self._writeLog("Error: can't sync '" + remotePath.encode('utf8') + "' and '" + localPath.encode('utf8') + "'", error)
+            finally:
+                storedLocalFsState.store()
+                self._remoteFs.endSync(remotePath)
+                self._localFs.endSync(localPath)
 
-        self._printSyncStat(True)
-        print ""
+
+    def _writeFileSystemStats(self):
+        for name, fileSystem in (("Remote", self._remoteFs), ("Local", self._localFs)):
+            stats = fileSystem.getStats()
+            if stats:
+                self._writeLog(name + " stats: " + ", ".join(key + ": " + str(value) for key, value in sorted(stats.iteritems())))
 
 
-    def _syncPath(self, remotePath, localPath, storedLocalFsState, onlyIfRemoteExist, onlyIfLocalExist):
+    def _syncPath(self, remotePath, localPath, storedLocalFsState, plan, onlyIfRemoteExist, onlyIfLocalExist):
         isRemoteExist = self._remoteFs.isExist(remotePath)
         isLocalExist  = self._localFs.isExist(localPath)
         self.lastSyncPathErrorCount.set(0);
+        self.isRemoteUnavailableLogged = False
 
         if isRemoteExist and isLocalExist:
             remoteFileElement = self._remoteFs.getFileSystemElement(remotePath)
@@ -88,17 +135,21 @@ class Syncer:
             if isRemoteFile != isLocalFile:
                 self._writeLog("Sync " + remotePath.encode('utf8') + " to " + localPath.encode('utf8') + " - can't sync file and folder")
             elif isRemoteFile:
-                self._syncFile(remotePath, localPath, remoteFileElement, localFileElement, storedLocalFsState, self._remoteFs, self._localFs)
+                self._planFile(remotePath, localPath, remoteFileElement, localFileElement, storedLocalFsState, plan, self._remoteFs, self._localFs)
             else: #dir
-                self._syncDir(remotePath, localPath, storedLocalFsState, self._remoteFs, self._localFs)
+                # moves are done before planning (dry run plans them as upload and delete)
+                if self.detectMoves and not self._remoteFs.isReadOnly() and not self.dryRun:
+                    self._syncMovedElements(remotePath, localPath, storedLocalFsState)
+                self._syncDir(remotePath, localPath, storedLocalFsState, plan, self._remoteFs, self._localFs)
 
         elif isRemoteExist == onlyIfRemoteExist and isLocalExist == onlyIfLocalExist:
-            self._initialSync(remotePath, localPath, isRemoteExist, isLocalExist, storedLocalFsState)
+            self._initialSync(remotePath, localPath, isRemoteExist, isLocalExist, storedLocalFsState, plan)
         else:
             self._writeLog("Sync ignored: root folder not exist. " + remotePath + " : " + str(isRemoteExist) + ". " + localPath + " : " + str(isLocalExist))
 
 
-    def _syncFile(self, remotePath, localPath, remoteFileElement, localFileElement, storedLocalFsState, remoteFs, localFs):
+    # Compare file with stored state and add operation, if any, to plan. Neither side is changed.
+    def _planFile(self, remotePath, localPath, remoteFileElement, localFileElement, storedLocalFsState, plan, remoteFs, localFs):
         self.processedFilesCount.inc()
 
         try:
@@ -115,55 +166,34 @@ class Syncer:
                     if remoteFileElement.size > self.maxFileSizeBytes:
                         self._writeLog("Sync file(ignored local, big remote size - " + str(remoteFileElement.size / 1024) + " KB): '" + remotePath.encode('utf8') + "' -> '" + localPath.encode('utf8') + "'")
                     elif not localFs.isReadOnly():
-                        self.updatedFilesCount.inc()
-                        content = remoteFs.readFile(remotePath)
-                        self._writeBackupFile(localPath)
-                        localFs.writeFile(localPath, content)
-                        storedLocalFsState.writeFile(localPath, content)
-                        self._writeLog("Sync file(write local): '" + remotePath.encode('utf8') + "' -> '" + localPath.encode('utf8') + "'")
+                        plan.add(SyncOperation(SyncOperation.COPY_TO_LOCAL, remotePath, localPath, False, remoteFileElement.size, "write local"))
                 elif needUpdateRemoteElement:
                     if localFileElement.size > self.maxFileSizeBytes:
                         self._writeLog("Sync file(ignored remote, big local size - " + str(localFileElement.size / 1024) + " KB): '" + localPath.encode('utf8') + "' -> '" + remotePath.encode('utf8') + "'")
                     elif not remoteFs.isReadOnly():
-                        self.updatedFilesCount.inc()
-                        content = localFs.readFile(localPath)
-                        remoteFs.writeFile(remotePath, content)
-                        storedLocalFsState.writeFile(localPath, content)
-                        self._writeLog("Sync file(write remote): '" + localPath.encode('utf8') + "' -> '" + remotePath.encode('utf8') + "'")
+                        plan.add(SyncOperation(SyncOperation.COPY_TO_REMOTE, remotePath, localPath, False, localFileElement.size, "write remote"))
 
             elif remoteFileElement != None: # and no local element
                 if storedFileElement != None:
                     if not remoteFs.isReadOnly():
-                        self.updatedFilesCount.inc()
-                        remoteFs.deleteFile(remotePath)
-                        self._writeLog("Sync file(delete remote): '" + remotePath.encode('utf8') + "'")
-                    storedLocalFsState.deleteFile(localPath)
+                        plan.add(SyncOperation(SyncOperation.DELETE_REMOTE, remotePath, localPath, False, remoteFileElement.size, "delete remote"))
+                    else:
+                        plan.add(SyncOperation(SyncOperation.FORGET, remotePath, localPath, False))
                 elif remoteFileElement.size > self.maxFileSizeBytes:
                     self._writeLog("Sync file(ignored create local, big remote size - " + str(remoteFileElement.size / 1024) + " KB): '" + remotePath.encode('utf8') + "' -> '" + localPath.encode('utf8') + "'")
                 elif not localFs.isReadOnly():
-                    self.updatedFilesCount.inc()
-                    content = remoteFs.readFile(remotePath)
-                    self._writeBackupFile(localPath)
-                    localFs.writeFile(localPath, content)
-                    storedLocalFsState.writeFile(localPath, content)
-                    self._writeLog("Sync file(create local): '" + remotePath.encode('utf8') + "' -> '" + localPath.encode('utf8') + "'")
+                    plan.add(SyncOperation(SyncOperation.COPY_TO_LOCAL, remotePath, localPath, False, remoteFileElement.size, "create local"))
 
             elif localFileElement != None: # and no remote element
                 if storedFileElement != None:
                     if not localFs.isReadOnly():
-                        self.updatedFilesCount.inc()
-                        self._writeBackupFile(localPath)
-                        localFs.deleteFile(localPath)
-                        self._writeLog("Sync file(delete local): '" + localPath.encode('utf8') + "'")
-                    storedLocalFsState.deleteFile(localPath)
+                        plan.add(SyncOperation(SyncOperation.DELETE_LOCAL, remotePath, localPath, False, localFileElement.size, "delete local"))
+                    else:
+                        plan.add(SyncOperation(SyncOperation.FORGET, remotePath, localPath, False))
                 elif localFileElement.size > self.maxFileSizeBytes:
                      self._writeLog("Sync file(ignored create remote, big local size - " + str(localFileElement.size / 1024) + " KB): '" + localPath.encode('utf8') + "' -> '" + remotePath.encode('utf8') + "'")
                 elif not remoteFs.isReadOnly():
-                    self.updatedFilesCount.inc()
-                    content = localFs.readFile(localPath)
-                    remoteFs.writeFile(remotePath, content)
-                    storedLocalFsState.writeFile(localPath, content)
-                    self._writeLog("Sync file(create remote): '" + localPath.encode('utf8') + "' -> '" + remotePath.encode('utf8') + "'")
+                    plan.add(SyncOperation(SyncOperation.COPY_TO_REMOTE, remotePath, localPath, False, localFileElement.size, "create remote"))
         except Exception, error:
             self.lastSyncPathErrorCount.inc()
             self._writeLog("Error: sync file: '" + localPath.encode('utf8') + "' <-> '" + remotePath.encode('utf8') + "'", error)
@@ -171,50 +201,374 @@ class Syncer:
         self._printSyncStat()
 
 
-    def _removeDoneWorker(self, future):
-        with self._lock:
-            self.activeWorkers.remove(future)
+    # Folders are created in planned order (parents first), then all other operations are run as independent units by
+    # worker threads, if available: transfers by transfer threads (smallest files first, if enabled), deletions by
+    # other threads at the same time. Stored state is saved once for each folder, when its last operation is done.
+    def _executePlan(self, plan, storedLocalFsState):
+        storedLocalFsState.setDeferredStore(True)
+        try:
+            metadataOperations = plan.getMetadataOperations()
+            self._executeCreateRemoteDirs([operation for operation in metadataOperations if operation.kind == SyncOperation.CREATE_REMOTE_DIR], storedLocalFsState)
+            for operation in metadataOperations:
+                if operation.kind == SyncOperation.CREATE_LOCAL_DIR:
+                    self._executeOperation(operation, storedLocalFsState, self._remoteFs, self._localFs)
+            storedLocalFsState.store()
+
+            operations = [operation for operation in metadataOperations if operation.kind not in (SyncOperation.CREATE_LOCAL_DIR, SyncOperation.CREATE_REMOTE_DIR)]
+            transferOperations = plan.getTransferOperations()
+            if self.smallFilesFirst:
+                transferOperations.sort(key = lambda operation: operation.size)
+            progress = FolderProgress(operations + transferOperations, self.isMultiThreaded)
+
+            # queued operations are started before the ones run by this thread
+            notQueuedOperations = []
+            for workQueue, queueOperations in ((self._transferQueue, transferOperations), (self._workQueue, operations)):
+                if workQueue == None:
+                    notQueuedOperations.extend(queueOperations)
+                    continue
+                for operation in queueOperations:
+                    workQueue.addWithPriority(operation.size if self.smallFilesFirst and operation.isTransfer() else 0,
+                                              self._executeWorkerOperation, operation, storedLocalFsState, progress)
+            for operation in notQueuedOperations:
+                self._executeOperation(operation, storedLocalFsState, self._remoteFs, self._localFs, progress)
+            self._waitForWorkers()
+        finally:
+            storedLocalFsState.setDeferredStore(False)
+            storedLocalFsState.store()
+
+
+    # Folders of each new remote tree are created with one batch of MKCOL requests.
+    def _executeCreateRemoteDirs(self, operations, storedLocalFsState):
+        trees = {}     # path elements of tree root -> operations, parents first
+        treeRoots = {} # path elements of folder -> path elements of its tree root
+        for operation in sorted(operations, key = lambda operation: len(PathOperations.splitPath(operation.remotePath))):
+            key = tuple(PathOperations.splitPath(operation.remotePath))
+            treeRoots[key] = treeRoots.get(key[:-1], key)
+            trees.setdefault(treeRoots[key], []).append(operation)
+
+        for root, treeOperations in sorted(trees.iteritems()):
+            if self._skipIfRemoteUnavailable(treeOperations[0].remotePath, self._remoteFs):
+                continue
+            try:
+                self._remoteFs.createDirs([operation.remotePath for operation in treeOperations])
+            except Exception, error:
+                self.lastSyncPathErrorCount.inc()
+                self._writeLog("Error: sync dir: '" + treeOperations[0].localPath.encode('utf8') + "' <-> '" + treeOperations[0].remotePath.encode('utf8') + "'", error)
+                continue
+            for operation in treeOperations:
+                self.updatedDirsCount.inc()
+                storedLocalFsState.createDir(operation.localPath)
+                self._writeLog(operation.getDescription())
 
 
-    def _addBusyWorker(self, future):
-        with self._lock:
-            self.activeWorkers.add(future)
+    # progress - FolderProgress of operations, stored state is saved after last operation of folder.
+    def _executeOperation(self, operation, storedLocalFsState, remoteFs, localFs, progress = None):
+        try:
+            self._executeOperationInternal(operation, storedLocalFsState, remoteFs, localFs)
+        finally:
+            self._completeOperation(operation, storedLocalFsState, progress)
 
 
-    def _getBusyWorkersCount(self):
-        with self._lock:
-            return len(self.activeWorkers)
+    def _completeOperation(self, operation, storedLocalFsState, progress):
+        if progress != None and progress.done(operation):
+            storedLocalFsState.store()
 
 
-    def _isInWorkerThread(self):
-        currentThread = threading.current_thread()
-        currentThreadIdent = currentThread.ident
+    def _executeOperationInternal(self, operation, storedLocalFsState, remoteFs, localFs):
+        if self._skipIfRemoteUnavailable(operation.remotePath, remoteFs):
+            return
+
+        try:
+            if operation.kind == SyncOperation.COPY_TO_LOCAL:
+                self.updatedFilesCount.inc()
+                self._writeBackupFile(operation.localPath)
+                size = self._copyFile(remoteFs, operation.remotePath, localFs, operation.localPath)
+                self._writeFileInfo(storedLocalFsState, operation.localPath, size)
+            elif operation.kind == SyncOperation.COPY_TO_REMOTE:
+                self.updatedFilesCount.inc()
+                size = self._copyFile(localFs, operation.localPath, remoteFs, operation.remotePath)
+                self._writeFileInfo(storedLocalFsState, operation.localPath, size)
+            elif operation.kind == SyncOperation.DELETE_REMOTE:
+                if operation.isDir:
+                    self.updatedDirsCount.inc()
+                    remoteFs.deleteDir(operation.remotePath)
+                else:
+                    self.updatedFilesCount.inc()
+                    remoteFs.deleteFile(operation.remotePath)
+            elif operation.kind == SyncOperation.DELETE_LOCAL:
+                if operation.isDir:
+                    self.updatedDirsCount.inc()
+                    self._writeBackupDir(operation.localPath)
+                    localFs.deleteDir(operation.localPath)
+                else:
+                    self.updatedFilesCount.inc()
+                    self._writeBackupFile(operation.localPath)
+                    localFs.deleteFile(operation.localPath)
+            elif operation.kind == SyncOperation.CREATE_LOCAL_DIR:
+                self.updatedDirsCount.inc()
+                localFs.createDir(operation.localPath)
+                storedLocalFsState.createDir(operation.localPath)
+
+            if operation.kind in (SyncOperation.DELETE_REMOTE, SyncOperation.DELETE_LOCAL, SyncOperation.FORGET):
+                if operation.isDir:
+                    storedLocalFsState.deleteDir(operation.localPath)
+                else:
+                    storedLocalFsState.deleteFile(operation.localPath)
+            if operation.kind != SyncOperation.FORGET:
+                self._writeLog(operation.getDescription())
+        except Exception, error:
+            self._writeOperationError(operation, error)
+
+        self._printSyncStat()
 
-        for t in self.executor._threads:
-            if t.ident == currentThreadIdent:
-                return True
-        return False
 
+    def _writeOperationError(self, operation, error):
+        self.lastSyncPathErrorCount.inc()
+        self._writeLog("Error: sync " + ("dir" if operation.isDir else "file") + ": '" + operation.localPath.encode('utf8') + "' <-> '" + operation.remotePath.encode('utf8') + "'", error)
 
-    def _syncDir(self, remotePath, localPath, storedLocalFsState, remoteFs, localFs, isRemoteExist = True, isLocalExist = True):
-        if self.maxWorkers > 1:
-            if self._getBusyWorkersCount() >= self.maxWorkers:
-                if self._isInWorkerThread():
-                    self._syncDirInternal(remotePath, localPath, storedLocalFsState, remoteFs, localFs, isRemoteExist, isLocalExist)
-                    return
-                else:
-                    while self._getBusyWorkersCount() >= self.maxWorkers:
-                        time.sleep(0.3)
 
-            future = self.executor.submit(self._syncDirInternal, remotePath, localPath, storedLocalFsState, remoteFs.clone(), localFs.clone(), isRemoteExist, isLocalExist)
-            self._addBusyWorker(future)
-            future.add_done_callback(self._removeDoneWorker)
+    # Work queue doesn't report errors: any error of queued operation is logged and counted here, and its folder is
+    # completed anyway.
+    def _executeWorkerOperation(self, operation, storedLocalFsState, progress):
+        try:
+            remoteFs, localFs = self._getWorkerFileSystems()
+            self._executeOperationInternal(operation, storedLocalFsState, remoteFs, localFs)
+        except Exception, error:
+            self._writeOperationError(operation, error)
+        finally:
+            self._completeOperation(operation, storedLocalFsState, progress)
+
+
+    # Worker thread runs all its operations with its own clones of file systems.
+    def _getWorkerFileSystems(self):
+        workerFileSystems = self._workerFileSystems
+        if not hasattr(workerFileSystems, "remoteFs"):
+            workerFileSystems.remoteFs = self._remoteFs.clone()
+            workerFileSystems.localFs = self._localFs.clone()
+        return workerFileSystems.remoteFs, workerFileSystems.localFs
+
+
+    # Dry run: planned operations are written to log instead of being executed.
+    def _writePlan(self, plan):
+        for operation in plan.getOperations():
+            if operation.kind != SyncOperation.FORGET:
+                self._writeLog("Dry run: " + operation.getDescription() + (", " + str(operation.size / 1024) + " KB" if operation.isTransfer() else ""))
+        self._writeLog("Dry run: " + plan.getSummary())
+
+
+    # Stream file content from one file system to another without loading entire file into memory.
+    # Return copied bytes count.
+    # Interrupted transfer is resumed from kept partial content while it makes progress.
+    def _copyFile(self, sourceFs, sourcePath, destinationFs, destinationPath):
+        resumesCount = 0
+        while True:
+            resumeInfo = destinationFs.getResumeInfo(destinationPath)
+            try:
+                stream = CountingReader(sourceFs.openFile(sourcePath, resumeInfo))
+                try:
+                    destinationFs.writeFile(destinationPath, stream)
+                finally:
+                    stream.close()
+                return getattr(stream, "offset", 0) + stream.bytesCount
+            except Exception, error:
+                newResumeInfo = destinationFs.getResumeInfo(destinationPath)
+                if resumesCount >= Syncer.MAX_TRANSFER_RESUMES or newResumeInfo == None or \
+                        (resumeInfo != None and newResumeInfo.offset <= resumeInfo.offset):
+                    raise error
+                resumesCount += 1
+                self._writeLog("Resume transfer from " + str(newResumeInfo.offset / 1024) + " KB: '" + sourcePath.encode('utf8') + "' -> '" + destinationPath.encode('utf8') + "'")
+
+
+    def _writeFileInfo(self, storedLocalFsState, localPath, size):
+        fingerprint = self._internalFs.getFingerprint(localPath) if self.detectMoves else None
+        storedLocalFsState.writeFileInfo(localPath, size, fingerprint)
+
+
+    # Local renames, moves and copies of synced elements are done on server with one MOVE (COPY) request instead of
+    # upload of new elements and delete of old ones. Folders are matched by names and sizes of all elements below them
+    # (files must be unchanged since last sync), files - by size and content fingerprint stored at last sync.
+    def _syncMovedElements(self, remotePath, localPath, storedLocalFsState):
+        localElements = {} # path -> FileSystemElement
+        self._collectLocalElements(localPath, localElements)
+        storedPaths = set(path for path in storedLocalFsState.getAllElements() if PathOperations.isSubPath(localPath, path))
+        newPaths = set(path for path in localElements if path not in storedPaths)
+        vanishedPaths = storedPaths.difference(localElements)
+
+        vanishedDirs = {} # path -> signature
+        for path in vanishedPaths:
+            if not storedLocalFsState.isFile(path) and os.path.dirname(path) not in vanishedPaths:
+                vanishedDirs[path] = self._getTreeSignature(path, storedPaths, storedLocalFsState.getFileSystemElement)
+        for path in sorted(newPaths):
+            if path not in newPaths or not localElements[path].isDir or os.path.dirname(path) in newPaths:
+                continue
+            signature = self._getTreeSignature(path, localElements, localElements.get)
+            for sourcePath, sourceSignature in vanishedDirs.items():
+                if signature and signature == sourceSignature and self._isTreeUnchanged(sourcePath, path, localElements, storedLocalFsState) and \
+                        self._moveRemoteElement(remotePath, localPath, sourcePath, path, False, storedLocalFsState):
+                    del vanishedDirs[sourcePath]
+                    for movedPath in list(newPaths):
+                        if movedPath == path or PathOperations.isSubPath(path, movedPath):
+                            newPaths.remove(movedPath)
+                    break
+
+        filesBySize = {} # size -> list of stored paths of files with fingerprint
+        for path in storedPaths:
+            element = storedLocalFsState.getFileSystemElement(path)
+            if storedLocalFsState.getFingerprint(path) != None:
+                filesBySize.setdefault(element.size, []).append(path)
+        for path in sorted(newPaths):
+            element = localElements[path]
+            if element.isDir or element.isLocked or element.size not in filesBySize:
+                continue
+            fingerprint = self._internalFs.getFingerprint(path)
+            for sourcePath in filesBySize[element.size]:
+                if storedLocalFsState.getFingerprint(sourcePath) != fingerprint:
+                    continue
+                if sourcePath in vanishedPaths:
+                    if self._moveRemoteElement(remotePath, localPath, sourcePath, path, False, storedLocalFsState):
+                        vanishedPaths.remove(sourcePath)
+                        filesBySize[element.size].remove(sourcePath)
+                        break
+                elif sourcePath in localElements and self._isUnchanged(localElements[sourcePath], storedLocalFsState.getFileSystemElement(sourcePath)):
+                    if self._moveRemoteElement(remotePath, localPath, sourcePath, path, True, storedLocalFsState):
+                        break
+
+
+    # Return True if remote element was moved (copied if 'keepSource').
+    def _moveRemoteElement(self, remotePath, localPath, localSourcePath, localDestinationPath, keepSource, storedLocalFsState):
+        sourcePath = self._getRemotePath(remotePath, localPath, localSourcePath)
+        destinationPath = self._getRemotePath(remotePath, localPath, localDestinationPath)
+        storedElement = storedLocalFsState.getFileSystemElement(localSourcePath)
+        try:
+            # elements are taken from parent folder listings, which are cached and needed for sync anyway
+            sourceElement = self._listDir(self._remoteFs, self._getRemotePath(remotePath, localPath, os.path.dirname(localSourcePath))).get(
+                PathOperations.getPathLastElement(sourcePath))
+            if sourceElement is None or sourceElement.isDir != storedElement.isDir:
+                return False
+            localDestinationDirPath = os.path.dirname(localDestinationPath)
+            if self._isSyncedDir(localPath, localDestinationDirPath, storedLocalFsState):
+                destinationElements = self._listDir(self._remoteFs, self._getRemotePath(remotePath, localPath, localDestinationDirPath))
+                if PathOperations.getPathLastElement(destinationPath) in destinationElements:
+                    return False
+            if not sourceElement.isDir and not self._isUnchanged(sourceElement, storedElement): # remote file was changed after last sync
+                return False
+            self._createRemoteDirs(remotePath, localPath, localDestinationDirPath, storedLocalFsState)
+            if keepSource:
+                self._remoteFs.copyElement(sourcePath, destinationPath)
+            else:
+                self._remoteFs.moveElement(sourcePath, destinationPath)
+        except Exception, error:
+            self._writeLog("Error: can't move remote '" + sourcePath.encode('utf8') + "' to '" + destinationPath.encode('utf8') + "'", error)
+            return False
+
+        storedLocalFsState.moveElement(localSourcePath, localDestinationPath, keepSource)
+        if storedElement.isDir:
+            self.updatedDirsCount.inc()
+        else:
+            self.updatedFilesCount.inc()
+        self._writeLog("Sync " + ("file" if not storedElement.isDir else "dir") + " (" + ("copy" if keepSource else "move") + " remote): '" + \
+                       sourcePath.encode('utf8') + "' -> '" + destinationPath.encode('utf8') + "'")
+        return True
+
+
+    # Create new local folder (and its new parents) on remote side before element is moved into it.
+    def _createRemoteDirs(self, remotePath, localPath, localDirPath, storedLocalFsState):
+        if self._isSyncedDir(localPath, localDirPath, storedLocalFsState):
+            return
+        self._createRemoteDirs(remotePath, localPath, os.path.dirname(localDirPath), storedLocalFsState)
+        dirPath = self._getRemotePath(remotePath, localPath, localDirPath)
+        self._remoteFs.createDir(dirPath)
+        storedLocalFsState.createDir(localDirPath)
+        self.updatedDirsCount.inc()
+        self._writeLog("Sync dir (create remote): '" + dirPath.encode('utf8') + "'")
+
+
+    def _isSyncedDir(self, localPath, localDirPath, storedLocalFsState):
+        return PathOperations.comparePath(localPath, localDirPath) or storedLocalFsState.isExist(localDirPath)
+
+
+    def _collectLocalElements(self, dirPath, elements):
+        for element in self._localFs.list(dirPath):
+            path = self._localFs.buildPath(dirPath, element.name)
+            elements[path] = element
+            if element.isDir and not element.isLocked:
+                self._collectLocalElements(path, elements)
+
+
+    # Return set of (relative path, is dir, size) of all elements below 'dirPath'.
+    def _getTreeSignature(self, dirPath, paths, getElement):
+        signature = set()
+        for path in paths:
+            if PathOperations.isSubPath(dirPath, path):
+                element = getElement(path)
+                signature.add((path[len(dirPath):], element.isDir, 0 if element.isDir else element.size))
+        return signature
+
+
+    def _isTreeUnchanged(self, storedDirPath, localDirPath, localElements, storedLocalFsState):
+        for path, element in localElements.iteritems():
+            if not element.isDir and PathOperations.isSubPath(localDirPath, path):
+                storedElement = storedLocalFsState.getFileSystemElement(storedDirPath + path[len(localDirPath):])
+                if not self._isUnchanged(element, storedElement):
+                    return False
+        return True
+
+
+    def _isUnchanged(self, element, storedElement):
+        return storedElement is not None and not element.isLocked and element.size == storedElement.size and \
+            element.lastModifiedTimeGMT <= storedElement.lastModifiedTimeGMT
+
+
+    def _getRemotePath(self, remotePath, localPath, localElementPath):
+        path = remotePath
+        for name in PathOperations.splitPath(localElementPath)[len(PathOperations.splitPath(localPath)):]:
+            path = self._remoteFs.buildPath(path, name)
+        return path
+
+
+    # Remaining elements of sync element are skipped without requests while server is unreachable (circuit breaker is open).
+    # Skipped element is counted as error, so stored state is kept as is and element is synced on next run.
+    def _skipIfRemoteUnavailable(self, remotePath, remoteFs):
+        if remoteFs.isAvailable():
+            return False
+        self.lastSyncPathErrorCount.inc()
+        with self._lock:
+            isLogged = self.isRemoteUnavailableLogged
+            self.isRemoteUnavailableLogged = True
+        if not isLogged:
+            self._writeLog("Error: server unreachable, skip remaining elements from: '" + remotePath.encode('utf8') + "'")
+        return True
+
+
+    # Wait until all queued folders and operations are done.
+    def _waitForWorkers(self):
+        for workQueue in (self._workQueue, self._transferQueue):
+            if workQueue != None:
+                workQueue.join()
+
+
+    # Folder is queued for a free worker, so subfolders found by one worker are synced by all of them.
+    def _syncDir(self, remotePath, localPath, storedLocalFsState, plan, remoteFs, localFs, isRemoteExist = True, isLocalExist = True):
+        if self._workQueue != None:
+            self._workQueue.add(self._syncWorkerDir, remotePath, localPath, storedLocalFsState, plan, isRemoteExist, isLocalExist)
         else:
-            self._syncDirInternal(remotePath, localPath, storedLocalFsState, remoteFs, localFs, isRemoteExist, isLocalExist)
+            self._syncDirInternal(remotePath, localPath, storedLocalFsState, plan, remoteFs, localFs, isRemoteExist, isLocalExist)
 
 
-    def _syncDirInternal(self, remotePath, localPath, storedLocalFsState, remoteFs, localFs, isRemoteExist = True, isLocalExist = True):
+    # Any error of queued folder is logged and counted here, work queue doesn't report errors.
+    def _syncWorkerDir(self, remotePath, localPath, storedLocalFsState, plan, isRemoteExist, isLocalExist):
+        try:
+            remoteFs, localFs = self._getWorkerFileSystems()
+            self._syncDirInternal(remotePath, localPath, storedLocalFsState, plan, remoteFs, localFs, isRemoteExist, isLocalExist)
+        except Exception, error:
+            self._writeDirError(remotePath, localPath, error)
+
+
+    # List folder on both sides and plan operations for its elements. Listing of folder planned to be created is empty.
+    def _syncDirInternal(self, remotePath, localPath, storedLocalFsState, plan, remoteFs, localFs, isRemoteExist = True, isLocalExist = True):
         self.processedDirsCount.inc()
+        if self._skipIfRemoteUnavailable(remotePath, remoteFs):
+            return
 
         try:
             needSync = True;
@@ -224,48 +578,45 @@ class Syncer:
             elif not isRemoteExist:
                 if storedLocalFsState.isExist(localPath) and not storedLocalFsState.isFile(localPath):
                     if not localFs.isReadOnly():
-                        self.updatedDirsCount.inc()
-                        self._writeBackupDir(localPath)
-                        localFs.deleteDir(localPath)
-                        self._writeLog("Sync dir (delete local): '" + localPath.encode('utf8') + "'")
-                    storedLocalFsState.deleteDir(localPath)
+                        plan.add(SyncOperation(SyncOperation.DELETE_LOCAL, remotePath, localPath, True, title = "delete local"))
+                    else:
+                        plan.add(SyncOperation(SyncOperation.FORGET, remotePath, localPath, True))
                     needSync = False
                 elif not remoteFs.isReadOnly():
-                    self.updatedDirsCount.inc()
-                    remoteFs.createDir(remotePath)
-                    storedLocalFsState.createDir(localPath)
-                    self._writeLog("Sync dir (create remote): '" + remotePath.encode('utf8') + "'")
+                    plan.add(SyncOperation(SyncOperation.CREATE_REMOTE_DIR, remotePath, localPath, True, title = "create remote"))
                 else:
                     needSync = False
             elif not isLocalExist:
                 if storedLocalFsState.isExist(localPath) and not storedLocalFsState.isFile(localPath):
                     if not remoteFs.isReadOnly():
-                        self.updatedDirsCount.inc()
-                        remoteFs.deleteDir(remotePath)
-                        self._writeLog("Sync dir (delete remote): '" + remotePath.encode('utf8') + "'")
-                    storedLocalFsState.deleteDir(localPath)
+                        plan.add(SyncOperation(SyncOperation.DELETE_REMOTE, remotePath, localPath, True, title = "delete remote"))
+                    else:
+                        plan.add(SyncOperation(SyncOperation.FORGET, remotePath, localPath, True))
                     needSync = False
                 elif not localFs.isReadOnly():
-                    self.updatedDirsCount.inc()
-                    localFs.createDir(localPath)
-                    storedLocalFsState.createDir(localPath)
-                    self._writeLog("Sync dir (create local): '" + localPath.encode('utf8') + "'")
+                    plan.add(SyncOperation(SyncOperation.CREATE_LOCAL_DIR, remotePath, localPath, True, title = "create local"))
                 else:
                     needSync = False
 
             if needSync:
-                remoteElements = self._listDir(remoteFs, remotePath)
-                localElements = self._listDir(localFs, localPath)
-                localElements = self._syncTwoElementsLists(remotePath, localPath, remoteElements, localElements, True, storedLocalFsState, remoteFs, localFs)
-                self._syncTwoElementsLists(remotePath, localPath, remoteElements, localElements, False, storedLocalFsState,  remoteFs, localFs)
+                remoteElements = {} if plan.isNewDir(remotePath, True) else self._listDir(remoteFs, remotePath)
+                localElements = {} if plan.isNewDir(localPath, False) else self._listDir(localFs, localPath)
+                remoteFs.prefetchLists([remoteFs.buildPath(remotePath, name) for name, element in remoteElements.iteritems()
+                                        if element.isDir and name in localElements and localElements[name].isDir])
+                localElements = self._syncTwoElementsLists(remotePath, localPath, remoteElements, localElements, True, storedLocalFsState, plan, remoteFs, localFs)
+                self._syncTwoElementsLists(remotePath, localPath, remoteElements, localElements, False, storedLocalFsState, plan, remoteFs, localFs)
         except Exception, error:
-            self.lastSyncPathErrorCount.inc()
-            self._writeLog("Error: sync dir: '" + localPath.encode('utf8') + "' <-> '" + remotePath.encode('utf8') + "'", error)
+            self._writeDirError(remotePath, localPath, error)
 
         self._printSyncStat()
 
 
-    def _syncTwoElementsLists(self, remotePath, localPath, remoteElements, localElements, iterateOnRemoteElements, storedLocalFsState, remoteFs, localFs):
+    def _writeDirError(self, remotePath, localPath, error):
+        self.lastSyncPathErrorCount.inc()
+        self._writeLog("Error: sync dir: '" + localPath.encode('utf8') + "' <-> '" + remotePath.encode('utf8') + "'", error)
+
+
+    def _syncTwoElementsLists(self, remotePath, localPath, remoteElements, localElements, iterateOnRemoteElements, storedLocalFsState, plan, remoteFs, localFs):
         if iterateOnRemoteElements:
             rElements = remoteElements
             lElements = localElements
@@ -306,14 +657,14 @@ class Syncer:
 
             if needSyncFile:
                 if iterateOnRemoteElements:
-                    self._syncFile(rElementPath, lElementPath, rElement, lElement, storedLocalFsState, remoteFs, localFs)
+                    self._planFile(rElementPath, lElementPath, rElement, lElement, storedLocalFsState, plan, remoteFs, localFs)
                 else:
-                    self._syncFile(lElementPath, rElementPath, lElement, rElement, storedLocalFsState, remoteFs, localFs)
+                    self._planFile(lElementPath, rElementPath, lElement, rElement, storedLocalFsState, plan, remoteFs, localFs)
             elif needSyncDir:
                 if iterateOnRemoteElements:
-                    self._syncDir(rElementPath, lElementPath, storedLocalFsState, remoteFs, localFs, True, lElement != None)
+                    self._syncDir(rElementPath, lElementPath, storedLocalFsState, plan, remoteFs, localFs, True, lElement != None)
                 else:
-                    self._syncDir(lElementPath, rElementPath, storedLocalFsState, remoteFs, localFs, lElement != None, True)
+                    self._syncDir(lElementPath, rElementPath, storedLocalFsState, plan, remoteFs, localFs, lElement != None, True)
 
         return lElements
 
@@ -326,45 +677,28 @@ class Syncer:
         return elementsDict
 
 
-    def _initialSync(self, remotePath, localPath, isRemoteExist, isLocalExist, storedLocalFsState):
-        firstFs = None
-        secondFs = None
+    def _initialSync(self, remotePath, localPath, isRemoteExist, isLocalExist, storedLocalFsState, plan):
         if isRemoteExist and not isLocalExist:
-            firstFs    = self._remoteFs
-            firstPath  = remotePath
-            secondFs   = self._localFs
-            secondPath = localPath;
+            if self._remoteFs.isFile(remotePath):
+                plan.add(SyncOperation(SyncOperation.COPY_TO_LOCAL, remotePath, localPath, False, self._remoteFs.getFileSystemElement(remotePath).size, "initial sync"))
+            else:
+                plan.add(SyncOperation(SyncOperation.CREATE_LOCAL_DIR, remotePath, localPath, True, title = "initial sync"))
+                self._syncDir(remotePath, localPath, storedLocalFsState, plan, self._remoteFs, self._localFs)
         elif isLocalExist and not isRemoteExist:
-            firstFs    = self._localFs
-            firstPath  = localPath
-            secondFs   = self._remoteFs
-            secondPath = remotePath;
-        else:
-            self._localFs.createDir(localPath)
-            storedLocalFsState.createDir(localPath)
-            self._remoteFs.createDir(remotePath)
-            self._writeLog("Sync dir (create local and remote): '" + localPath.encode('utf8') + "' and '" + remotePath.encode('utf8') + "'")
-
-        if firstFs != None and secondFs != None:
-            if firstFs.isFile(firstPath):
-                self.updatedFilesCount.inc()
-                fileContent = firstFs.readFile(firstPath)
-                secondFs.writeFile(secondPath, fileContent)
-                storedLocalFsState.writeFile(localPath, fileContent)
-                self._writeLog("Sync file(initial sync): '" + localPath.encode('utf8') + "' <-> '" + remotePath.encode('utf8') + "'")
+            if self._localFs.isFile(localPath):
+                plan.add(SyncOperation(SyncOperation.COPY_TO_REMOTE, remotePath, localPath, False, self._localFs.getFileSystemElement(localPath).size, "initial sync"))
             else:
-                if not secondFs.isExist(secondPath):
-                    self.updatedDirsCount.inc()
-                    secondFs.createDir(secondPath)
-                    storedLocalFsState.createDir(localPath)
-                    self._writeLog("Sync dir (initial sync): '" + localPath.encode('utf8') + "' <-> '" + remotePath.encode('utf8') + "'")
-                self._syncDir(remotePath, localPath, storedLocalFsState, self._remoteFs, self._localFs)
+                plan.add(SyncOperation(SyncOperation.CREATE_REMOTE_DIR, remotePath, localPath, True, title = "initial sync"))
+                self._syncDir(remotePath, localPath, storedLocalFsState, plan, self._remoteFs, self._localFs)
+        else:
+            plan.add(SyncOperation(SyncOperation.CREATE_LOCAL_DIR, remotePath, localPath, True, title = "create local"))
+            plan.add(SyncOperation(SyncOperation.CREATE_REMOTE_DIR, remotePath, localPath, True, title = "create remote"))
 
 
     def _writeLog(self, log, exception = None):
         if self.logFilePath != None and self.logFilePath != '':
-            with open(self.logFilePath, "a") as logFile:
-                with self._lock:
+            with Syncer.LOG_LOCK:
+                with open(self.logFilePath, "a") as logFile:
                     logFile.write(log + "\n")
                     if exception != None:
                         logFile.write("Exception: " + str(exception) + "\n")
@@ -376,7 +710,7 @@ class Syncer:
             backupFilePath = self._internalFs.buildPath(self.backupDirPath, backupFileName)
             try:
                 if self._internalFs.isExist(backupLocalPath): # Support backup only local files.
-                    self._internalFs.writeFile(backupFilePath, self._internalFs.readFile(backupLocalPath))
+                    self._copyFile(self._internalFs, backupLocalPath, self._internalFs, backupFilePath)
             except Exception, error:
                 self._writeLog("Error: can't backup file: '" + backupLocalPath.encode('utf8') + "' to '" + backupFilePath.encode('utf8') + "'", error)
 
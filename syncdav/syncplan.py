@@ -0,0 +1,119 @@
+from __future__ import with_statement
+from common import PathOperations, DummyLock
+import os, threading
+
+
+# One change of sync plan. 'size' - bytes to transfer (copy operations) or to delete (files).
+class SyncOperation:
+    COPY_TO_LOCAL     = "copy to local"
+    COPY_TO_REMOTE    = "copy to remote"
+    DELETE_LOCAL      = "delete local"
+    DELETE_REMOTE     = "delete remote"
+    FORGET            = "forget"         # element deleted on other, read-only side: only stored state is updated
+    CREATE_LOCAL_DIR  = "create local dir"
+    CREATE_REMOTE_DIR = "create remote dir"
+
+    TRANSFER_KINDS = (COPY_TO_LOCAL, COPY_TO_REMOTE)
+
+    # title - shown in log, e.g. "write local" or "create local".
+    def __init__(self, kind, remotePath, localPath, isDir, size = 0, title = None):
+        self.kind = kind
+        self.remotePath = remotePath
+        self.localPath = localPath
+        self.isDir = isDir
+        self.size = size
+        self.title = title if title != None else kind
+
+
+    def isTransfer(self):
+        return self.kind in SyncOperation.TRANSFER_KINDS
+
+
+    def getDescription(self):
+        if self.kind == SyncOperation.COPY_TO_LOCAL:
+            paths = "'" + self.remotePath.encode('utf8') + "' -> '" + self.localPath.encode('utf8') + "'"
+        elif self.kind == SyncOperation.COPY_TO_REMOTE:
+            paths = "'" + self.localPath.encode('utf8') + "' -> '" + self.remotePath.encode('utf8') + "'"
+        elif self.kind in (SyncOperation.DELETE_REMOTE, SyncOperation.CREATE_REMOTE_DIR):
+            paths = "'" + self.remotePath.encode('utf8') + "'"
+        else:
+            paths = "'" + self.localPath.encode('utf8') + "'"
+        return ("Sync dir (" if self.isDir else "Sync file(") + self.title + "): " + paths
+#end class SyncOperation
+
+
+# Operations of one sync path in order they were planned: parent folders are created before their children.
+# Paths of planned new folders are kept, so their listings are known to be empty without asking file system.
+class SyncPlan:
+    def __init__(self, threadSafe = True):
+        self._lock = threading.Lock() if threadSafe else DummyLock()
+        self._operations = []
+        self._newDirs = set() # (isRemote, path elements)
+
+
+    def add(self, operation):
+        with self._lock:
+            self._operations.append(operation)
+            if operation.kind == SyncOperation.CREATE_LOCAL_DIR:
+                self._newDirs.add((False, tuple(PathOperations.splitPath(operation.localPath))))
+            elif operation.kind == SyncOperation.CREATE_REMOTE_DIR:
+                self._newDirs.add((True, tuple(PathOperations.splitPath(operation.remotePath))))
+
+
+    def isNewDir(self, path, isRemote):
+        with self._lock:
+            return (isRemote, tuple(PathOperations.splitPath(path))) in self._newDirs
+
+
+    def getOperations(self):
+        with self._lock:
+            return list(self._operations)
+
+
+    # Folder creations, deletions and forgotten elements: operations without transfer of file contents.
+    def getMetadataOperations(self):
+        return [operation for operation in self.getOperations() if not operation.isTransfer()]
+
+
+    def getTransferOperations(self):
+        return [operation for operation in self.getOperations() if operation.isTransfer()]
+
+
+    def getSummary(self):
+        counts = dict.fromkeys((SyncOperation.COPY_TO_LOCAL, SyncOperation.COPY_TO_REMOTE, SyncOperation.DELETE_LOCAL, SyncOperation.DELETE_REMOTE), 0)
+        sizes = dict(counts)
+        dirsCount = 0
+        for operation in self.getOperations():
+            if operation.isDir:
+                if operation.kind != SyncOperation.FORGET:
+                    dirsCount += 1
+            elif operation.kind in counts:
+                counts[operation.kind] += 1
+                sizes[operation.kind] += operation.size
+        return "download " + str(counts[SyncOperation.COPY_TO_LOCAL]) + " files (" + str(sizes[SyncOperation.COPY_TO_LOCAL] / 1024) + " KB), " + \
+            "upload " + str(counts[SyncOperation.COPY_TO_REMOTE]) + " files (" + str(sizes[SyncOperation.COPY_TO_REMOTE] / 1024) + " KB), " + \
+            "delete " + str(counts[SyncOperation.DELETE_LOCAL]) + " local and " + str(counts[SyncOperation.DELETE_REMOTE]) + " remote files, " + \
+            "create or delete " + str(dirsCount) + " folders"
+#end class SyncPlan
+
+
+# Numbers of not finished operations of each local folder, tells when the last element of a folder is done.
+class FolderProgress:
+    def __init__(self, operations, threadSafe = True):
+        self._lock = threading.Lock() if threadSafe else DummyLock()
+        self._pendingCounts = {} # local folder path -> count
+        for operation in operations:
+            folderPath = os.path.dirname(operation.localPath)
+            self._pendingCounts[folderPath] = self._pendingCounts.get(folderPath, 0) + 1
+
+
+    # Return True if it was the last operation in its folder.
+    def done(self, operation):
+        folderPath = os.path.dirname(operation.localPath)
+        with self._lock:
+            self._pendingCounts[folderPath] -= 1
+            if self._pendingCounts[folderPath] > 0:
+                return False
+            del self._pendingCounts[folderPath]
+            return True
+#end class FolderProgress
@@ -17,6 +17,8 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """The tinydav WebDAV client."""
 from __future__ import with_statement
+import copy
+import socket
 import sys
 import time
 
@@ -25,9 +27,8 @@ PYTHON2_7 = (sys.version_info >= (2, 7))
 PYTHON2 = ((2, 5) <= sys.version_info <= (3, 0))
 PYTHON3 = (sys.version_info >= (3, 0))
 
-from contextlib import closing
 from email.header import Header
-from functools import wraps, partial
+from functools import partial
 
 if PYTHON2:
     from httplib import MULTI_STATUS, OK, CONFLICT, NO_CONTENT, UNAUTHORIZED, CREATED
@@ -62,14 +63,22 @@ else:
 
 from tinydav import creator, util
 from tinydav.exception import HTTPError, HTTPUserError, HTTPServerError
+from tinydav.exception import CircuitOpenError
+from tinydav.pool import ConnectionPool
+from tinydav.retry import RetryPolicy
+from tinydav.timeout import TimeoutPolicy
+from tinydav.limiter import ConcurrencyLimiter
+from tinydav.breaker import CircuitBreaker
+from tinydav.tls import TLSPolicy
 
 __author__ = "Manuel Hermann <manuel-hermann@gmx.net>"
 __license__ = "LGPL"
 __version__ = "0.7.5"
 
 __all__ = (
-    "HTTPError", "HTTPUserError", "HTTPServerError",
-    "HTTPClient", "WebDAVClient",
+    "HTTPError", "HTTPUserError", "HTTPServerError", "CircuitOpenError",
+    "HTTPClient", "WebDAVClient", "ConnectionPool", "RetryPolicy",
+    "TimeoutPolicy", "ConcurrencyLimiter", "CircuitBreaker", "TLSPolicy",
 )
 
 # RFC 2518, 9.8 Timeout Request Header
@@ -97,6 +106,21 @@ SCHEME_MAP = {
 default_header_encoding = "utf-8"
 separate_query_sequences = True
 
+# send file-like request bodies in blocks of this size
+DEFAULT_BLOCKSIZE = 64 * 1024
+CRLF = "\r\n".encode("ascii")
+EMPTY = "".encode("ascii")
+
+# methods the server is asked to compress the response for, when
+# HTTPClient.accept_encoding is set
+COMPRESSIBLE_METHODS = frozenset(("GET", "PROPFIND", "REPORT"))
+
+# RFC 7230, 6.3.2 Pipelining
+# A user agent SHOULD NOT pipeline requests after a non-idempotent method,
+# until the final response status code for that method has been received.
+# Only safe methods are pipelined, so unanswered requests can be sent again.
+PIPELINE_METHODS = frozenset(("GET", "HEAD", "OPTIONS", "PROPFIND", "REPORT"))
+
 
 # Responses
 class HTTPResponse(int):
@@ -109,28 +133,62 @@ class HTTPResponse(int):
 
     response -- The original httplib.HTTPResponse object.
     headers -- A dictionary with the received headers.
-    content -- The content of the response as string.
+    content -- The content of the response as string. None for streamed
+               responses.
     statusline -- The received HTTP status line. E.g. "HTTP/1.1 200 OK".
+    content_encoding -- The gzip or deflate content-coding the body was
+                        decoded from or None.
+    wire_bytes -- Number of body bytes received so far.
+    decoded_bytes -- Number of body bytes after decoding so far.
+
+    Streamed responses don't read the body on initialization. Read it with
+    the read or iter_content method and close the response afterwards.
+
+    A gzip or deflate encoded body is decoded transparently, content and
+    read return the decoded data.
 
     """
 
-    def __new__(cls, response):
+    def __new__(cls, response, stream=False):
         """Construct HTTPResponse.
 
         response -- The original httplib.HTTPResponse object.
+        stream -- If True, the body of a 2xx response is not read.
 
         """
         return int.__new__(cls, response.status)
 
-    def __init__(self, response):
+    def __init__(self, response, stream=False):
         """Initialize the HTTPResponse.
 
         response -- The original httplib.HTTPResponse object. 
+        stream -- If True, the body of a 2xx response is not read. Error
+                  responses are always read completely.
 
         """
         self.response = response
         self.headers = dict(response.getheaders())
-        self.content = response.read()
+        self.is_stream = stream and (200 <= response.status < 300)
+        # callback that gives the connection back, when a stream is done
+        self._release = None
+        # TransferStats the streamed body is accounted in, when it's done
+        self._transferstats = None
+        # TimeoutPolicy the streamed body is measured for, when it's done
+        self._timeoutpolicy = None
+        self._received = time.time()
+        self._decoder = util.ContentDecoder.create(
+            self.headers.get("content-encoding"))
+        self.content_encoding = None
+        if self._decoder is not None:
+            self.content_encoding = self._decoder.encoding
+        self.wire_bytes = 0
+        self.decoded_bytes = 0
+        self._buffer = EMPTY
+        self._eof = False
+        if self.is_stream:
+            self.content = None
+        else:
+            self.content = self._decode(response.read(), True)
         version = "HTTP/%s.%s" % tuple(str(response.version))
         self.statusline = "%s %d %s"\
                         % (version, response.status, response.reason)
@@ -148,6 +206,84 @@ class HTTPResponse(int):
         """Return string representation."""
         return self.statusline
 
+    def read(self, amt=None):
+        """Read and return up to amt bytes of a streamed response body.
+
+        Return an empty string when the body is exhausted.
+
+        amt -- Maximum number of bytes to read. Read everything, if None.
+
+        """
+        while not self._eof and ((amt is None) or (len(self._buffer) < amt)):
+            data = self.response.read(amt)
+            eof = self.response.isclosed() or not data
+            self._buffer += self._decode(data, eof)
+            if eof:
+                self._eof = True
+                self._finish(True)
+            elif self._decoder is None:
+                break
+        if amt is None:
+            (data, self._buffer) = (self._buffer, EMPTY)
+        else:
+            (data, self._buffer) = (self._buffer[:amt], self._buffer[amt:])
+        return data
+
+    def iter_content(self, chunk_size=65536):
+        """Iterate over the streamed response body in chunks.
+
+        chunk_size -- Maximum size of each chunk in bytes.
+
+        """
+        while True:
+            data = self.read(chunk_size)
+            if not data:
+                break
+            yield data
+
+    def close(self):
+        """Close the response and release its connection.
+
+        A connection of a not completely read stream can't be used for
+        further requests and gets closed.
+
+        """
+        if self._release is not None:
+            reusable = self.response.isclosed()
+            self.response.close()
+            self._finish(reusable)
+
+    def _finish(self, reusable):
+        """Give the connection of a streamed response back."""
+        release = self._release
+        self._release = None
+        if release is not None:
+            release(reusable and not self.response.will_close)
+        transferstats = self._transferstats
+        self._transferstats = None
+        if transferstats is not None:
+            transferstats.add(self)
+        timeoutpolicy = self._timeoutpolicy
+        self._timeoutpolicy = None
+        if timeoutpolicy is not None:
+            timeoutpolicy.addtransfer(self.wire_bytes,
+                                      time.time() - self._received)
+
+    def _decode(self, data, final):
+        """Return decoded data and account received bytes.
+
+        data -- The next part of the body as received.
+        final -- True, if data is the last part of the body.
+
+        """
+        self.wire_bytes += len(data)
+        if self._decoder is not None:
+            data = self._decoder.decompress(data)
+            if final:
+                data += self._decoder.flush()
+        self.decoded_bytes += len(data)
+        return data
+
     def _setauth(self):
         value = self.headers.get("www-authenticate", "")
         auth = util.parse_authenticate(value)
@@ -187,19 +323,23 @@ class WebDAVResponse(HTTPResponse):
     responses. The length will then be the number of results in the
     multi-status.
 
+    The body of a streamed multi-status response is not parsed on
+    initialization. Use iter_entries to parse it incrementally.
+
     """
-    def __init__(self, response):
+    def __init__(self, response, stream=False):
         """Initialize the WebDAVResponse.
 
         response -- The original httplib.HTTPResponse object. 
+        stream -- If True, the body of a 2xx response is not read.
 
         """
-        super(WebDAVResponse, self).__init__(response)
+        super(WebDAVResponse, self).__init__(response, stream)
         self._etree = ElementTree()
         # on XML parsing error set this to the raised exception
         self.parse_error = None
         self.is_multistatus = False
-        if (self == MULTI_STATUS):
+        if (self == MULTI_STATUS) and not self.is_stream:
             self._set_multistatus()
 
     def __len__(self):
@@ -230,6 +370,33 @@ class WebDAVResponse(HTTPResponse):
         else:
             yield self
 
+    def iter_entries(self, extra=None):
+        """Iterate over a streamed multi-status response.
+
+        Yield a util.MultiStatusEntry per response element while the body is
+        read from the server. Processed XML elements are discarded, so memory
+        usage doesn't depend on the number of results. The response is closed
+        when the iteration ends.
+
+        extra -- If given, a dict that receives the text of other children of
+                 the multistatus element (e.g. {DAV:}sync-token).
+
+        Raise ParseError on malformed XML.
+
+        """
+        source = self
+        if not self.is_stream:
+            # body was already read, e.g. for a pipelined request
+            if PYTHON2:
+                source = StringIO(self.content)
+            else:
+                source = BytesIO(self.content)
+        try:
+            for entry in util.iter_multistatus(source, extra):
+                yield entry
+        finally:
+            self.close()
+
     def _parse_xml_content(self):
         """Parse the XML content.
 
@@ -634,6 +801,98 @@ class MultiStatusResponse(int):
 
 
 # Clients
+class Pipeline(object):
+    """Batch of requests sent on one keep-alive connection.
+
+    Request methods of the client (e.g. propfind, head, get) called on the
+    pipeline queue the request and return None. The send method writes all
+    queued requests to one connection before the first response is read and
+    returns the responses in request order (RFC 7230, 6.3.2 Pipelining).
+
+    Only GET, HEAD, OPTIONS, PROPFIND and REPORT requests can be queued.
+    Bodies of the responses are always read completely.
+
+    """
+    def __init__(self, client):
+        """Initialize the pipeline.
+
+        client -- The HTTPClient the requests are made with.
+
+        """
+        self._client = client
+        self._requests = list()
+        self._recorder = copy.copy(client)
+        self._recorder._request = self._queue
+
+    def __getattr__(self, name):
+        """Return request method of the client, that queues the request."""
+        return getattr(self._recorder, name)
+
+    def __len__(self):
+        """Return number of queued requests."""
+        return len(self._requests)
+
+    def send(self):
+        """Send queued requests and return list with their responses.
+
+        Responses with 4xx and 5xx HTTP status codes are given as
+        HTTPUserError and HTTPServerError objects instead of being raised.
+
+        """
+        (requests, self._requests) = (self._requests, list())
+        if not requests:
+            return list()
+        return self._client._pipeline_request(requests)
+
+    def _queue(self, method, uri, content=None, headers=None, stream=False):
+        """Queue request instead of sending it."""
+        if method not in PIPELINE_METHODS:
+            raise ValueError("%s request can't be pipelined" % method)
+        self._requests.append((method, uri, content, headers))
+
+
+class _PipelineFile(object):
+    """Buffered socket file shared by the responses of a pipeline.
+
+    httplib closes the file of a response when its body was read, the
+    buffer must be kept for the following responses.
+
+    """
+    def __init__(self, fileobject):
+        self._fileobject = fileobject
+
+    def __getattr__(self, name):
+        return getattr(self._fileobject, name)
+
+    def close(self):
+        pass
+
+    def detach(self):
+        """Close the underlying file, the socket is kept open."""
+        self._fileobject.close()
+
+
+class _PipelineSocket(object):
+    """Socket stand-in handing the shared file to httplib responses."""
+    def __init__(self, fileobject):
+        self._fileobject = fileobject
+
+    def makefile(self, *args, **kwargs):
+        return self._fileobject
+
+
+class _TLSConnection(httplib.HTTPSConnection):
+    """HTTPS connection wrapping its socket with a shared TLSPolicy."""
+    def __init__(self, tls, *args, **kwargs):
+        httplib.HTTPSConnection.__init__(self, *args, **kwargs)
+        self._tls = tls
+
+    def connect(self):
+        httplib.HTTPConnection.connect(self)
+        hostname = self._tunnel_host or self.host
+        self.sock = self._tls.wrap(self.sock, hostname)
+
+
 class HTTPClient(object):
     """Mini HTTP client.
 
@@ -646,6 +905,28 @@ class HTTPClient(object):
     headers -- Dictionary with headers to send with every request.
     cookie -- If set with setcookie: the given object.
     locks -- Mapping with locks.
+    pool -- ConnectionPool the connections are taken from or None, if every
+            request uses its own connection.
+    blocksize -- Size of the blocks file-like request bodies are sent in.
+    retrypolicy -- RetryPolicy deciding which failed requests are repeated.
+    accept_encoding -- Value of the Accept-Encoding header sent with GET,
+                       PROPFIND and REPORT requests (e.g. "gzip, deflate")
+                       or None to get uncompressed responses.
+    transferstats -- If set, a util.TransferStats the received responses
+                     are accounted in. May be shared by several clients.
+    timeoutpolicy -- If set, a TimeoutPolicy giving the socket timeout of
+                     each request instead of the fixed timeout. Should be
+                     shared by all clients of a server.
+    limiter -- If set, a ConcurrencyLimiter bounding the number of
+               requests in flight until their response header arrived.
+               Should be shared by all clients of a server.
+    breaker -- If set, a CircuitBreaker failing requests with
+               CircuitOpenError without connecting, while the server is
+               unreachable. Should be shared by all clients of a server.
+    tls -- If set, a TLSPolicy sharing SSL context and sessions by all HTTPS
+           connections and checking a pinned certificate fingerprint.
+           Overrides the settings of setssl. Should be shared by all
+           clients of a server.
 
     """
 
@@ -666,7 +947,8 @@ class HTTPClient(object):
         return self
 
     def __init__(self, host, port=80, protocol=None, strict=False,
-                 timeout=None, source_address=None):
+                 timeout=None, source_address=None, pool=None,
+                 retrypolicy=None):
         """Initialize the WebDAV client.
 
         host -- WebDAV server host.
@@ -691,6 +973,11 @@ class HTTPClient(object):
                           httplib). This argument is available since
                           Python 2.7. It won't have any effect in previous
                           versions.
+        pool -- If given, a ConnectionPool to keep connections alive between
+                requests. The pool may be shared by several clients.
+        retrypolicy -- If given, a RetryPolicy for failed requests. May be
+                       shared by several clients. If not given, a default
+                       RetryPolicy is used.
 
         """
         assert isinstance(port, int)
@@ -712,6 +999,17 @@ class HTTPClient(object):
             self.context = None
         self.headers = dict()
         self.cookie = None
+        self.pool = pool
+        self.blocksize = DEFAULT_BLOCKSIZE
+        if retrypolicy is None:
+            retrypolicy = RetryPolicy()
+        self.retrypolicy = retrypolicy
+        self.accept_encoding = None
+        self.transferstats = None
+        self.timeoutpolicy = None
+        self.limiter = None
+        self.breaker = None
+        self.tls = None
         self._do_digest_auth = False
 
     def _getconnection(self):
@@ -728,6 +1026,9 @@ class HTTPClient(object):
         if self.protocol == "http":
             return httplib.HTTPConnection(*args, **kwargs)
         # setup HTTPS
+        if self.tls is not None:
+            kwargs["context"] = self.tls.getcontext()
+            return _TLSConnection(self.tls, *args, **kwargs)
         if PYTHON2:
             kwargs["key_file"] = self.key_file
             kwargs["cert_file"] = self.cert_file
@@ -735,61 +1036,384 @@ class HTTPClient(object):
             kwargs["context"] = self.context
         return httplib.HTTPSConnection(*args, **kwargs)
 
-    def retry(tries=3, delay=2):
-        def deco_retry(f):
-            @wraps(f)
-            def f_retry(*args, **kwargs):
-                for _ in range(tries):
-                    try:
-                        return f(*args, **kwargs)
-                    except:
-                        time.sleep(delay)
-                return f(*args, **kwargs)
-            return f_retry
-        return deco_retry
-
-    @retry(4)
-    def _retry_request(self, method, uri, content=None, headers=None):
-        con = self._getconnection()
-        with closing(con):
-            con.request(method, uri, content, headers)  
-            response = self.ResponseType(con.getresponse())
-            if 400 <= response < 500:
-                response = HTTPUserError(response)
-            elif 500 <= response < 600:
-                response = HTTPServerError(response)
+    def _acquireconnection(self):
+        """Return 2-tuple with connection and flag whether it was reused."""
+        if self.pool is None:
+            return (self._getconnection(), False)
+        return self.pool.acquire(self)
+
+    def _releaseconnection(self, con, reusable):
+        """Give connection back to the pool or close it."""
+        if reusable and (self.tls is not None) and (con.sock is not None):
+            # TLS 1.3 session tickets arrive after the handshake
+            self.tls.savesession(con.sock)
+        if self.pool is None:
+            con.close()
+        else:
+            self.pool.release(self, con, reusable)
+
+    def _sendrequest(self, con, method, uri, content, headers):
+        """Send request on connection.
+
+        File-like content is streamed in blocks. Its length is taken from the
+        Content-Length header, if given. Otherwise chunked transfer encoding
+        is used.
+
+        """
+        if not hasattr(content, "read"):
+            con.request(method, uri, content, headers)
+            return
+        content.rewind()
+        names = set(key.lower() for key in headers)
+        chunked = ("content-length" not in names)
+        con.putrequest(method, uri,
+                       skip_accept_encoding=("accept-encoding" in names))
+        for (key, value) in headers.items():
+            con.putheader(key, value)
+        if chunked:
+            # RFC 2616, 3.6.1 Chunked Transfer Coding
+            con.putheader("Transfer-Encoding", "chunked")
+        con.endheaders()
+        while True:
+            data = content.read(self.blocksize)
+            if not data:
+                break
+            if chunked:
+                size = ("%X" % len(data)).encode("ascii")
+                data = size + CRLF + data + CRLF
+            con.send(data)
+        if chunked:
+            con.send("0".encode("ascii") + CRLF + CRLF)
+
+    def _retry_request(self, method, uri, content=None, headers=None,
+                       stream=False):
+        """Send request and return response, retry as to self.retrypolicy.
+
+        Raise the last connection error, when no further retry is allowed.
+        Raise CircuitOpenError, when the breaker doesn't let the request
+        through.
+
+        """
+        attempt = 0
+        permitted = False
+        while True:
+            attempt += 1
+            if not permitted:
+                self._checkbreaker()
+                permitted = True
+            self._acquireslot()
+            try:
+                (con, reused) = self._acquireconnection()
+            except:
+                self._releaseslot()
+                self._cancelbreaker()
+                raise
+            sent = False
+            try:
+                size = self._getcontentsize(content)
+                self._settimeout(con, size)
+                started = time.time()
+                self._sendrequest(con, method, uri, content, headers)
+                sent = True
+                sentat = time.time()
+                httpresponse = con.getresponse()
+                if stream:
+                    response = self.ResponseType(httpresponse, stream)
+                else:
+                    response = self.ResponseType(httpresponse)
+                self._measure(response, size, started, sentat)
+                self._releaseslot(response, size, sentat)
+                if self.breaker is not None:
+                    self.breaker.success()
+            except (httplib.HTTPException, socket.error):
+                self._releaseslot(overloaded=isinstance(sys.exc_info()[1],
+                                                        socket.timeout))
+                self._releaseconnection(con, False)
+                # A kept-alive connection may have been closed by the server
+                # in the meantime. Try again at once with a fresh connection.
+                if reused and (not sent or
+                               self.retrypolicy.isidempotent(method)):
+                    attempt -= 1
+                    continue
+                permitted = False
+                if self.breaker is not None:
+                    self.breaker.failure()
+                    if not self.breaker.isavailable():
+                        # no use in waiting for a retry
+                        raise
+                delay = self.retrypolicy.getdelay(method, attempt, None, sent)
+                if delay is None:
+                    raise
+                self.retrypolicy.wait(delay)
+                continue
+            except:
+                self._releaseslot()
+                self._releaseconnection(con, False)
+                self._cancelbreaker()
+                raise
+            if response.is_stream:
+                # the connection is released, when the body was read
+                response._release = partial(self._releaseconnection, con)
+                response._transferstats = self.transferstats
+                response._timeoutpolicy = self.timeoutpolicy
+            else:
+                self._releaseconnection(con, not httpresponse.will_close)
+                if self.transferstats is not None:
+                    self.transferstats.add(response)
+            delay = self.retrypolicy.getdelay(method, attempt, response)
+            if delay is None:
+                break
+            response.close()
+            self.retrypolicy.wait(delay)
+        return self._geterror(response)
+
+    def _checkbreaker(self):
+        """Raise CircuitOpenError, if the breaker rejects the request."""
+        if (self.breaker is not None) and not self.breaker.allow():
+            raise CircuitOpenError(self.host, self.breaker.getretryafter())
+
+    def _cancelbreaker(self):
+        """Give back permission of the breaker after a local error."""
+        if self.breaker is not None:
+            self.breaker.cancel()
+
+    def _acquireslot(self):
+        """Wait until limiter allows another request in flight."""
+        if self.limiter is not None:
+            self.limiter.acquire()
+
+    def _releaseslot(self, response=None, size=0, sentat=None,
+                     overloaded=False):
+        """Give request slot back to limiter with outcome of the request.
+
+        response -- The received response or None on errors.
+        size -- Number of bytes of the request body.
+        sentat -- Time the request was sent completely.
+        overloaded -- True, if the request timed out.
+
+        """
+        if self.limiter is None:
+            return
+        responsetime = None
+        if response is not None:
+            overloaded = self.limiter.isoverload(response)
+            if size < self.blocksize:
+                responsetime = response._received - sentat
+        self.limiter.release(responsetime, overloaded)
+
+    def _getcontentsize(self, content):
+        """Return number of bytes of request body, 0 if unknown."""
+        if content is None:
+            return 0
+        if hasattr(content, "read"):
+            return content.length or 0
+        return len(content)
+
+    def _settimeout(self, con, size):
+        """Connect and set socket timeout of request as to timeoutpolicy.
+
+        size -- Number of bytes of the request body.
 
+        """
+        if self.timeoutpolicy is None:
+            return
+        if con.sock is None:
+            con.timeout = self.timeoutpolicy.getconnecttimeout()
+            con.connect()
+        con.sock.settimeout(self.timeoutpolicy.gettimeout(size,
+                                                          self.blocksize))
+
+    def _measure(self, response, size, started, sentat):
+        """Account response time and bandwidth in timeoutpolicy."""
+        if self.timeoutpolicy is None:
+            return
+        self.timeoutpolicy.addtransfer(size, sentat - started)
+        if size < self.blocksize:
+            # time of big uploads depends on server side processing of the
+            # body, so only small requests give response time samples
+            self.timeoutpolicy.addresponsetime(response._received - sentat)
+        if not response.is_stream:
+            self.timeoutpolicy.addtransfer(response.wire_bytes,
+                                           time.time() - response._received)
+
+    def _geterror(self, response):
+        """Return HTTPError for 4xx and 5xx responses, else the response."""
+        if 400 <= response < 500:
+            response = HTTPUserError(response)
+        elif 500 <= response < 600:
+            response = HTTPServerError(response)
         return response
 
-    def _request(self, method, uri, content=None, headers=None):
+    def _request(self, method, uri, content=None, headers=None,
+                 stream=False):
         """Make request and return response.
 
         method -- Request method.
         uri -- URI the request is for.
         content -- The content of the request. May be None.
         headers -- If given, a mapping with additonal headers to send.
+        stream -- If True, don't read the body of a successful response.
 
         """
+        (uri, headers, fake_request) = self._preparerequest(method, uri,
+                                                            headers)
+
+        response = self._retry_request(method, uri, content, headers, stream)
+
+        self._extractcookies(response, fake_request)
+
+        if isinstance(response, HTTPError):
+            raise response
+        return response
+
+    def _preparerequest(self, method, uri, headers):
+        """Return 3-tuple with uri, headers and cookie request to send."""
         if not uri.startswith("/"):
             uri = "/%s" % uri
 
         headers = dict() if (headers is None) else headers
 
+        if self.accept_encoding and (method in COMPRESSIBLE_METHODS):
+            names = set(key.lower() for key in headers)
+            # RFC 7233, 2.1: byte ranges refer to the encoded body, so ranges
+            # are requested without content-coding
+            if ("accept-encoding" not in names) and ("range" not in names):
+                headers["Accept-Encoding"] = self.accept_encoding
+
         # handle cookies, if necessary
+        fake_request = None
         if self.cookie is not None:
             fake_request = util.FakeHTTPRequest(self, uri, headers)
             self.cookie.add_cookie_header(fake_request)
+        return (uri, headers, fake_request)
 
-        response = self._retry_request(method, uri, content, headers)
-
+    def _extractcookies(self, response, fake_request):
+        """Store cookies set by response."""
         if self.cookie is not None:
             # Get response object suitable for cookielib
             cookie_response = util.get_cookie_response(response)
             self.cookie.extract_cookies(cookie_response, fake_request)
 
-        if isinstance(response, HTTPError):
-            raise response
-        return response
+    def pipeline(self):
+        """Return Pipeline to send several requests without waiting.
+
+        Use it to hide the latency of many small independent requests:
+        queue them by calling request methods on the pipeline and send them
+        with its send method.
+
+        """
+        return Pipeline(self)
+
+    def _pipeline_request(self, requests):
+        """Send requests on one connection and return their responses.
+
+        requests -- List of (method, uri, content, headers) tuples.
+
+        Requests that weren't answered on the connection, e.g. because the
+        server closed it after some responses, are sent again one by one.
+        So are requests whose response is to be retried as to
+        self.retrypolicy.
+
+        """
+        prepared = list()
+        for (method, uri, content, headers) in requests:
+            (uri, headers, fake_request) = self._preparerequest(method, uri,
+                                                                headers)
+            prepared.append((method, uri, content, headers, fake_request))
+        responses = self._sendpipeline(prepared)
+        for (index, response) in enumerate(responses):
+            (method, uri, content, headers, fake_request) = prepared[index]
+            if response is not None:
+                delay = self.retrypolicy.getdelay(method, 1, response)
+                if delay is None:
+                    responses[index] = self._geterror(response)
+                    self._extractcookies(response, fake_request)
+                    continue
+                self.retrypolicy.wait(delay)
+            response = self._retry_request(method, uri, content, headers)
+            self._extractcookies(response, fake_request)
+            responses[index] = response
+        return responses
+
+    def _sendpipeline(self, prepared):
+        """Write all requests, then read responses in request order.
+
+        Return list of responses, None for each unanswered request.
+
+        """
+        responses = [None] * len(prepared)
+        if (self.breaker is not None) and not self.breaker.isavailable():
+            # requests are sent one by one and fail there
+            return responses
+        # the batch occupies one connection, so it counts as one request
+        self._acquireslot()
+        try:
+            (con, reused) = self._acquireconnection()
+        except:
+            self._releaseslot()
+            raise
+        reusable = False
+        try:
+            data = [self._formatrequest(method, uri, content, headers)
+                    for (method, uri, content, headers, _) in prepared]
+            self._settimeout(con, sum(len(request) for request in data))
+            if con.sock is None:
+                con.connect()
+            con.sock.sendall(EMPTY.join(data))
+            fileobject = _PipelineFile(con.sock.makefile("rb"))
+            try:
+                for (index, request) in enumerate(prepared):
+                    httpresponse = self._readpipelined(fileobject, request[0])
+                    responses[index] = self.ResponseType(httpresponse)
+                    if self.transferstats is not None:
+                        self.transferstats.add(responses[index])
+                    if httpresponse.will_close:
+                        break
+                else:
+                    reusable = True
+            finally:
+                fileobject.detach()
+        except (httplib.HTTPException, socket.error):
+            # requests without response are sent again
+            pass
+        finally:
+            self._releaseslot()
+            self._releaseconnection(con, reusable)
+        if (self.breaker is not None) and (responses[0] is not None):
+            self.breaker.success()
+        return responses
+
+    def _readpipelined(self, fileobject, method):
+        """Return httplib response read from the shared file."""
+        sock = _PipelineSocket(fileobject)
+        if PYTHON2:
+            httpresponse = httplib.HTTPResponse(sock, strict=self.strict,
+                                                method=method)
+        else:
+            httpresponse = httplib.HTTPResponse(sock, method=method)
+        httpresponse.begin()
+        return httpresponse
+
+    def _formatrequest(self, method, uri, content, headers):
+        """Return request as bytes like httplib would send it."""
+        # RFC 2616, 14.23 Host
+        # A "host" without any trailing port information implies the default
+        # port for the service requested.
+        host = self.host
+        if self.port != SCHEME_MAP[self.protocol][1]:
+            host = "%s:%d" % (host, self.port)
+        content = EMPTY if (content is None) else content
+        if not isinstance(content, bytes):
+            content = content.encode("utf-8")
+        lines = ["%s %s HTTP/1.1" % (method, uri), "Host: %s" % host]
+        names = set(key.lower() for key in headers)
+        if "accept-encoding" not in names:
+            lines.append("Accept-Encoding: identity")
+        for (key, value) in headers.items():
+            lines.append("%s: %s" % (key, value))
+        lines.append("Content-Length: %d" % len(content))
+        head = "\r\n".join(lines) + "\r\n\r\n"
+        return head.encode("latin-1") + content
 
     def _prepare(self, uri, headers, query=None):
         """Return 2-tuple with prepared version of uri and headers.
@@ -912,19 +1536,22 @@ class HTTPClient(object):
         (uri, headers) = self._prepare(uri, headers)
         return self._request("OPTIONS", uri, None, headers)
 
-    def get(self, uri, headers=None, query=None):
+    def get(self, uri, headers=None, query=None, stream=False):
         """Make GET request and return status.
 
         uri -- URI of the request.
         headers -- Optional mapping with headers to send.
         query -- Mapping with key/value-pairs to be added as query to the URI.
+        stream -- If True, the response body is not read into memory. Read
+                  it with the read or iter_content method of the response
+                  and close the response afterwards.
 
         Raise HTTPUserError on 4xx HTTP status codes.
         Raise HTTPServerError on 5xx HTTP status codes.
 
         """
         (uri, headers) = self._prepare(uri, headers, query)
-        return self._request("GET", uri, None, headers)
+        return self._request("GET", uri, None, headers, stream)
 
     def head(self, uri, headers=None, query=None):
         """Make HEAD request and return status.
@@ -983,14 +1610,20 @@ class HTTPClient(object):
         return self._request("POST", uri, content, headers)
 
     def put(self, uri, fileobject, content_type="application/octet-stream",
-            headers=None):
+            headers=None, length=None):
         """Make PUT request and return status.
 
         uri -- Path for PUT.
-        fileobject -- File-like object or string with content to PUT.
+        fileobject -- File-like object or string with content to PUT. A
+                      file-like object is streamed from its current position
+                      in blocks of self.blocksize bytes, with Content-Length
+                      if its size can be determined and with chunked transfer
+                      encoding otherwise.
         content_type -- The content-type of the file. Default value is
                         application/octet-stream.
         headers -- If given, must be a dict with headers to send.
+        length -- If given, only this number of bytes of a file-like object
+                  is sent.
 
         Raise HTTPUserError on 4xx HTTP status codes.
         Raise HTTPServerError on 5xx HTTP status codes.
@@ -998,12 +1631,44 @@ class HTTPClient(object):
         """
         (uri, headers) = self._prepare(uri, headers)
         headers["content-type"] = content_type
+        return self._request("PUT", uri, self._getbody(fileobject, length,
+                                                       headers), headers)
+
+    def patch(self, uri, fileobject, content_type="application/octet-stream",
+              headers=None, length=None):
+        """Make PATCH request and return status.
+
+        The meaning of the content depends on content_type and the server,
+        e.g. "application/x-sabredav-partialupdate" with a X-Update-Range
+        header writes the content to a byte range of the resource.
+
+        uri -- Path for PATCH.
+        fileobject -- File-like object or string with content to send,
+                      streamed like with put.
+        content_type -- The content-type of the patch document. Default
+                        value is application/octet-stream.
+        headers -- If given, must be a dict with headers to send.
+        length -- If given, only this number of bytes of a file-like object
+                  is sent.
 
-        data = fileobject
-        if hasattr(fileobject, "read") and not PYTHON2_6:
-            # python 2.5 httlib cannot handle file-like objects
-            data = content.read()
-        return self._request("PUT", uri, data, headers)
+        Raise HTTPUserError on 4xx HTTP status codes.
+        Raise HTTPServerError on 5xx HTTP status codes.
+
+        """
+        # RFC 5789, 2. The PATCH Method
+        (uri, headers) = self._prepare(uri, headers)
+        headers["content-type"] = content_type
+        return self._request("PATCH", uri, self._getbody(fileobject, length,
+                                                         headers), headers)
+
+    def _getbody(self, fileobject, length, headers):
+        """Return request body for fileobject and set its Content-Length."""
+        if not hasattr(fileobject, "read"):
+            return fileobject
+        data = util.RequestBody(fileobject, length)
+        if data.length is not None:
+            headers["Content-Length"] = str(data.length)
+        return data
 
     def delete(self, uri, content="", headers=None):
         """Make DELETE request and return HTTPResponse.
@@ -1077,7 +1742,8 @@ class CoreWebDAVClient(HTTPClient):
 
     ResponseType = WebDAVResponse
 
-    def __init__(self, host, port=80, protocol=None, timeout=3):
+    def __init__(self, host, port=80, protocol=None, timeout=3, pool=None,
+                 retrypolicy=None):
         """Initialize the WebDAV client.
 
         host -- WebDAV server host.
@@ -1090,9 +1756,15 @@ class CoreWebDAVClient(HTTPClient):
                         8080 -> http
                         8081 -> http
                     Default port is 'http'.
+        timeout -- Operations will timeout after that many seconds.
+        pool -- If given, a ConnectionPool to keep connections alive between
+                requests.
+        retrypolicy -- If given, a RetryPolicy for failed requests.
 
         """
-        super(CoreWebDAVClient, self).__init__(host, port, protocol, False, timeout)
+        super(CoreWebDAVClient, self).__init__(host, port, protocol, False,
+                                               timeout, pool=pool,
+                                               retrypolicy=retrypolicy)
         self.locks = dict()
 
     def _preparecopymove(self, source, destination, depth, overwrite, headers):
@@ -1143,7 +1815,7 @@ class CoreWebDAVClient(HTTPClient):
 
     def propfind(self, uri, depth=0, names=False,
                  properties=None, include=None, namespaces=None,
-                 headers=None):
+                 headers=None, stream=False):
         """Make PROPFIND request and return status.
 
         uri -- Path for PROPFIND.
@@ -1155,6 +1827,9 @@ class CoreWebDAVClient(HTTPClient):
                    be requested with this argument.
         namespaces -- Mapping with namespaces for given properties, if needed.
         headers -- If given, must be a dict with headers to send.
+        stream -- If True, the multi-status body is not read on return. Use
+                  the iter_entries method of the response to parse it while
+                  it is received.
 
         Raise ValueError, if illegal depth was given or if properties and
         include arguments were given.
@@ -1177,7 +1852,7 @@ class CoreWebDAVClient(HTTPClient):
         headers["Content-Type"] = "application/xml"
         content = creator.create_propfind(names, properties,
                                           include, namespaces)
-        return self._request("PROPFIND", uri, content, headers)
+        return self._request("PROPFIND", uri, content, headers, stream)
 
     def proppatch(self, uri, setprops=None, delprops=None,
                   namespaces=None, headers=None):
@@ -1286,24 +1961,8 @@ class CoreWebDAVClient(HTTPClient):
 
         """
         (uri, headers) = self._prepare(uri, headers)
-        # RFC 2518, 9.8 Timeout Request Header
-        # TimeOut = "Timeout" ":" 1#TimeType
-        # TimeType = ("Second-" DAVTimeOutVal | "Infinite" | Other)
-        # DAVTimeOutVal = 1*digit
-        # Other = "Extend" field-value   ; See section 4.2 of [RFC2068]
         if timeout is not None:
-            try:
-                timeout = int(timeout)
-            except ValueError: # no number
-                if timeout.lower() == "infinite":
-                    value = "Infinite"
-                else:
-                    raise ValueError("either number of seconds or 'infinite'")
-            else:
-                if timeout > MAX_TIMEOUT:
-                    raise ValueError("timeout too big")
-                value = "Second-%d" % timeout
-            headers["Timeout"] = value
+            headers["Timeout"] = self._gettimeout(timeout)
         # RFC 2518, 8.10.4 Depth and Locking
         # Values other than
         # 0 or infinity MUST NOT be used with the Depth header on a LOCK
@@ -1322,6 +1981,47 @@ class CoreWebDAVClient(HTTPClient):
             # remove the formerly set ResponseType from the instance
             del self.ResponseType
 
+    def refresh_lock(self, lock, timeout=None, headers=None):
+        """Make LOCK request to refresh lock and return WebDAVResponse.
+
+        lock -- WebDAVLockResponse of the lock to refresh.
+        timeout -- Value for the timeout header. Either "infinite" or a number
+                   representing the seconds (not greater than 2^32 - 1).
+        headers -- If given, must be a mapping with headers to set.
+
+        Raise HTTPUserError on 4xx HTTP status codes.
+        Raise HTTPServerError on 5xx HTTP status codes.
+
+        """
+        # uri is already prepared in WebDAVLockResponse
+        (_, headers) = self._prepare("", headers)
+        # RFC 4918, 9.10.2 Refreshing Locks
+        # A lock is refreshed by sending a LOCK request without a request
+        # body to the URL of a resource within the scope of the lock. This
+        # request MUST specify which lock to refresh by using the 'If' header
+        # with a single lock token (only one lock may be refreshed at a time).
+        headers["If"] = "(<%s>)" % lock.locktokens[0]
+        if timeout is not None:
+            headers["Timeout"] = self._gettimeout(timeout)
+        return self._request("LOCK", lock._uri, None, headers)
+
+    def _gettimeout(self, timeout):
+        """Return value of Timeout header for timeout."""
+        # RFC 2518, 9.8 Timeout Request Header
+        # TimeOut = "Timeout" ":" 1#TimeType
+        # TimeType = ("Second-" DAVTimeOutVal | "Infinite" | Other)
+        # DAVTimeOutVal = 1*digit
+        # Other = "Extend" field-value   ; See section 4.2 of [RFC2068]
+        try:
+            timeout = int(timeout)
+        except ValueError: # no number
+            if timeout.lower() == "infinite":
+                return "Infinite"
+            raise ValueError("either number of seconds or 'infinite'")
+        if timeout > MAX_TIMEOUT:
+            raise ValueError("timeout too big")
+        return "Second-%d" % timeout
+
     def unlock(self, uri_or_lock, locktoken=None, headers=None):
         """Make UNLOCK request and return WebDAVResponse.
 
@@ -1368,7 +2068,7 @@ class CoreWebDAVClient(HTTPClient):
 
 class ExtendedWebDAVClient(CoreWebDAVClient):
     """WebDAV client with versioning extensions (RFC 3253)."""
-    def __report(self, uri, depth, content, headers):
+    def __report(self, uri, depth, content, headers, stream=False):
         depth = util.get_depth(depth)
         (uri, headers) = self._prepare(uri, headers)
         # RFC 3253, 3.6 REPORT Method
@@ -1376,7 +2076,7 @@ class ExtendedWebDAVClient(CoreWebDAVClient):
         # included, Depth:0 is assumed.
         headers["Depth"] = depth
         headers["Content-Type"] = "application/xml"
-        return self._request("REPORT", uri, content, headers)
+        return self._request("REPORT", uri, content, headers, stream=stream)
 
     def version_tree_report(self, uri, depth=0, properties=None,
                             elements=None, namespaces=None, headers=None):
@@ -1425,6 +2125,40 @@ class ExtendedWebDAVClient(CoreWebDAVClient):
         content = creator.create_report_expand_property(*args)
         return self.__report(uri, depth, content, headers)
 
+    def sync_collection_report(self, uri, synctoken=None, synclevel="infinite",
+                               properties=None, namespaces=None,
+                               headers=None, stream=False):
+        """Make a sync-collection-REPORT request and return status.
+
+        The multi-status response lists all members changed since synctoken.
+        Removed members have status 404. The new sync token is the text of
+        the {DAV:}sync-token child of the multistatus element, use
+        WebDAVResponse.iter_entries with an extra dict to get it from a
+        streamed response.
+
+        uri -- Collection to get changes for.
+        synctoken -- Token of a previous sync-collection-REPORT. None for the
+                     initial request, that lists all members.
+        synclevel -- Either 1 or "infinite". Default is "infinite".
+        properties -- If given, an iterable with all requested properties is
+                      expected.
+        namespaces -- Mapping with namespaces for given properties, if needed.
+        headers -- If given, must be a mapping with headers to set.
+        stream -- If True, the response body is not read and parsed. Iterate
+                  over the response with iter_entries.
+
+        Raise HTTPUserError on 4xx HTTP status codes. A rejected sync token
+        causes 403 (precondition DAV:valid-sync-token) or 409.
+        Raise HTTPServerError on 5xx HTTP status codes.
+
+        """
+        args = (synctoken, synclevel, properties, namespaces)
+        content = creator.create_report_sync_collection(*args)
+        # RFC 6578, 3.2 DAV:sync-collection Report
+        # This report is only defined when the Depth header has value "0";
+        # other values result in a 400 (Bad Request) error response.
+        return self.__report(uri, 0, content, headers, stream)
+
 
 class WebDAVClient(ExtendedWebDAVClient):
     """Mini WebDAV client.
@@ -0,0 +1,144 @@
+# Circuit breaker for tinydav WebDAV client.
+# Copyright (C) 2009  Manuel Hermann <manuel-hermann@gmx.net>
+#
+# This file is part of tinydav.
+#
+# tinydav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Circuit breaker for tinydav WebDAV client."""
+from __future__ import with_statement
+import threading
+import time
+
+__all__ = ("CircuitBreaker",)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitBreaker(object):
+    """Stop sending requests to a server that can't be reached.
+
+    The breaker is closed while requests reach the server. After threshold
+    connection failures in a row it opens: requests fail at once without
+    connecting and without retries. After resettimeout seconds it is half
+    open and lets one probe request through. When the probe reaches the
+    server the breaker is closed again, otherwise it opens for twice the
+    time (up to maxresettimeout).
+
+    Any HTTP response counts as success, status codes are handled by the
+    retry policy.
+
+    One breaker object should be shared by all clients of one server.
+
+    This object has the following attributes:
+
+    threshold -- Number of connection failures in a row opening the breaker.
+    resettimeout -- Seconds the breaker stays open at first.
+    maxresettimeout -- Upper bound of seconds the breaker stays open.
+    state -- "closed", "open" or "half-open".
+    failures -- Connection failures in a row.
+    opened -- Number of times the breaker was opened.
+    rejected -- Number of requests failed without connecting.
+
+    """
+    def __init__(self, threshold=5, resettimeout=30, maxresettimeout=600):
+        """Initialize the circuit breaker.
+
+        threshold -- Connection failures in a row opening the breaker.
+                     Default is 5.
+        resettimeout -- Seconds until the first probe. Default is 30.
+        maxresettimeout -- Upper bound of seconds between probes. Default is
+                           600.
+
+        """
+        self.threshold = threshold
+        self.resettimeout = resettimeout
+        self.maxresettimeout = maxresettimeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._timeout = resettimeout
+        self._openeduntil = 0
+        self._probing = False
+
+    def allow(self):
+        """Return True, if a request may be sent.
+
+        In half-open state only the first caller gets True and has to report
+        the outcome of its request with success, failure or cancel.
+
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if (self.state == OPEN) and (time.time() >= self._openeduntil):
+                self.state = HALF_OPEN
+                self._probing = False
+            if (self.state == HALF_OPEN) and not self._probing:
+                self._probing = True
+                return True
+            self.rejected += 1
+            return False
+
+    def isavailable(self):
+        """Return True, if the next request will be sent."""
+        with self._lock:
+            if self.state == OPEN:
+                return time.time() >= self._openeduntil
+            return not ((self.state == HALF_OPEN) and self._probing)
+
+    def getretryafter(self):
+        """Return seconds until the next probe request is let through."""
+        with self._lock:
+            return max(0, self._openeduntil - time.time())
+
+    def success(self):
+        """Account request that reached the server."""
+        with self._lock:
+            self.state = CLOSED
+            self.failures = 0
+            self._probing = False
+            self._timeout = self.resettimeout
+
+    def failure(self):
+        """Account request that couldn't reach the server."""
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN:
+                # probe failed, wait longer before the next one
+                self._timeout = min(self.maxresettimeout, self._timeout * 2)
+                self._open()
+            elif (self.state == CLOSED) and (self.failures >= self.threshold):
+                self._open()
+
+    def cancel(self):
+        """Give back permission of allow without outcome of the request."""
+        with self._lock:
+            self._probing = False
+
+    def getstats(self):
+        """Return dict with state and counters."""
+        with self._lock:
+            return dict(state=self.state, opened=self.opened,
+                        rejected=self.rejected)
+
+    def _open(self):
+        """Open the breaker for the current reset timeout."""
+        self.state = OPEN
+        self.opened += 1
+        self._probing = False
+        self._openeduntil = time.time() + self._timeout
@@ -184,6 +184,29 @@ def create_report_version_tree(properties=None, elements=None, namespaces=None):
     return tostring(report, "UTF-8")
 
 
+def create_report_sync_collection(synctoken=None, synclevel="infinite",
+                                  properties=None, namespaces=None):
+    """Construct and return XML for sync-collection-REPORT."""
+    namespaces = dict() if (namespaces is None) else namespaces
+    ns = {"xmlns": "DAV:"}
+    # RFC 6578, 6.1 DAV:sync-collection XML Element
+    # <!ELEMENT sync-collection (sync-token, sync-level, limit?, prop)>
+    # <!ELEMENT sync-token CDATA>  -- empty on the initial request
+    # <!ELEMENT sync-level CDATA>  -- "1" or "infinite"
+    report = Element("sync-collection", ns)
+    _addnamespaces(report, namespaces)
+    token = SubElement(report, "sync-token")
+    if synctoken:
+        token.text = synctoken
+    level = SubElement(report, "sync-level")
+    level.text = str(synclevel)
+    prop = SubElement(report, "prop")
+    if properties:
+        for propname in properties:
+            propelement = SubElement(prop, propname)
+    return tostring(report, "UTF-8")
+
+
 def create_report_expand_property(properties=None, elements=None,
                                   namespaces=None):
     """Construct and return XML for expand-property-REPORT."""
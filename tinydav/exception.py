@@ -58,3 +58,21 @@ class HTTPUserError(HTTPError):
 class HTTPServerError(HTTPError):
     """Exception class for 5xx HTTP errors."""
 
+
+class CircuitOpenError(Exception):
+    """Exception raised instead of sending a request to an unreachable server.
+
+    This object has the following attributes:
+      retryafter -- Seconds until the next request is let through as probe.
+
+    """
+    def __init__(self, host, retryafter):
+        """Initialize the CircuitOpenError.
+
+        host -- The server host.
+        retryafter -- Seconds until the next probe request.
+
+        """
+        Exception.__init__(self, "%s is unreachable, next try in %d seconds"
+                                 % (host, retryafter))
+        self.retryafter = retryafter
@@ -0,0 +1,164 @@
+# Adaptive concurrency limiter for tinydav WebDAV client.
+# Copyright (C) 2009  Manuel Hermann <manuel-hermann@gmx.net>
+#
+# This file is part of tinydav.
+#
+# tinydav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Adaptive concurrency limiter for tinydav WebDAV client."""
+from __future__ import with_statement
+import threading
+import time
+
+__all__ = ("ConcurrencyLimiter",)
+
+# 429 and 5xx responses tell that the server is overloaded.
+OVERLOAD_STATUSES = frozenset((429, 500, 502, 503, 504))
+
+# Seconds a response time may exceed the lowest one in any case, jitter of
+# fast servers isn't taken as queueing.
+MIN_LATENCY_SLACK = 0.02
+
+
+class ConcurrencyLimiter(object):
+    """Limit the number of requests in flight with AIMD.
+
+    Like the TCP congestion window (RFC 5681, 3.1) the limit grows by one
+    per limit requests (additive increase) while responses come back in
+    time and shrinks to backoff times the limit (multiplicative decrease) on
+    429 and 5xx responses and timeouts. A response is not in time, when its
+    response time is more than latencyfactor times the lowest response time
+    seen recently: the server starts queueing requests. The limit only grows
+    while it is used up, so an idle client doesn't raise it (RFC 7661).
+
+    One limiter object should be shared by all clients of one server.
+
+    This object has the following attributes:
+
+    limit -- Current limit as float, requests are allowed while fewer than
+             int(limit) are in flight.
+    minlimit -- Lower bound of the limit.
+    maxlimit -- Upper bound of the limit.
+    inflight -- Number of requests in flight.
+    peak -- Highest number of requests in flight so far.
+    decreases -- Number of times the limit was decreased.
+    history -- List of (timestamp, limit) tuples, one per change of the
+               integer limit, the last maxhistory changes.
+
+    """
+    def __init__(self, initial=4, minlimit=1, maxlimit=32, backoff=0.5,
+                 latencyfactor=2.0, cooldown=1.0, maxhistory=50):
+        """Initialize the limiter.
+
+        initial -- Limit at start. Default is 4.
+        minlimit -- Lower bound of the limit. Default is 1.
+        maxlimit -- Upper bound of the limit. Default is 32.
+        backoff -- Factor the limit is multiplied with on overload. Default
+                   is 0.5.
+        latencyfactor -- Response times above this multiple of the lowest
+                         recent response time stop the limit from growing.
+        cooldown -- Seconds after a decrease during which further overload
+                    signals are ignored, they are caused by the same burst.
+        maxhistory -- Number of limit changes kept in history.
+
+        """
+        self.minlimit = minlimit
+        self.maxlimit = maxlimit
+        self.limit = float(max(minlimit, min(maxlimit, initial)))
+        self.backoff = backoff
+        self.latencyfactor = latencyfactor
+        self.cooldown = cooldown
+        self.maxhistory = maxhistory
+        self.inflight = 0
+        self.peak = 0
+        self.decreases = 0
+        self.history = [(time.time(), int(self.limit))]
+        self._condition = threading.Condition(threading.Lock())
+        self._lastdecrease = 0
+        # lowest response time of the current and the last window
+        self._baseline = None
+        self._windowmin = None
+        self._windowsamples = 0
+
+    def acquire(self):
+        """Wait until a request may be sent and account it as in flight."""
+        with self._condition:
+            while self.inflight >= int(self.limit):
+                self._condition.wait()
+            self.inflight += 1
+            self.peak = max(self.peak, self.inflight)
+
+    def release(self, responsetime=None, overloaded=False):
+        """Account a finished request and adapt the limit.
+
+        responsetime -- Seconds between sent request and received response
+                        header or None, when it's not comparable to other
+                        requests (e.g. big uploads).
+        overloaded -- True, if the server answered with 429 or 5xx or the
+                      request timed out.
+
+        """
+        with self._condition:
+            # limit was used up, when this request was sent
+            saturated = (self.inflight >= int(self.limit))
+            self.inflight -= 1
+            if overloaded:
+                self._decrease()
+            elif saturated and self._isintime(responsetime):
+                self._setlimit(self.limit + 1.0 / self.limit)
+            self._condition.notify_all()
+
+    def isoverload(self, status):
+        """Return True, if HTTP status tells that the server is overloaded."""
+        return status in OVERLOAD_STATUSES
+
+    def getstats(self):
+        """Return dict with current limit, peak and limit history."""
+        with self._condition:
+            return dict(limit=int(self.limit), peak=self.peak,
+                        decreases=self.decreases,
+                        history=[limit for (_, limit) in self.history])
+
+    def _decrease(self):
+        """Multiplicative decrease, once per cooldown."""
+        now = time.time()
+        if now - self._lastdecrease < self.cooldown:
+            return
+        self._lastdecrease = now
+        self.decreases += 1
+        self._setlimit(self.limit * self.backoff)
+
+    def _isintime(self, responsetime):
+        """Account response time and return True, if it's not increased."""
+        if responsetime is None:
+            return True
+        if (self._windowmin is None) or (responsetime < self._windowmin):
+            self._windowmin = responsetime
+        self._windowsamples += 1
+        if (self._baseline is None) or (self._windowmin < self._baseline):
+            self._baseline = self._windowmin
+        # forget old minimum, server or network conditions may have changed
+        if self._windowsamples >= 100:
+            self._baseline = self._windowmin
+            self._windowmin = None
+            self._windowsamples = 0
+        return responsetime <= max(self.latencyfactor * self._baseline,
+                                   self._baseline + MIN_LATENCY_SLACK)
+
+    def _setlimit(self, limit):
+        """Set limit within bounds and record changes of integer limit."""
+        oldlimit = int(self.limit)
+        self.limit = max(self.minlimit, min(self.maxlimit, limit))
+        if int(self.limit) != oldlimit:
+            self.history.append((time.time(), int(self.limit)))
+            del self.history[:-self.maxhistory]
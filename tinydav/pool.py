@@ -0,0 +1,156 @@
+# Connection pool for tinydav WebDAV client.
+# Copyright (C) 2009  Manuel Hermann <manuel-hermann@gmx.net>
+#
+# This file is part of tinydav.
+#
+# tinydav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Persistent HTTP/1.1 connection pool for tinydav WebDAV client."""
+from __future__ import with_statement
+import select
+import threading
+import time
+
+__all__ = ("ConnectionPool",)
+
+# Seconds an idle connection is kept open before it is evicted.
+DEFAULT_IDLE_TIMEOUT = 30
+
+
+class ConnectionPool(object):
+    """Thread-safe pool of keep-alive HTTP(S) connections.
+
+    Connections are pooled per (host, port, protocol) of the HTTPClient that
+    requests them, so one pool can be shared by any number of clients, even
+    when they talk to different servers.
+
+    This object has the following attributes:
+
+    maxconnections -- Maximum number of open connections per server. Callers
+                      block in acquire until a connection becomes free. Zero
+                      means unlimited.
+    idletimeout -- Seconds after which an unused connection is closed.
+
+    """
+    def __init__(self, maxconnections=4, idletimeout=DEFAULT_IDLE_TIMEOUT):
+        """Initialize the connection pool.
+
+        maxconnections -- Maximum number of open connections per server.
+                          Zero means unlimited. Default is 4.
+        idletimeout -- Seconds after which an unused connection is closed.
+
+        """
+        self.maxconnections = maxconnections
+        self.idletimeout = idletimeout
+        self._condition = threading.Condition(threading.Lock())
+        # key -> list of (connection, last used timestamp), newest last
+        self._idle = dict()
+        # key -> number of connections handed out or idle
+        self._opened = dict()
+
+    def _getkey(self, client):
+        """Return pool key for given HTTPClient."""
+        return (client.host, client.port, client.protocol)
+
+    def acquire(self, client):
+        """Return 2-tuple with a connection for client and a reuse flag.
+
+        The reuse flag is True, when the connection was already used for
+        another request before.
+
+        client -- HTTPClient instance or one of its subclasses.
+
+        """
+        key = self._getkey(client)
+        with self._condition:
+            while True:
+                self._evict(key)
+                idle = self._idle.get(key)
+                while idle:
+                    (con, lastused) = idle.pop()
+                    if not self._isstale(con):
+                        return (con, True)
+                    self._discard(key, con)
+                opened = self._opened.get(key, 0)
+                if (not self.maxconnections) or (opened < self.maxconnections):
+                    self._opened[key] = opened + 1
+                    break
+                self._condition.wait()
+        try:
+            return (client._getconnection(), False)
+        except:
+            with self._condition:
+                self._opened[key] -= 1
+                self._condition.notify()
+            raise
+
+    def release(self, client, con, reusable=True):
+        """Give connection back to the pool.
+
+        client -- HTTPClient instance the connection was acquired for.
+        con -- The connection returned by acquire.
+        reusable -- If False, the connection is closed instead of being kept
+                    for further requests (e.g. the server sent
+                    "Connection: close" or the request failed).
+
+        """
+        key = self._getkey(client)
+        with self._condition:
+            if reusable and (con.sock is not None):
+                self._idle.setdefault(key, list()).append((con, time.time()))
+            else:
+                self._discard(key, con)
+            self._condition.notify()
+
+    def clear(self):
+        """Close all idle connections."""
+        with self._condition:
+            for (key, idle) in list(self._idle.items()):
+                for (con, lastused) in idle:
+                    self._discard(key, con)
+            self._idle.clear()
+            self._condition.notify_all()
+
+    def _evict(self, key):
+        """Close connections that were idle longer than idletimeout."""
+        idle = self._idle.get(key)
+        if not idle:
+            return
+        deadline = time.time() - self.idletimeout
+        while idle and idle[0][1] < deadline:
+            (con, lastused) = idle.pop(0)
+            self._discard(key, con)
+
+    def _discard(self, key, con):
+        """Close connection and forget about it."""
+        self._opened[key] = max(0, self._opened.get(key, 0) - 1)
+        try:
+            con.close()
+        except Exception:
+            pass
+
+    def _isstale(self, con):
+        """Return True, when an idle connection can't be used anymore.
+
+        An idle keep-alive socket must not be readable: either the server
+        closed its end or it sent data nobody asked for.
+
+        """
+        sock = con.sock
+        if sock is None:
+            return True
+        try:
+            (readable, _, _) = select.select([sock], [], [], 0)
+        except Exception:
+            return True
+        return bool(readable)
@@ -0,0 +1,157 @@
+# Retry policy for tinydav WebDAV client.
+# Copyright (C) 2009  Manuel Hermann <manuel-hermann@gmx.net>
+#
+# This file is part of tinydav.
+#
+# tinydav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Retry policy for tinydav WebDAV client."""
+from __future__ import with_statement
+from email.utils import parsedate_tz, mktime_tz
+import random
+import threading
+import time
+
+__all__ = ("RetryPolicy",)
+
+# RFC 2616, 9.1.2 Idempotent Methods; RFC 4918 PROPFIND and PROPPATCH,
+# RFC 3253 REPORT and UNLOCK have no additional side effects when repeated.
+IDEMPOTENT_METHODS = frozenset((
+    "GET", "HEAD", "OPTIONS", "TRACE", "PUT", "DELETE",
+    "PROPFIND", "PROPPATCH", "REPORT", "UNLOCK",
+))
+
+# 429 and 503 tell that the request was not processed, so any method may be
+# sent again. Other server errors are retried for idempotent methods only.
+RETRY_ANY_STATUSES = frozenset((429, 503))
+RETRY_IDEMPOTENT_STATUSES = frozenset((500, 502, 504))
+
+
+class RetryPolicy(object):
+    """Decide whether and when a failed request is sent again.
+
+    Connection errors are retried, when the request didn't reach the server
+    or the method is idempotent. Responses are retried on 429 and 5xx status
+    codes. The delay grows exponentially with each attempt and is randomized
+    (jitter), a Retry-After header of the server is honored. The number of
+    retries can be limited over the whole lifetime of the policy, so one
+    policy object shared by all clients of a sync run acts as a global retry
+    budget.
+
+    This object has the following attributes:
+
+    tries -- Maximum number of attempts per request.
+    backoff -- Delay in seconds before the first retry. Doubled on every
+               further retry.
+    maxdelay -- Upper bound in seconds for a single delay.
+    budget -- Maximum number of retries over all requests or None.
+    retries -- Number of retries made so far.
+    waited -- Seconds spent sleeping before retries so far.
+    rejected -- Number of retries refused because the budget was used up.
+
+    """
+    def __init__(self, tries=5, backoff=0.5, maxdelay=30, budget=None):
+        """Initialize the retry policy.
+
+        tries -- Maximum number of attempts per request, including the
+                 first one. Default is 5.
+        backoff -- Delay in seconds before the first retry. Default is 0.5.
+        maxdelay -- Upper bound in seconds for a single delay.
+        budget -- Maximum number of retries over all requests made with this
+                  policy. None means unlimited.
+
+        """
+        self.tries = tries
+        self.backoff = backoff
+        self.maxdelay = maxdelay
+        self.budget = budget
+        self.retries = 0
+        self.waited = 0.0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def isidempotent(self, method):
+        """Return True, if method can be repeated without side effects."""
+        return method in IDEMPOTENT_METHODS
+
+    def getdelay(self, method, attempt, response=None, sent=True):
+        """Return delay in seconds before the next attempt or None.
+
+        None means that the request must not be retried.
+
+        method -- The request method.
+        attempt -- Number of the attempt that just failed, starting with 1.
+        response -- The HTTPResponse, if one was received. None on connection
+                    errors.
+        sent -- False, if the request failed before it was sent completely.
+
+        """
+        if attempt >= self.tries:
+            return None
+        if response is None:
+            if sent and not self.isidempotent(method):
+                return None
+            delay = self._getbackoff(attempt)
+        else:
+            if response in RETRY_ANY_STATUSES:
+                pass
+            elif (response in RETRY_IDEMPOTENT_STATUSES and
+                  self.isidempotent(method)):
+                pass
+            else:
+                return None
+            delay = self._getretryafter(response)
+            if delay is None:
+                delay = self._getbackoff(attempt)
+        with self._lock:
+            if (self.budget is not None) and (self.retries >= self.budget):
+                self.rejected += 1
+                return None
+            self.retries += 1
+        return delay
+
+    def wait(self, delay):
+        """Sleep delay seconds and account them."""
+        if delay > 0:
+            time.sleep(delay)
+        with self._lock:
+            self.waited += delay
+
+    def getstats(self):
+        """Return dict with retry counters."""
+        with self._lock:
+            return dict(retries=self.retries, waited=self.waited,
+                        rejected=self.rejected)
+
+    def _getbackoff(self, attempt):
+        """Return exponential delay with jitter for given attempt."""
+        delay = min(self.maxdelay, self.backoff * (2 ** (attempt - 1)))
+        # "equal jitter": keep half of the delay, randomize the other half
+        return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+    def _getretryafter(self, response):
+        """Return delay requested by a Retry-After header or None."""
+        # RFC 2616, 14.37 Retry-After
+        # Retry-After  = "Retry-After" ":" ( HTTP-date | delta-seconds )
+        value = response.headers.get("retry-after")
+        if not value:
+            return None
+        value = value.strip()
+        if value.isdigit():
+            delay = int(value)
+        else:
+            parsed = parsedate_tz(value)
+            if parsed is None:
+                return None
+            delay = mktime_tz(parsed) - time.time()
+        return max(0, min(self.maxdelay, delay))
@@ -0,0 +1,141 @@
+# Adaptive timeout policy for tinydav WebDAV client.
+# Copyright (C) 2009  Manuel Hermann <manuel-hermann@gmx.net>
+#
+# This file is part of tinydav.
+#
+# tinydav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Adaptive timeout policy for tinydav WebDAV client."""
+from __future__ import with_statement
+import threading
+
+__all__ = ("TimeoutPolicy",)
+
+# Transfers smaller than this are dominated by latency and give no useful
+# bandwidth sample.
+MIN_BANDWIDTH_SAMPLE = 64 * 1024
+
+
+class TimeoutPolicy(object):
+    """Compute socket timeouts from measured latency and bandwidth.
+
+    The response time of requests is tracked like the round trip time in
+    RFC 6298 (smoothed value and its variation), the bandwidth as moving
+    average of big transfers. A request gets the retransmission timeout
+    (RFC 6298, 2) plus the time the request body and one block of data need
+    at half of the measured bandwidth. So timeouts of big uploads grow with
+    their size, while requests to a server that stopped responding fail
+    after a few round trip times. New connections get the retransmission
+    timeout only.
+
+    One policy object should be shared by all clients of one server.
+
+    This object has the following attributes:
+
+    initial -- Timeout in seconds used until the first response was measured.
+    mintimeout -- Lower bound in seconds of the latency part of a timeout.
+    maxtimeout -- Upper bound in seconds of a timeout.
+    minbandwidth -- Bandwidth in bytes per second assumed as long as nothing
+                    was measured.
+    srtt -- Smoothed response time in seconds or None.
+    rttvar -- Variation of the response time in seconds or None.
+    bandwidth -- Measured bandwidth in bytes per second or None.
+    samples -- Number of response time samples so far.
+
+    """
+    # RFC 6298, 2: alpha=1/8, beta=1/4, K=4
+    ALPHA = 0.125
+    BETA = 0.25
+    K = 4
+    # weight of a new bandwidth sample
+    GAMMA = 0.25
+
+    def __init__(self, initial=3, mintimeout=2, maxtimeout=600,
+                 minbandwidth=16 * 1024):
+        """Initialize the timeout policy.
+
+        initial -- Timeout in seconds until the first response was measured.
+                   Default is 3.
+        mintimeout -- Lower bound of the latency part of a timeout in
+                      seconds. Default is 2, server side processing time
+                      varies more than network round trips.
+        maxtimeout -- Upper bound of a timeout in seconds. Default is 600.
+        minbandwidth -- Bandwidth in bytes per second assumed until it was
+                        measured. Default is 16 KB/s.
+
+        """
+        self.initial = initial
+        self.mintimeout = mintimeout
+        self.maxtimeout = maxtimeout
+        self.minbandwidth = minbandwidth
+        self.srtt = None
+        self.rttvar = None
+        self.bandwidth = None
+        self.samples = 0
+        self._lock = threading.Lock()
+
+    def getconnecttimeout(self):
+        """Return timeout in seconds for connecting to the server."""
+        with self._lock:
+            return self._getrto()
+
+    def gettimeout(self, size=0, blocksize=0):
+        """Return socket timeout in seconds for a request.
+
+        size -- Number of bytes of the request body.
+        blocksize -- Number of bytes sent or received with one socket
+                     operation.
+
+        """
+        with self._lock:
+            bandwidth = max(self.minbandwidth, self.bandwidth or 0) / 2.0
+            timeout = self._getrto() + (size + blocksize) / bandwidth
+        return min(self.maxtimeout, timeout)
+
+    def addresponsetime(self, seconds):
+        """Account time between sent request and received response header."""
+        with self._lock:
+            # RFC 6298, 2.2 and 2.3
+            if self.srtt is None:
+                self.srtt = seconds
+                self.rttvar = seconds / 2.0
+            else:
+                self.rttvar = ((1 - self.BETA) * self.rttvar +
+                               self.BETA * abs(self.srtt - seconds))
+                self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * seconds
+            self.samples += 1
+
+    def addtransfer(self, size, seconds):
+        """Account size bytes sent or received in seconds."""
+        if (size < MIN_BANDWIDTH_SAMPLE) or (seconds <= 0):
+            return
+        sample = size / seconds
+        with self._lock:
+            if self.bandwidth is None:
+                self.bandwidth = sample
+            else:
+                self.bandwidth = ((1 - self.GAMMA) * self.bandwidth +
+                                  self.GAMMA * sample)
+
+    def getstats(self):
+        """Return dict with current estimates."""
+        with self._lock:
+            return dict(srtt=self.srtt, rto=self._getrto(),
+                        bandwidth=self.bandwidth, samples=self.samples)
+
+    def _getrto(self):
+        """Return retransmission timeout in seconds (RFC 6298, 2)."""
+        if self.srtt is None:
+            return self.initial
+        rto = self.srtt + self.K * self.rttvar
+        return min(self.maxtimeout, max(self.mintimeout, rto))
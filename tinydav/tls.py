@@ -0,0 +1,126 @@
+# TLS policy for tinydav WebDAV client.
+# Copyright (C) 2009  Manuel Hermann <manuel-hermann@gmx.net>
+#
+# This file is part of tinydav.
+#
+# tinydav is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""TLS policy for tinydav WebDAV client."""
+from __future__ import with_statement
+import hashlib
+import ssl
+import threading
+
+__all__ = ("TLSPolicy",)
+
+
+class TLSPolicy(object):
+    """Share one SSL context and TLS session by all connections to a server.
+
+    The context (with its loaded CA certificates) is created once. Where the
+    ssl module supports it (Python 3.6+), the session of the last handshake
+    is offered on new connections, so the server can resume it with an
+    abbreviated handshake (RFC 5246, 7.3; RFC 8446, 2.2).
+
+    If fingerprint is given, the certificate chain isn't verified, but the
+    SHA-256 hash of the server certificate must match the fingerprint. It's
+    checked right after the handshake of every connection, so no extra
+    connection is needed.
+
+    One policy object should be shared by all clients of one server.
+
+    This object has the following attributes:
+
+    fingerprint -- Hex SHA-256 hash of the pinned server certificate or None.
+    handshakes -- Number of TLS handshakes so far.
+    resumed -- Number of handshakes that resumed a session.
+
+    """
+    def __init__(self, context=None, fingerprint=None):
+        """Initialize the TLS policy.
+
+        context -- ssl.SSLContext to use. If not given, a default context
+                   is created on first use: verifying certificates, or
+                   without verification, if fingerprint is given.
+        fingerprint -- Hex SHA-256 hash of the server certificate the
+                       connections are pinned to.
+
+        """
+        self.fingerprint = fingerprint.lower() if fingerprint else None
+        self.handshakes = 0
+        self.resumed = 0
+        self._context = context
+        self._session = None
+        self._lock = threading.Lock()
+
+    def getcontext(self):
+        """Return the shared ssl.SSLContext."""
+        with self._lock:
+            if self._context is None:
+                self._context = ssl.create_default_context()
+                if self.fingerprint:
+                    self._context.check_hostname = False
+                    self._context.verify_mode = ssl.CERT_NONE
+            return self._context
+
+    def wrap(self, sock, hostname):
+        """Return sock wrapped in TLS, resuming the last session if possible.
+
+        Raise ssl.CertificateError, if the server certificate doesn't match
+        the pinned fingerprint.
+
+        """
+        kwargs = dict(server_hostname=hostname)
+        with self._lock:
+            if self._session is not None:
+                kwargs["session"] = self._session
+        sslsock = self.getcontext().wrap_socket(sock, **kwargs)
+        try:
+            self._verify(sslsock)
+        except:
+            sslsock.close()
+            raise
+        with self._lock:
+            self.handshakes += 1
+            if getattr(sslsock, "session_reused", False):
+                self.resumed += 1
+        self.savesession(sslsock)
+        return sslsock
+
+    def savesession(self, sslsock):
+        """Keep session of sslsock for the next connections.
+
+        With TLS 1.3 the session ticket arrives after the handshake, so this
+        should be called again when a connection is done.
+
+        """
+        session = getattr(sslsock, "session", None)
+        if session is not None:
+            with self._lock:
+                self._session = session
+
+    def getstats(self):
+        """Return dict with handshake counters."""
+        with self._lock:
+            return dict(handshakes=self.handshakes, resumed=self.resumed)
+
+    def _verify(self, sslsock):
+        """Raise ssl.CertificateError, if fingerprint doesn't match."""
+        if not self.fingerprint:
+            return
+        certificate = sslsock.getpeercert(True)
+        actual = hashlib.sha256(certificate).hexdigest() if certificate \
+                 else ""
+        if actual != self.fingerprint:
+            raise ssl.CertificateError("server certificate fingerprint "
+                                       "mismatch [%s]" % actual)
@@ -16,6 +16,7 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """Utility functions and classes for tinydav WebDAV client."""
+from __future__ import with_statement
 import sys
 PYTHON2 = ((2, 5) <= sys.version_info <= (3, 0))
 
@@ -25,7 +26,11 @@ from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from os import path
+from xml.etree.ElementTree import iterparse
+import os
 import re
+import threading
+import zlib
 
 if PYTHON2:
     from urlparse import urlunsplit
@@ -36,7 +41,9 @@ from tinydav.exception import HTTPError
 
 __all__ = (
     "FakeHTTPRequest", "make_absolute", "make_multipart",
-    "extract_namespace", "get_depth"
+    "extract_namespace", "get_depth", "get_length", "RequestBody",
+    "MultiStatusEntry", "iter_multistatus", "ContentDecoder",
+    "TransferStats"
 )
 
 authparser = re.compile("""
@@ -95,6 +102,186 @@ class FakeHTTPRequest(object):
         self._headers[key] = header
 
 
+class RequestBody(object):
+    """File-like request body that can be sent again, e.g. on retries.
+
+    This object has the following attributes:
+
+    fileobject -- The wrapped file-like object.
+    length -- Number of bytes to send or None, if unknown.
+
+    """
+    def __init__(self, fileobject, length=None):
+        """Initialize the request body.
+
+        fileobject -- File-like object with the content to send. Reading
+                      starts at its current position.
+        length -- Number of bytes to send. Default is everything up to the
+                  end of fileobject.
+
+        """
+        self.fileobject = fileobject
+        available = get_length(fileobject)
+        if length is None:
+            self.length = available
+        elif available is None:
+            self.length = length
+        else:
+            self.length = min(length, available)
+        self._remaining = self.length
+        try:
+            self._start = fileobject.tell()
+        except (AttributeError, IOError, OSError):
+            self._start = None
+        self._used = False
+
+    def read(self, size=-1):
+        """Read and return up to size bytes."""
+        self._used = True
+        if self._remaining is None:
+            return self.fileobject.read(size)
+        if (size is None) or (size < 0) or (size > self._remaining):
+            size = self._remaining
+        data = self.fileobject.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def rewind(self):
+        """Prepare the body for being sent (again).
+
+        Raise IOError, if the body was already read and can't be rewound.
+
+        """
+        if self._used:
+            if self._start is None:
+                raise IOError("request body can't be sent again")
+            self.fileobject.seek(self._start)
+            self._remaining = self.length
+            self._used = False
+
+
+class ContentDecoder(object):
+    """Incremental decoder for a gzip or deflate encoded response body.
+
+    This object has the following attributes:
+
+    encoding -- The content-coding the decoder was created for.
+
+    """
+    # RFC 2616, 3.5 Content Codings
+    ENCODINGS = ("gzip", "x-gzip", "deflate")
+
+    @classmethod
+    def create(cls, encoding):
+        """Return ContentDecoder for encoding or None.
+
+        None is returned for identity and unsupported content-codings.
+
+        encoding -- Value of the Content-Encoding header or None.
+
+        """
+        if encoding is None:
+            return None
+        encoding = encoding.strip().lower()
+        if encoding not in cls.ENCODINGS:
+            return None
+        return cls(encoding)
+
+    def __init__(self, encoding):
+        """Initialize the decoder.
+
+        encoding -- One of ContentDecoder.ENCODINGS.
+
+        """
+        self.encoding = encoding
+        if encoding == "deflate":
+            self._decompressor = None
+        else:
+            # add 16 to window bits to expect a gzip header and trailer
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def decompress(self, data):
+        """Return decoded data for the next part of the encoded body."""
+        if self._decompressor is None:
+            # "deflate" should be zlib format (RFC 1950), but some servers
+            # send raw deflate data (RFC 1951). Decide by the first byte.
+            if not data:
+                return data
+            if (ord(data[:1]) & 0x0F) == 8:
+                self._decompressor = zlib.decompressobj()
+            else:
+                self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._decompressor.decompress(data)
+
+    def flush(self):
+        """Return remaining decoded data at the end of the body."""
+        if self._decompressor is None:
+            return "".encode("ascii")
+        return self._decompressor.flush()
+
+
+class TransferStats(object):
+    """Counters of bytes received from the server.
+
+    One object may be shared by several clients. Responses are accounted
+    when their body was read completely.
+
+    This object has the following attributes:
+
+    responses -- Number of accounted responses.
+    encoded -- Number of responses with a compressed body.
+    wirebytes -- Bytes of response bodies as received from the server.
+    decodedbytes -- Bytes of response bodies after decompression.
+
+    """
+    def __init__(self):
+        """Initialize the counters."""
+        self.responses = 0
+        self.encoded = 0
+        self.wirebytes = 0
+        self.decodedbytes = 0
+        self._lock = threading.Lock()
+
+    def add(self, response):
+        """Account the body of an HTTPResponse."""
+        with self._lock:
+            self.responses += 1
+            if response.content_encoding is not None:
+                self.encoded += 1
+            self.wirebytes += response.wire_bytes
+            self.decodedbytes += response.decoded_bytes
+
+    def getstats(self):
+        """Return dict with transfer counters."""
+        with self._lock:
+            return dict(responses=self.responses, encoded=self.encoded,
+                        wirebytes=self.wirebytes,
+                        decodedbytes=self.decodedbytes)
+
+
+def get_length(fileobject):
+    """Return number of bytes left in a file-like object or None.
+
+    fileobject -- File-like object to get remaining length of.
+
+    """
+    try:
+        return len(fileobject)
+    except TypeError:
+        pass
+    try:
+        position = fileobject.tell()
+        try:
+            return os.fstat(fileobject.fileno()).st_size - position
+        except (AttributeError, IOError, OSError):
+            fileobject.seek(0, 2)
+            length = fileobject.tell() - position
+            fileobject.seek(position)
+            return length
+    except (AttributeError, IOError, OSError):
+        return None
+
+
 def make_absolute(httpclient, uri):
     """Return correct absolute URI.
 
@@ -278,6 +465,107 @@ def make_multipart(content, default_encoding="ascii", with_filenames=False):
     return (headers, payload)
 
 
+class MultiStatusEntry(object):
+    """Compact result for one response element of a multi-status response.
+
+    This object has the following attributes:
+
+    href -- The HREF of the resource.
+    status -- The HTTP status code of the resource as int.
+    properties -- Dict with the text of all properties found with status 200.
+                  Names of DAV properties have no namespace.
+    is_collection -- True, if the resourcetype property is a collection.
+
+    """
+    __slots__ = ("href", "status", "properties", "is_collection")
+
+    def __init__(self, href, status, properties, is_collection):
+        self.href = href
+        self.status = status
+        self.properties = properties
+        self.is_collection = is_collection
+
+    def __repr__(self):
+        """Return representation string."""
+        return "<%s: %s %d>" % (self.__class__.__name__, self.href,
+                                self.status)
+
+
+def _get_status(statusline, default=200):
+    """Return status code of a multi-status status line."""
+    # RFC 2518, 12.9.1.2 status XML Element
+    # <!ELEMENT status (#PCDATA) >
+    try:
+        return int(statusline.split()[1])
+    except (AttributeError, IndexError, ValueError):
+        return default
+
+
+def _make_entry(response):
+    """Return MultiStatusEntry for a response element."""
+    # RFC 2518, 12.9.1 response XML Element
+    # <!ELEMENT response (href, ((href*, status)|(propstat+)),
+    # responsedescription?) >
+    href = response.findtext("{DAV:}href")
+    status = _get_status(response.findtext("{DAV:}status"), None)
+    properties = dict()
+    is_collection = False
+    for propstat in response.findall("{DAV:}propstat"):
+        # RFC 2518, 12.9.1.1 propstat XML Element
+        # <!ELEMENT propstat (prop, status, responsedescription?) >
+        propstatus = _get_status(propstat.findtext("{DAV:}status"))
+        if status is None or (propstatus == 200 and status != 200):
+            status = propstatus
+        if propstatus != 200:
+            continue
+        for prop in propstat.findall("{DAV:}prop/*"):
+            name = prop.tag
+            if name.startswith("{DAV:}"):
+                name = name[6:]
+            if name == "resourcetype":
+                collection = prop.find("{DAV:}collection")
+                is_collection = (collection is not None)
+            properties[name] = prop.text
+    if status is None:
+        status = 200
+    return MultiStatusEntry(href, status, properties, is_collection)
+
+
+def iter_multistatus(fileobject, extra=None):
+    """Parse multi-status XML incrementally and yield MultiStatusEntry objects.
+
+    The XML is read from fileobject in blocks while iterating, processed
+    elements are discarded. So memory usage doesn't grow with the number of
+    responses.
+
+    fileobject -- File-like object with the multi-status XML.
+    extra -- If given, a dict that receives the text of all other direct
+             children of the multistatus element (e.g. sync-token) by their
+             tag name.
+
+    Raise ParseError (ExpatError on Python < 2.7) on malformed XML.
+
+    """
+    root = None
+    depth = 0
+    for (event, elem) in iterparse(fileobject, ("start", "end")):
+        if event == "start":
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+        depth -= 1
+        # RFC 2518, 12.9 multistatus XML Element
+        # <!ELEMENT multistatus (response+, responsedescription?) >
+        if depth != 1:
+            continue
+        if elem.tag == "{DAV:}response":
+            yield _make_entry(elem)
+        elif extra is not None:
+            extra[elem.tag] = elem.text
+        root.clear()
+
+
 def extract_namespace(key):
     """Return the namespace in key or None, when no namespace is in key.
 